@@ -50,6 +50,8 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    # First, so its timings cover the rest of the chain
+    'core.instrumentation.RequestMetricsMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -63,7 +65,8 @@ ROOT_URLCONF = 'ECommerce.urls'
 
 TEMPLATES = [
     {
-        'BACKEND': 'django.template.backends.django.DjangoTemplates',
+        # DjangoTemplates with render times reported to core.instrumentation
+        'BACKEND': 'core.instrumentation.DjangoTemplates',
         'DIRS': [os.path.join(BASE_DIR, 'templates')],
         'APP_DIRS': True,
         'OPTIONS': {
@@ -80,6 +83,34 @@ TEMPLATES = [
 WSGI_APPLICATION = 'ECommerce.wsgi.application'
 
 
+# Database
+# DATABASES is set per environment. Every SQLite connection runs
+# SQLITE_PRAGMAS (core/db.py): WAL so pages can read while a checkout
+# writes, and a busy_timeout (ms) so writers queue for the lock instead
+# of failing with "database is locked".
+
+SQLITE_PRAGMAS = {
+    'journal_mode': 'WAL',
+    # With WAL, a power cut can lose the last commits but not corrupt the
+    # file; FULL syncs every commit at the cost of write throughput
+    'synchronous': 'NORMAL',
+    'busy_timeout': 20000,
+    # Negative means KiB rather than pages
+    'cache_size': -20000,
+    'temp_store': 'MEMORY',
+}
+
+# Aliases in DATABASES that replicate 'default'. GETs of the catalog
+# views read REPLICA_READ_MODELS from one of them; all else uses 'default'.
+# Pages cached from a replica's rows, which may predate the change that
+# expired the previous copy, are kept for REPLICA_CACHE_TIMEOUT at most.
+
+DATABASE_ROUTERS = ['core.db.ReplicaRouter']
+DATABASE_REPLICAS = []
+REPLICA_READ_MODELS = ['core.item']
+REPLICA_CACHE_TIMEOUT = 30
+
+
 # Internationalization
 # https://docs.djangoproject.com/en/3.0/topics/i18n/
 
@@ -100,9 +131,160 @@ USE_TZ = True
 STATIC_URL = '/static/'
 STATICFILES_DIRS = [os.path.join(BASE_DIR, 'static')]
 STATIC_ROOT = os.path.join(BASE_DIR, 'static_root')
+
+# Static build (core/assets.py)
+# Deploy with `manage.py build_static` rather than collectstatic: it
+# writes STATIC_BUNDLES, fingerprints every file through the manifest
+# storage and precompresses them. Templates link the bundles instead of
+# their sources once STATIC_USE_BUNDLES is on. STATIC_SERVE_PRECOMPRESSED
+# routes STATIC_URL to core.assets.serve when no front server does it.
+
+STATICFILES_STORAGE = 'core.assets.ManifestStorage'
+STATICFILES_FINDERS = [
+    'django.contrib.staticfiles.finders.FileSystemFinder',
+    'django.contrib.staticfiles.finders.AppDirectoriesFinder',
+    'core.assets.BundleFinder',
+]
+STATIC_BUNDLE_DIR = os.path.join(BASE_DIR, 'static_bundles')
+STATIC_BUNDLES = {
+    'css/site.css': ['css/bootstrap.min.css', 'css/mdb.min.css', 'css/style.css'],
+    'js/site.js': ['js/jquery-3.4.1.min.js', 'js/popper.min.js',
+                   'js/bootstrap.min.js', 'js/mdb.min.js'],
+}
+# Sources, unminified copies and addons no page loads stay out of STATIC_ROOT
+STATIC_BUILD_IGNORE = ['scss', '*.scss', 'addons', 'modules', '*.map',
+                       'css/bootstrap.css', 'css/mdb.css', 'css/mdb.lite*',
+                       'css/style.min.css', 'js/bootstrap.js', 'js/mdb.js']
+STATIC_USE_BUNDLES = config('STATIC_USE_BUNDLES', default=False, cast=bool)
+STATIC_SERVE_PRECOMPRESSED = config('STATIC_SERVE_PRECOMPRESSED', default=False, cast=bool)
+# For names without a content hash, which core.assets.serve caches briefly
+STATIC_CACHE_MAX_AGE = 60 * 60
 MEDIA_URL = '/media/'
 MEDIA_ROOT = os.path.join(BASE_DIR, 'media')
 
+# Resized and WebP copies of item images (core/images.py), made in the
+# background on upload. Their names carry a content hash, so serve
+# MEDIA_URL + IMAGE_DERIVATIVE_DIR with a far-future Cache-Control.
+
+IMAGE_DERIVATIVE_DIR = 'derivatives'
+IMAGE_DERIVATIVE_WIDTHS = (320, 640, 960)
+IMAGE_FALLBACK_WIDTH = 640
+
+
+# Cache
+# Swap in memcached/redis per environment; the cart badge summary, the
+# rendered catalog and product pages, coupons and the version keys that
+# expire them and the search index (core/cache.py) are stored here. Every
+# worker has to share it, which locmem does not: see core/checks.py.
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    }
+}
+
+CACHE_ALIAS = 'default'
+CART_CACHE_TIMEOUT = 300
+CATALOG_CACHE_TIMEOUT = 60 * 60
+# Product pages are cached per slug and expired when their item changes
+PRODUCT_CACHE_TIMEOUT = 60 * 60 * 24
+COUPON_CACHE_TIMEOUT = 60 * 60
+
+
+# Open carts nobody has touched for this many days are deleted by the
+# purge_carts command (run it from cron), in batches of PURGE_BATCH_SIZE
+
+ABANDONED_CART_DAYS = 30
+PURGE_BATCH_SIZE = 500
+
+# How long a cart line holds units of an item with tracked stock; run
+# release_stock_holds from cron about as often to hand lapsed ones back
+
+STOCK_RESERVATION_MINUTES = 15
+
+
+# Catalog
+# 'offset' numbers the pages; 'cursor' uses keyset pagination (no COUNT,
+# constant cost for deep pages). CATALOG_ORDERING must end in 'id'.
+
+CATALOG_PAGINATION = 'offset'
+CATALOG_ORDERING = ['id']
+CATALOG_APPROXIMATE_COUNT = False
+
+# 'memory' keeps an inverted index in each process; 'database' uses SQLite
+# FTS5 or a Postgres tsvector column for large catalogs (run migrate after
+# switching so the index and its triggers get created).
+
+SEARCH_BACKEND = 'memory'
+SEARCH_RESULTS_PER_PAGE = 20
+
+# Completed orders per page of the order history (keyset paginated)
+
+ORDER_HISTORY_PER_PAGE = 50
+
+# JSON API (core/api.py): how long shared caches may serve a catalog
+# response before revalidating it, and the rows fetched per round trip
+# while streaming the item listing
+
+API_CACHE_MAX_AGE = 60
+API_CHUNK_SIZE = 500
+
+# Rows fetched per round trip by the order exports (core/exports.py)
+
+EXPORT_CHUNK_SIZE = 2000
+
+
+# Background jobs (core/tasks.py)
+# An in-process thread pool; EAGER runs each job inline instead.
+
+BACKGROUND_WORKERS = 4
+BACKGROUND_TASKS_EAGER = False
+
+
+# Payments
+# 'sync' talks to Stripe inside the request; 'async' hands the charge to
+# a background job and sends the customer to a status page that polls it.
+
+PAYMENT_MODE = 'sync'
+
+# Seconds after which a payment attempt still pending is taken to have
+# lost its job or request with its process, and is failed so the customer
+# can pay again; well past Stripe's own network timeouts.
+
+PAYMENT_ATTEMPT_TIMEOUT = 15 * 60
+
+# How long the saved-card details on UserProfile are trusted before the
+# payment page asks Stripe again; adding a card clears them at once.
+
+CARD_CACHE_TIMEOUT = 60 * 60 * 24
+
+
+# Instrumentation (core/instrumentation.py)
+# Every response gets a Server-Timing header (total, db, tpl, cache,
+# stripe); /metrics serves the totals in the Prometheus text format and
+# /metrics/slow the last SLOW_REQUEST_BUFFER requests slower than
+# SLOW_REQUEST_SECONDS with up to SLOW_REQUEST_MAX_QUERIES of their SQL.
+# Neither is routed unless METRICS_ENABLED, and then both only answer
+# staff users or an "Authorization: Bearer <METRICS_TOKEN>" header. Not
+# the client address: behind a local proxy every request comes from it.
+
+SERVER_TIMING_HEADER = True
+METRICS_ENABLED = config('METRICS_ENABLED', default=False, cast=bool)
+METRICS_TOKEN = config('METRICS_TOKEN', default='')
+SLOW_REQUEST_SECONDS = 0.5
+SLOW_REQUEST_BUFFER = 100
+SLOW_REQUEST_MAX_QUERIES = 200
+
+
+# Query audit (core/querycheck.py)
+# The same statement this many times in one request is reported as an
+# N+1. STRICT makes AuditClient, and with it the route audit in the
+# tests, fail on N+1s and on routes over their query budget.
+
+QUERY_AUDIT_REPEAT_THRESHOLD = 3
+QUERY_AUDIT_SLOW_MS = 100
+QUERY_AUDIT_STRICT = config('QUERY_AUDIT_STRICT', default=False, cast=bool)
+
 
 # Auth
 
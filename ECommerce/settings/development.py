@@ -16,6 +16,14 @@ INSTALLED_APPS += [
 
 MIDDLEWARE += ['debug_toolbar.middleware.DebugToolbarMiddleware', ]
 
+# Logs N+1s, duplicate and slow queries per request (core/querycheck.py)
+
+MIDDLEWARE += ['core.querycheck.QueryAuditMiddleware', ]
+
+# /metrics and /metrics/slow (core/instrumentation.py), for staff users
+
+METRICS_ENABLED = True
+
 # Database
 # https://docs.djangoproject.com/en/3.0/ref/settings/#databases
 
@@ -1,3 +1,5 @@
+from decouple import Csv
+
 from .base import *
 
 DEBUG = config('DEBUG', cast=bool)
@@ -23,9 +25,63 @@ AUTH_PASSWORD_VALIDATORS = [
     },
 ]
 
-DATABASES = {
+# Cache
+# Shared by every worker, so a change one of them expires is seen by all
+# (checked by manage.py check --deploy). CACHE_BACKEND is a Django cache
+# backend path, e.g. django_redis.cache.RedisCache for redis, and
+# CACHE_LOCATION its servers, comma separated.
+
+CACHES = {
     'default': {
-        'ENGINE': 'django.db.backends.sqlite3',
-        'NAME': os.path.join(BASE_DIR, 'db.sqlite3'),
+        'BACKEND': config('CACHE_BACKEND',
+                          default='django.core.cache.backends.memcached.MemcachedCache'),
+        'LOCATION': config('CACHE_LOCATION', default='127.0.0.1:11211', cast=Csv()),
     }
 }
+
+# Database
+# Postgres when DATABASE_ENGINE is 'postgres', else the SQLite file with
+# the WAL pragmas of SQLITE_PRAGMAS. Each worker keeps its connection for
+# DATABASE_CONN_MAX_AGE seconds instead of reconnecting per request.
+# Django has no pool of its own: point DATABASE_HOST at PgBouncer, and
+# set DATABASE_TRANSACTION_POOLING if it runs in transaction mode, where
+# server-side cursors cannot work. DATABASE_REPLICA_HOSTS (host[:port],
+# comma separated) serve the catalog pages' reads.
+
+DATABASE_ENGINE = config('DATABASE_ENGINE', default='sqlite')
+DATABASE_CONN_MAX_AGE = config('DATABASE_CONN_MAX_AGE', default=600, cast=int)
+
+
+def postgres_database(host, port):
+    return {
+        'ENGINE': 'django.db.backends.postgresql',
+        'NAME': config('DATABASE_NAME'),
+        'USER': config('DATABASE_USER'),
+        'PASSWORD': config('DATABASE_PASSWORD'),
+        'HOST': host,
+        'PORT': port,
+        'CONN_MAX_AGE': DATABASE_CONN_MAX_AGE,
+        'DISABLE_SERVER_SIDE_CURSORS': config('DATABASE_TRANSACTION_POOLING',
+                                              default=False, cast=bool),
+        'OPTIONS': {'connect_timeout': 5},
+    }
+
+
+if DATABASE_ENGINE == 'postgres':
+    DATABASES = {
+        'default': postgres_database(config('DATABASE_HOST', default='localhost'),
+                                     config('DATABASE_PORT', default='5432')),
+    }
+    for n, address in enumerate(config('DATABASE_REPLICA_HOSTS', default='', cast=Csv())):
+        host, _, port = address.partition(':')
+        DATABASES[f'replica_{n}'] = dict(postgres_database(host, port or '5432'),
+                                         TEST={'MIRROR': 'default'})
+    DATABASE_REPLICAS = [alias for alias in DATABASES if alias != 'default']
+else:
+    DATABASES = {
+        'default': {
+            'ENGINE': 'django.db.backends.sqlite3',
+            'NAME': config('DATABASE_NAME', default=os.path.join(BASE_DIR, 'db.sqlite3')),
+            'CONN_MAX_AGE': DATABASE_CONN_MAX_AGE,
+        }
+    }
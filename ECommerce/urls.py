@@ -13,15 +13,23 @@ Including another URLconf
     1. Import the include() function: from django.urls import include, path
     2. Add a URL to urlpatterns:  path('blog/', include('blog.urls'))
 """
+import re
+
 from django.contrib import admin
-from django.urls import path, include
+from django.urls import path, include, re_path
 import debug_toolbar
 from django.conf import settings
 from django.conf.urls.static import static
 
+from core import assets
+
 urlpatterns = [
     path('', include('core.urls', namespace='core')),
     path('accounts/', include('allauth.urls')),
     path('admin/', admin.site.urls),
     path('__debug__/', include(debug_toolbar.urls)),
 ] + static(settings.MEDIA_URL, document_root=settings.MEDIA_ROOT)
+
+if settings.STATIC_SERVE_PRECOMPRESSED:
+    urlpatterns += [re_path(r'^%s(?P<path>.*)$' % re.escape(settings.STATIC_URL.lstrip('/')),
+                            assets.serve)]
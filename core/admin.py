@@ -1,5 +1,10 @@
 from django.contrib import admin
-from .models import Item, OrderItem, Order, Payment, Coupon, Refund, Address, UserProfile
+from django.http import StreamingHttpResponse
+from django.utils import timezone
+from .exports import CONTENT_TYPES, export_orders
+from .models import (Item, OrderItem, Order, Payment, PaymentAttempt, Coupon, CouponRedemption,
+                     Refund, Address, UserProfile)
+from .pagination import EstimatedCountPaginator
 
 def make_refund_accepted(modeladmin,request,queryset):
     queryset.update(refund_requested=False, refund_granted=True)
@@ -7,35 +12,77 @@ def make_refund_accepted(modeladmin,request,queryset):
     
 make_refund_accepted.short_description = 'Update orders to refund granted'
 
+def export_action(format):
+    def export(modeladmin, request, queryset):
+        # Streamed straight from a chunked query, whatever the selection size
+        response = StreamingHttpResponse(export_orders(queryset, format),
+                                         content_type=CONTENT_TYPES[format])
+        filename = f'orders-{timezone.now():%Y%m%d-%H%M%S}.{format}'
+        response['Content-Disposition'] = f'attachment; filename="{filename}"'
+        return response
+
+    export.__name__ = f'export_orders_{format}'
+    export.short_description = f'Export selected orders as {format.upper()}'
+    return export
+
+def address_summary(address):
+    if address is None:
+        return None
+    return f'{address.street_address}, {address.zip} {address.country}'
+
 class OrderAdmin(admin.ModelAdmin):
-    list_display = ['user',
+    list_display = ['customer',
                     'ordered', 
                     'being_delivered',
                     'received',
                     'refund_requested',
                     'refund_granted',
                     'start_date',
-                    'billing_address',
-                    'shipping_address',
-                    'payment',
+                    'billing',
+                    'shipping',
+                    'paid',
                     'coupon']
-    list_display_links = ['user',
-                            'billing_address',
-                            'payment',
-                            'shipping_address',
-                            'coupon']
+    # Each link column costs a reverse() per row, and they all open the order
+    list_display_links = ['customer']
     list_filter = ['ordered', 
                     'being_delivered',
                     'received',
                     'refund_requested',
                     'refund_granted',
                     'start_date']
-    search_fields = ['user__username',
-                    'ref_code']
-    actions = [make_refund_accepted]
+    # A whole ref_code, or the start of a username; no substring scans
+    search_fields = ['=ref_code',
+                    '^user__username']
+    actions = [make_refund_accepted,
+               export_action('csv'),
+               export_action('jsonl')]
+    # Every column below reads from these joins, never from a lazy FK
+    list_select_related = ['user',
+                           'billing_address',
+                           'shipping_address',
+                           'payment',
+                           'coupon']
+    paginator = EstimatedCountPaginator
+    show_full_result_count = False
+
+    def customer(self, obj):
+        return obj.user.username
+    customer.admin_order_field = 'user__username'
+
+    def billing(self, obj):
+        return address_summary(obj.billing_address)
+    billing.admin_order_field = 'billing_address__street_address'
+
+    def shipping(self, obj):
+        return address_summary(obj.shipping_address)
+    shipping.admin_order_field = 'shipping_address__street_address'
+
+    def paid(self, obj):
+        return obj.payment and obj.payment.amount
+    paid.admin_order_field = 'payment__amount'
 
 class AddressAdmin(admin.ModelAdmin):
-    list_display = ['user',
+    list_display = ['customer',
                     'street_address',
                     'apartment_address',
                     'country',
@@ -43,14 +90,45 @@ class AddressAdmin(admin.ModelAdmin):
                     'address_type',
                     'default']
     list_filter = ['default','address_type','country']
-    search_fields = ['user__username','street_address','apartment_address','zip']
+    search_fields = ['=user__username','street_address','apartment_address','^zip']
+    list_select_related = ['user']
+    paginator = EstimatedCountPaginator
+    show_full_result_count = False
+
+    def customer(self, obj):
+        return obj.user.username
+    customer.admin_order_field = 'user__username'
+
+class CouponAdmin(admin.ModelAdmin):
+    list_display = ['code',
+                    'kind',
+                    'amount',
+                    'active',
+                    'valid_from',
+                    'valid_until',
+                    'times_used',
+                    'max_uses',
+                    'max_uses_per_user']
+    list_filter = ['kind', 'active']
+    search_fields = ['=code']
+    readonly_fields = ['times_used']
+
+class CouponRedemptionAdmin(admin.ModelAdmin):
+    list_display = ['coupon', 'customer', 'order', 'created']
+    list_select_related = ['coupon', 'user']
+    raw_id_fields = ['order', 'user']
+
+    def customer(self, obj):
+        return obj.user.username
 
 # Register your models here.
 admin.site.register(Item)
 admin.site.register(OrderItem)
 admin.site.register(Order,OrderAdmin)
 admin.site.register(Payment)
-admin.site.register(Coupon)
+admin.site.register(PaymentAttempt)
+admin.site.register(Coupon,CouponAdmin)
+admin.site.register(CouponRedemption,CouponRedemptionAdmin)
 admin.site.register(Refund)
 admin.site.register(Address,AddressAdmin)
 admin.site.register(UserProfile)
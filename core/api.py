@@ -0,0 +1,175 @@
+"""Read-only JSON views of the catalog and the cart.
+
+Every response carries a strong ETag and a Last-Modified built from the
+``updated_at`` stamps of the rows behind it. Those are read in a query of
+their own before anything else, so a client or edge cache revalidating
+with If-None-Match / If-Modified-Since gets its 304 without the
+response ever being built. The item listing is streamed from a chunked
+iterator and never held in memory whole.
+"""
+from itertools import islice
+
+from django.conf import settings
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db.models import Count, Max
+from django.http import Http404, JsonResponse, StreamingHttpResponse
+from django.shortcuts import get_object_or_404
+from django.urls import reverse
+from django.utils.cache import (get_conditional_response, patch_cache_control,
+                                patch_vary_headers)
+from django.utils.http import http_date, quote_etag
+from django.views.generic import View
+
+from .models import Item, Order, OrderItem
+
+ITEM_FIELDS = ('slug', 'title', 'price', 'discount_price', 'category', 'label',
+               'description', 'image', 'updated_at')
+
+
+# Shared, since json.dumps(cls=...) builds an encoder on every call
+dumps = DjangoJSONEncoder(separators=(',', ':')).encode
+
+
+def make_etag(*parts):
+    return quote_etag('-'.join(str(part) for part in parts))
+
+
+def item_data(row, url_prefix=None):
+    row = dict(row)
+    row['image'] = row['image'] and settings.MEDIA_URL + row['image']
+    if url_prefix is None:
+        row['url'] = Item(slug=row['slug']).get_absolute_url()
+    else:
+        row['url'] = url_prefix + row['slug']
+    return row
+
+
+class ConditionalView(View):
+    """Subclasses return ``(etag, last_modified)`` from ``get_version`` and
+    build the response in ``render``, which a matching validator skips."""
+    private = False
+
+    def dispatch(self, request, *args, **kwargs):
+        try:
+            return super().dispatch(request, *args, **kwargs)
+        except Http404:
+            return JsonResponse({'detail': 'Not found'}, status=404)
+
+    def get(self, request, *args, **kwargs):
+        etag, last_modified = self.get_version(**kwargs)
+        timestamp = last_modified and int(last_modified.timestamp())
+        response = get_conditional_response(
+            request, etag=etag, last_modified=timestamp)
+        if response is None:
+            response = self.render(**kwargs)
+        response['ETag'] = etag
+        if timestamp:
+            response['Last-Modified'] = http_date(timestamp)
+        if self.private:
+            patch_cache_control(response, private=True, no_cache=True)
+            patch_vary_headers(response, ['Cookie'])
+        else:
+            patch_cache_control(response, public=True,
+                                max_age=settings.API_CACHE_MAX_AGE)
+        return response
+
+
+class ItemListView(ConditionalView):
+    def get_queryset(self):
+        queryset = Item.objects.all()
+        category = self.request.GET.get('category')
+        if category:
+            queryset = queryset.filter(category=category)
+        return queryset
+
+    def get_version(self):
+        # The count catches deletions, which leave no newer stamp behind
+        version = self.get_queryset().aggregate(
+            count=Count('pk'), updated=Max('updated_at'))
+        updated = version['updated']
+        return (make_etag('items', self.request.GET.get('category', ''),
+                          version['count'], updated and updated.timestamp()),
+                updated)
+
+    def stream(self):
+        chunk_size = settings.API_CHUNK_SIZE
+        rows = self.get_queryset().order_by('id').values(*ITEM_FIELDS).iterator(
+            chunk_size=chunk_size)
+        # Product URLs differ only by slug, so reverse() runs once
+        url_prefix = reverse('core:product_url', args=['-'])[:-1]
+        separator = '['
+        while True:
+            # One write per chunk of rows rather than one per row
+            chunk = [dumps(item_data(row, url_prefix))
+                     for row in islice(rows, chunk_size)]
+            if not chunk:
+                break
+            yield separator + ','.join(chunk)
+            separator = ','
+        yield '[]' if separator == '[' else ']'
+
+    def render(self):
+        return StreamingHttpResponse(self.stream(),
+                                     content_type='application/json')
+
+
+class ItemDetailView(ConditionalView):
+    def get_version(self, slug):
+        self.version = get_object_or_404(
+            Item.objects.values_list('pk', 'updated_at'), slug=slug)
+        pk, updated = self.version
+        return make_etag('item', pk, updated.timestamp()), updated
+
+    def render(self, slug):
+        row = Item.objects.values(*ITEM_FIELDS).get(pk=self.version[0])
+        return JsonResponse(item_data(row), json_dumps_params={'separators': (',', ':')})
+
+
+class CartView(ConditionalView):
+    private = True
+
+    def dispatch(self, request, *args, **kwargs):
+        if not request.user.is_authenticated:
+            return JsonResponse({'detail': 'Authentication required'}, status=401)
+        return super().dispatch(request, *args, **kwargs)
+
+    def get_version(self):
+        # Lines not yet snapshotted show their items' live titles and
+        # prices, so a repriced item has to change the validator too
+        self.version = Order.objects.filter(
+            user=self.request.user, ordered=False).annotate(
+            items_updated=Max('items__item__updated_at')).values_list(
+            'pk', 'updated_at', 'items_updated').first()
+        if self.version is None:
+            return make_etag('cart', self.request.user.pk, 'empty'), None
+        pk, updated, items_updated = self.version
+        if items_updated is not None:
+            updated = max(updated, items_updated)
+        return make_etag('cart', pk, updated.timestamp()), updated
+
+    def render(self):
+        if self.version is None:
+            return JsonResponse({'items': [], 'subtotal': '0.00', 'discount': '0.00',
+                                 'total': '0.00', 'coupon': None})
+        order = Order.objects.filter(pk=self.version[0]).values(
+            'subtotal', 'discount', 'total', 'coupon__code').get()
+        # The snapshot once a payment has taken one, as in Order.lines_subtotal,
+        # so the lines add up to the total being charged
+        lines = OrderItem.objects.filter(order=self.version[0]).order_by('pk').values(
+            'quantity', 'title', 'unit_price', 'item__slug', 'item__title',
+            'item__price', 'item__discount_price')
+        items = []
+        for line in lines:
+            unit_price = line['unit_price']
+            if unit_price is None:
+                unit_price = line['item__discount_price'] or line['item__price']
+            items.append({'slug': line['item__slug'],
+                          'title': line['title'] or line['item__title'],
+                          'quantity': line['quantity'],
+                          'unit_price': unit_price,
+                          'total_price': line['quantity'] * unit_price})
+        return JsonResponse({'items': items,
+                             'subtotal': order['subtotal'],
+                             'discount': order['discount'],
+                             'total': order['total'],
+                             'coupon': order['coupon__code']})
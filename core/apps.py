@@ -1,5 +1,15 @@
 from django.apps import AppConfig
+from django.core.checks import Tags, register
+from django.db.backends.signals import connection_created
+from django.db.models.signals import post_migrate
 
 
 class CoreConfig(AppConfig):
     name = 'core'
+
+    def ready(self):
+        from . import checks, db, instrumentation, search
+        post_migrate.connect(search.search_schema_receiver, sender=self)
+        register(checks.check_shared_cache, Tags.caches, deploy=True)
+        connection_created.connect(db.configure_sqlite)
+        connection_created.connect(instrumentation.install_query_wrapper)
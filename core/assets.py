@@ -0,0 +1,202 @@
+"""Static files built for long-term caching: bundled, fingerprinted and
+precompressed.
+
+The build_static command concatenates each of STATIC_BUNDLES from its
+sources into STATIC_BUNDLE_DIR, where BundleFinder picks it up. It then
+runs collectstatic through the manifest storage, which puts a content
+hash into every file name and rewrites the url()s between them. Last,
+it writes .gz and .br copies next to each compressible file. brotli is
+optional: without it there is only gzip.
+
+``serve`` is STATIC_URL for deployments with no front server doing the
+same: it hands out the .br or .gz copy to browsers that accept one, and
+caches fingerprinted names for a year.
+"""
+import gzip
+import mimetypes
+import os
+import re
+
+from django.conf import settings
+from django.contrib.staticfiles import finders
+from django.contrib.staticfiles.finders import BaseFinder
+from django.contrib.staticfiles.storage import ManifestStaticFilesStorage
+from django.core.exceptions import SuspiciousFileOperation
+from django.core.files.storage import FileSystemStorage
+from django.http import FileResponse, Http404, HttpResponseNotModified
+from django.utils._os import safe_join
+from django.utils.cache import patch_cache_control, patch_vary_headers
+from django.utils.http import http_date
+from django.views.static import was_modified_since
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+COMPRESSIBLE = {'.css', '.js', '.svg', '.html', '.txt', '.json', '.xml', '.map',
+                '.eot', '.ttf', '.otf', '.ico'}
+# Encodings in order of preference, with the suffix of their copies
+ENCODINGS = [('br', '.br'), ('gzip', '.gz')]
+FINGERPRINTED = re.compile(r'\.[0-9a-f]{12}\.[^/.]+$')
+SOURCE_MAP = re.compile(r'^\s*(/\*\s*# sourceMappingURL=.*?\*/|//\s*# sourceMappingURL=.*)$',
+                        re.M)
+CHARSET = re.compile(r'@charset "[^"]*";')
+
+
+class ManifestStorage(ManifestStaticFilesStorage):
+    """Hashed URLs once build_static has run, plain ones until then (in
+    development and the tests) instead of an error."""
+    manifest_strict = False
+
+    def stored_name(self, name):
+        try:
+            return super().stored_name(name)
+        except ValueError:
+            return name
+
+
+class BundleFinder(BaseFinder):
+    """Finds the bundles build_static wrote to STATIC_BUNDLE_DIR."""
+
+    def get_storage(self):
+        return FileSystemStorage(location=settings.STATIC_BUNDLE_DIR)
+
+    def find(self, path, all=False):
+        storage = self.get_storage()
+        if path in settings.STATIC_BUNDLES and storage.exists(path):
+            return [storage.path(path)] if all else storage.path(path)
+        return []
+
+    def list(self, ignore_patterns):
+        storage = self.get_storage()
+        for path in settings.STATIC_BUNDLES:
+            if storage.exists(path):
+                yield path, storage
+
+
+def minify_css(css):
+    """Comments and whitespace only; /*! licence */ comments are kept."""
+    css = re.sub(r'/\*(?!!).*?\*/', '', css, flags=re.S)
+    css = re.sub(r'\s+', ' ', css)
+    # Not around ':' in general, where a space can be a descendant combinator
+    css = re.sub(r'\s*([{};,>])\s*', r'\1', css)
+    css = re.sub(r'(?<=[;{])([\w-]+):\s+', r'\1:', css)
+    return css.replace(';}', '}').strip()
+
+
+def read_source(path):
+    found = finders.find(path)
+    if not found:
+        raise FileNotFoundError(f'Bundle source {path} not found')
+    with open(found, encoding='utf-8') as f:
+        source = f.read()
+    if path.endswith('.css') and not path.endswith('.min.css'):
+        source = minify_css(source)
+    # The maps are not bundled, so browsers would only 404 on them
+    return SOURCE_MAP.sub('', source)
+
+
+def build_bundle(name):
+    sources = [read_source(path) for path in settings.STATIC_BUNDLES[name]]
+    if name.endswith('.css'):
+        # Only valid as the very first thing in a stylesheet
+        return '@charset "UTF-8";\n' + '\n'.join(CHARSET.sub('', s) for s in sources)
+    # A source without a trailing semicolon must not run into the next
+    return ';\n'.join(sources)
+
+
+def write_bundles():
+    """Write every bundle to STATIC_BUNDLE_DIR, returning {name: bytes}."""
+    sizes = {}
+    for name in settings.STATIC_BUNDLES:
+        path = os.path.join(settings.STATIC_BUNDLE_DIR, name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        content = build_bundle(name).encode('utf-8')
+        with open(path, 'wb') as f:
+            f.write(content)
+        sizes[name] = len(content)
+    return sizes
+
+
+def compress(path, data):
+    """Write the compressed copies of ``data`` worth keeping; returns
+    {encoding: bytes}."""
+    copies = {'gzip': gzip.compress(data, compresslevel=9, mtime=0)}
+    if brotli is not None:
+        copies['br'] = brotli.compress(data, quality=11)
+    sizes = {}
+    for encoding, suffix in ENCODINGS:
+        content = copies.get(encoding)
+        # Already-compressed formats barely shrink; skip what doesn't pay
+        if content is not None and len(content) < len(data) * 0.95:
+            with open(path + suffix, 'wb') as f:
+                f.write(content)
+            sizes[encoding] = len(content)
+    return sizes
+
+
+def precompress(root):
+    """Precompress every compressible file under ``root`` whose copies are
+    missing or older than it."""
+    totals = {'files': 0, 'bytes': 0, 'gzip': 0, 'br': 0}
+    for directory, _, names in os.walk(root):
+        for name in names:
+            path = os.path.join(directory, name)
+            if os.path.splitext(name)[1].lower() not in COMPRESSIBLE:
+                continue
+            if os.path.exists(path + '.gz') and (
+                    os.path.getmtime(path + '.gz') >= os.path.getmtime(path)):
+                continue
+            with open(path, 'rb') as f:
+                data = f.read()
+            sizes = compress(path, data)
+            totals['files'] += 1
+            totals['bytes'] += len(data)
+            for encoding in ('gzip', 'br'):
+                totals[encoding] += sizes.get(encoding, len(data))
+    return totals
+
+
+def accepted_encodings(request):
+    header = request.META.get('HTTP_ACCEPT_ENCODING', '')
+    accepted = set()
+    for part in header.split(','):
+        coding, _, params = part.strip().partition(';')
+        if params.replace(' ', '') not in ('q=0', 'q=0.0', 'q=0.00', 'q=0.000'):
+            accepted.add(coding.strip().lower())
+    return accepted
+
+
+def serve(request, path):
+    try:
+        fullpath = safe_join(settings.STATIC_ROOT, path)
+    except SuspiciousFileOperation:
+        raise Http404('Not found')
+    if not os.path.isfile(fullpath):
+        raise Http404('Not found')
+    accepted = accepted_encodings(request)
+    encoding, filename = None, fullpath
+    for coding, suffix in ENCODINGS:
+        if coding in accepted and os.path.isfile(fullpath + suffix):
+            encoding, filename = coding, fullpath + suffix
+            break
+    stat = os.stat(filename)
+    if not was_modified_since(request.META.get('HTTP_IF_MODIFIED_SINCE'),
+                              stat.st_mtime, stat.st_size):
+        response = HttpResponseNotModified()
+    else:
+        content_type, _ = mimetypes.guess_type(fullpath)
+        response = FileResponse(open(filename, 'rb'),
+                                content_type=content_type or 'application/octet-stream')
+        response['Last-Modified'] = http_date(stat.st_mtime)
+        if encoding:
+            response['Content-Encoding'] = encoding
+    patch_vary_headers(response, ['Accept-Encoding'])
+    if FINGERPRINTED.search(path):
+        # The name changes with the content, so it never needs revalidating
+        patch_cache_control(response, public=True, max_age=60 * 60 * 24 * 365,
+                            immutable=True)
+    else:
+        patch_cache_control(response, public=True, max_age=settings.STATIC_CACHE_MAX_AGE)
+    return response
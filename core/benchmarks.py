@@ -0,0 +1,1251 @@
+"""Per-route query/latency/memory benchmarks for core.urls.
+
+``run_benchmarks`` seeds a catalog into the current database, requests
+every route with the test client and returns a JSON-serialisable report.
+It backs both the ``benchmark`` management command and the query budget
+tests in core/tests.py.
+"""
+import io
+import json
+import os
+import re
+import statistics
+import tempfile
+import threading
+import time
+import tracemalloc
+from collections import namedtuple
+from contextlib import contextmanager
+from unittest import mock
+
+import django
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.contrib.staticfiles import finders
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.db import connection, reset_queries
+from django.http import HttpResponse
+from django.core.management import call_command
+from django.core.management.base import BaseCommand
+from django.test import Client, RequestFactory, override_settings
+from django.core.paginator import Paginator
+from django.test.utils import (CaptureQueriesContext, setup_test_environment,
+                               teardown_test_environment)
+from django.urls import reverse
+from django.utils import timezone
+from PIL import Image
+
+from . import (assets, exports, images, instrumentation, inventory, payments, search,
+               tasks, views)
+from .cache import bump_catalog_version, bump_product_version, get_cache
+from .pagination import CursorPaginator, encode_cursor
+from .querycheck import AuditClient, is_transaction_control
+from .models import Address, Coupon, Item, Order, OrderItem, Payment, PaymentAttempt
+from .testing import FakeStripe, FakeStripeServer
+
+User = get_user_model()
+
+Route = namedtuple('Route', 'name budget prepare')
+Request = namedtuple('Request', 'user method path data')
+
+
+@contextmanager
+def throwaway_database(name=None):
+    """Run the body against a freshly created test database.
+
+    ``name`` overrides the test database name, e.g. to get an on-disk
+    SQLite file that several threads can write to.
+    """
+    setup_test_environment()
+    test_settings = connection.settings_dict.setdefault('TEST', {})
+    old_test_name = test_settings.get('NAME')
+    if name:
+        test_settings['NAME'] = name
+    old_name = connection.creation.create_test_db(verbosity=0, autoclobber=True)
+    try:
+        yield
+    finally:
+        connection.creation.destroy_test_db(old_name, verbosity=0)
+        test_settings['NAME'] = old_test_name
+        teardown_test_environment()
+
+
+class BenchmarkCommand(BaseCommand):
+    """Base of the benchmark_* commands: runs ``run(**options)`` in a
+    throwaway database and prints the JSON report it returns, or writes
+    it to --output.
+
+    With ``threaded``, SQLite gets an on-disk database, for benchmarks
+    whose threads or background jobs open connections of their own,
+    which SQLite's in-memory test database does not allow.
+    """
+    threaded = False
+
+    def add_arguments(self, parser):
+        parser.add_argument('--output', help='write the JSON report here '
+                            'instead of stdout')
+
+    def run(self, **options):
+        raise NotImplementedError
+
+    def handle(self, *args, **options):
+        with self.database():
+            report = self.run(**options)
+        self.write_report(report, options['output'])
+
+    @contextmanager
+    def database(self):
+        if self.threaded and connection.vendor == 'sqlite':
+            with tempfile.TemporaryDirectory() as directory:
+                with throwaway_database(os.path.join(directory, 'benchmark.sqlite3')):
+                    yield
+        else:
+            with throwaway_database():
+                yield
+
+    def write_report(self, report, output=None):
+        report = json.dumps(report, indent=2)
+        if output:
+            with open(output, 'w') as f:
+                f.write(report + '\n')
+        else:
+            self.stdout.write(report)
+
+
+# Deterministic vocabulary so search benchmarks see realistic posting lists
+COLOURS = ['black', 'white', 'navy', 'olive', 'grey', 'red', 'sand', 'teal',
+           'burgundy', 'mustard', 'charcoal', 'ivory']
+MATERIALS = ['cotton', 'linen', 'wool', 'denim', 'leather', 'silk', 'fleece',
+             'canvas', 'cashmere', 'corduroy']
+GARMENTS = ['shirt', 'tee', 'hoodie', 'jacket', 'jeans', 'chinos', 'shorts',
+            'sweater', 'coat', 'blazer', 'polo', 'cardigan', 'parka', 'vest']
+
+
+def item_title(n):
+    return (f'{COLOURS[n % len(COLOURS)].title()} '
+            f'{MATERIALS[n // 7 % len(MATERIALS)]} '
+            f'{GARMENTS[n // 3 % len(GARMENTS)]} {n}')
+
+
+def seed_items(count, batch_size=5000):
+    for start in range(0, count, batch_size):
+        Item.objects.bulk_create(
+            Item(title=item_title(n), price=10 + n % 90,
+                 discount_price=(5 + n % 40) if n % 3 == 0 else None,
+                 category=Item.CATEGORY_CHOICES[n % 3][0],
+                 label=Item.LABEL_CHOICES[n % 3][0],
+                 slug=f'item-{n:07d}',
+                 description=f'A {MATERIALS[n // 11 % len(MATERIALS)]} '
+                             f'{GARMENTS[n % len(GARMENTS)]} in '
+                             f'{COLOURS[n // 5 % len(COLOURS)]}, item {n}',
+                 image='sample.jpg')
+            for n in range(start, min(start + batch_size, count)))
+
+
+class Dataset:
+    def __init__(self, items=2000, cart_size=50, history_users=20,
+                 orders_per_user=10, lines_per_order=5):
+        self.items = items
+        self.cart_size = cart_size
+        self.history_users = history_users
+        self.orders_per_user = orders_per_user
+        self.lines_per_order = lines_per_order
+        self.shoppers = 0
+
+    def as_dict(self):
+        return {'items': self.items,
+                'cart_size': self.cart_size,
+                'history_users': self.history_users,
+                'orders_per_user': self.orders_per_user,
+                'lines_per_order': self.lines_per_order}
+
+    def seed(self):
+        seed_items(self.items)
+        self.item_ids = list(Item.objects.order_by('pk').values_list('pk', flat=True))
+        self.slugs = dict(Item.objects.values_list('pk', 'slug'))
+        # bulk_create skips the signal that expires cached catalog pages
+        bump_catalog_version()
+        Coupon.objects.create(code='BENCH10', amount=10)
+
+        self.ref_codes = []
+        for n in range(self.history_users):
+            user = User.objects.create(username=f'history-{n}')
+            self.ref_codes += self.add_orders(user, self.orders_per_user,
+                                              self.lines_per_order)
+
+    def item_at(self, n):
+        return self.item_ids[n % len(self.item_ids)]
+
+    def add_orders(self, user, count, lines):
+        now = timezone.now()
+        refs = [f'{user.pk}-{n}' for n in range(count)]
+        Order.objects.bulk_create(
+            Order(user=user, ref_code=ref, ordered=True, ordered_date=now)
+            for ref in refs)
+        order_ids = dict(Order.objects.filter(ref_code__in=refs)
+                         .values_list('ref_code', 'pk'))
+        OrderItem.objects.bulk_create(
+            OrderItem(user=user, ordered=True, item_id=self.item_at(n * lines + i))
+            for n in range(count) for i in range(lines))
+        line_ids = list(OrderItem.objects.filter(user=user, ordered=True)
+                        .order_by('pk').values_list('pk', flat=True))[-count * lines:]
+        Order.items.through.objects.bulk_create(
+            Order.items.through(order_id=order_ids[ref],
+                                orderitem_id=line_ids[n * lines + i])
+            for n, ref in enumerate(refs) for i in range(lines))
+        OrderItem.objects.filter(pk__in=line_ids).update(**payments.snapshot_fields())
+        return refs
+
+    def new_shopper(self, cart_size=None):
+        """A user with default addresses and an open cart of ``cart_size`` lines."""
+        cart_size = self.cart_size if cart_size is None else cart_size
+        self.shoppers += 1
+        user = User.objects.create(username=f'shopper-{self.shoppers}',
+                                   email=f'shopper-{self.shoppers}@example.com')
+        addresses = [Address.objects.create(
+            user=user, street_address='1 Main St', apartment_address='',
+            country='US', zip='10001', address_type=address_type, default=True)
+            for address_type in ('S', 'B')]
+        order = Order.objects.create(user=user, ordered_date=timezone.now(),
+                                     shipping_address=addresses[0],
+                                     billing_address=addresses[1])
+        lines = OrderItem.objects.bulk_create(
+            OrderItem(user=user, item_id=self.item_at(self.shoppers * 7 + n))
+            for n in range(cart_size))
+        line_ids = OrderItem.objects.filter(user=user).values_list('pk', flat=True)
+        order.items.add(*line_ids)
+        subtotal = sum(line.item.get_price() for line in
+                       OrderItem.objects.filter(user=user).select_related('item'))
+        Order.objects.filter(pk=order.pk).update(subtotal=subtotal, total=subtotal)
+        user.cart_slugs = [self.slugs[line.item_id] for line in lines]
+        return user
+
+
+def get(path, user=None):
+    return Request(user, 'get', path, None)
+
+
+def post(path, data, user=None):
+    return Request(user, 'post', path, data)
+
+
+def shopper_get(name, *args):
+    def prepare(dataset):
+        user = dataset.new_shopper()
+        slug_args = [user.cart_slugs[0]] if args else []
+        return get(reverse(name, args=slug_args), user)
+    return prepare
+
+
+def prepare_home_last_page(dataset):
+    return get(reverse('core:item-list_url') + f'?page={-(-dataset.items // views.HomeView.paginate_by)}')
+
+
+def prepare_item_detail(dataset):
+    return get(reverse('core:product_url', args=[dataset.slugs[dataset.item_at(dataset.items // 2)]]))
+
+
+def prepare_checkout_post(dataset):
+    return post(reverse('core:checkout_url'),
+                {'use_default_shipping': 'on', 'use_default_billing': 'on',
+                 'payment_option': 'S'},
+                dataset.new_shopper())
+
+
+def prepare_payment_post(dataset):
+    return post(reverse('core:payment_url', args=['stripe']),
+                {'stripeToken': 'tok_visa'}, dataset.new_shopper())
+
+
+def prepare_add_coupon(dataset):
+    return post(reverse('core:add-coupon_url'), {'code': 'BENCH10'},
+                dataset.new_shopper())
+
+
+def prepare_order_history(dataset):
+    return get(reverse('core:order-history_url'),
+               User.objects.get(username='history-0'))
+
+
+def prepare_refund_post(dataset):
+    return post(reverse('core:request-refund_url'),
+                {'ref_code': dataset.ref_codes[len(dataset.ref_codes) // 2],
+                 'message': 'Wrong size', 'email': 'refund@example.com'})
+
+
+# Query budgets are the counts measured when each route was last tuned;
+# they must not depend on catalog, cart or history size.
+ROUTES = [
+    Route('home', 0, lambda dataset: get(reverse('core:item-list_url'))),
+    Route('home-last-page', 0, prepare_home_last_page),
+    Route('item-detail', 0, prepare_item_detail),
+    Route('order-summary', 5, shopper_get('core:order-summary_url')),
+    Route('add-to-cart', 6, shopper_get('core:add-product_url', 'slug')),
+    Route('remove-single-from-cart', 9, shopper_get('core:remove-single-product_url', 'slug')),
+    Route('remove-from-cart', 8, shopper_get('core:remove-product_url', 'slug')),
+    Route('order-history', 5, prepare_order_history),
+    Route('checkout', 9, shopper_get('core:checkout_url')),
+    Route('checkout-post', 9, prepare_checkout_post),
+    Route('payment', 7, lambda dataset: get(reverse('core:payment_url', args=['stripe']),
+                                           dataset.new_shopper())),
+    Route('payment-post', 17, prepare_payment_post),
+    Route('add-coupon', 6, prepare_add_coupon),
+    Route('request-refund', 0, lambda dataset: get(reverse('core:request-refund_url'))),
+    Route('request-refund-post', 3, prepare_refund_post),
+    Route('api-item', 2, lambda dataset: get(reverse(
+        'core:api-item_url', args=[dataset.slugs[dataset.item_at(dataset.items // 2)]]))),
+    Route('api-cart', 5, shopper_get('core:api-cart_url')),
+]
+
+
+def log_in(client, request):
+    if request.user is None:
+        client.logout()
+    else:
+        client.force_login(request.user)
+
+
+def perform(client, request):
+    if request.method == 'post':
+        return client.post(request.path, request.data)
+    return client.get(request.path)
+
+
+def measure(client, route, dataset, repeat):
+    # Unmeasured warm-up: template loading, first-hit caches
+    request = route.prepare(dataset)
+    log_in(client, request)
+    perform(client, request)
+
+    timings = []
+    for _ in range(repeat):
+        request = route.prepare(dataset)
+        log_in(client, request)
+        with CaptureQueriesContext(connection) as queries:
+            start = time.perf_counter()
+            response = perform(client, request)
+            timings.append(time.perf_counter() - start)
+        # Read now: the next request_started signal clears the query log.
+        # Transaction control is left out so counts match inside a
+        # TestCase, where atomic() issues savepoints instead of BEGIN.
+        query_count = sum(1 for query in queries.captured_queries
+                          if not is_transaction_control(query['sql']))
+
+    # Allocation tracing slows everything down, so it gets its own run
+    request = route.prepare(dataset)
+    log_in(client, request)
+    tracemalloc.start()
+    try:
+        perform(client, request)
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+    return {'name': route.name,
+            'method': request.method.upper(),
+            'path': request.path,
+            'status': response.status_code,
+            'queries': query_count,
+            'query_budget': route.budget,
+            'wall_ms': round(statistics.median(timings) * 1000, 3),
+            'peak_kb': round(peak / 1024, 1)}
+
+
+def run_benchmarks(dataset, names=None, repeat=5):
+    routes = [route for route in ROUTES if not names or route.name in names]
+    client = Client()
+    with override_settings(DEBUG=False), \
+            mock.patch.object(payments, 'stripe', FakeStripe()):
+        dataset.seed()
+        results = [measure(client, route, dataset, repeat) for route in routes]
+    return {'generated_at': timezone.now().isoformat(),
+            'django': django.get_version(),
+            'database': connection.vendor,
+            'dataset': dataset.as_dict(),
+            'repeat': repeat,
+            'routes': results}
+
+
+def audit_routes(dataset, names=None, strict=False):
+    """Every route in ROUTES through querycheck.AuditClient, against its
+    query budget. Strict raises on the first problem found."""
+    routes = [route for route in ROUTES if not names or route.name in names]
+    client = AuditClient(strict=False)
+    results = []
+    with override_settings(DEBUG=False), \
+            mock.patch.object(payments, 'stripe', FakeStripe()):
+        dataset.seed()
+        for route in routes:
+            # Warm-up, as in measure(): first-hit caches are not the route's
+            request = route.prepare(dataset)
+            log_in(client, request)
+            client.query_budget = None
+            perform(client, request)
+            request = route.prepare(dataset)
+            log_in(client, request)
+            client.query_budget = route.budget
+            client.strict = strict
+            try:
+                response = perform(client, request)
+            finally:
+                client.strict = False
+            results.append(dict(name=route.name, method=request.method.upper(),
+                                path=request.path, status=response.status_code,
+                                **response.query_audit.as_dict()))
+    return {'generated_at': timezone.now().isoformat(),
+            'database': connection.vendor,
+            'dataset': dataset.as_dict(),
+            'routes': results,
+            'problems': [f"{route['name']}: {problem}" for route in results
+                         for problem in audit_problems(route)]}
+
+
+def audit_problems(route):
+    problems = []
+    if route['over_budget']:
+        problems.append(f"{route['queries']} queries, budget {route['query_budget']}")
+    problems += [f"N+1 {group['count']}x {group['fingerprint']}"
+                 for group in route['n_plus_one']]
+    return problems
+
+
+def find_regressions(report, baseline=None, tolerance=0.5):
+    """Budget and baseline violations in ``report``, as readable strings."""
+    regressions = []
+    previous = {}
+    if baseline:
+        previous = {route['name']: route for route in baseline['routes']}
+    for route in report['routes']:
+        if route['queries'] > route['query_budget']:
+            regressions.append(
+                f"{route['name']}: {route['queries']} queries, budget {route['query_budget']}")
+        before = previous.get(route['name'])
+        if not before:
+            continue
+        for metric in ('wall_ms', 'peak_kb'):
+            if route[metric] > before[metric] * (1 + tolerance):
+                regressions.append(
+                    f"{route['name']}: {metric} {route[metric]} vs {before[metric]} in baseline")
+    return regressions
+
+
+def time_call(func, repeat):
+    timings = []
+    reset_queries()
+    for _ in range(repeat):
+        with CaptureQueriesContext(connection) as queries:
+            start = time.perf_counter()
+            func()
+            timings.append(time.perf_counter() - start)
+    return round(statistics.median(timings) * 1000, 3), len(queries)
+
+
+def benchmark_pagination(items, per_page=5, repeat=5, depths=(0, 0.5, 1)):
+    """Offset vs keyset page fetch times at several depths of the catalog."""
+    seed_items(items)
+    ordered = Item.objects.order_by('id')
+    num_pages = -(-items // per_page)
+    results = []
+    for depth in depths:
+        number = max(1, round(num_pages * depth))
+        offset = (number - 1) * per_page
+
+        def offset_page():
+            page = Paginator(ordered, per_page).page(number)
+            list(page.object_list)
+
+        cursor = None
+        if offset:
+            cursor = encode_cursor([ordered.values_list('id', flat=True)[offset - 1]])
+
+        def cursor_page():
+            CursorPaginator(Item.objects.all(), per_page).page(cursor)
+
+        offset_ms, offset_queries = time_call(offset_page, repeat)
+        cursor_ms, cursor_queries = time_call(cursor_page, repeat)
+        results.append({'depth': depth, 'page': number,
+                        'offset_ms': offset_ms,
+                        'offset_queries': offset_queries,
+                        'cursor_ms': cursor_ms,
+                        'cursor_queries': cursor_queries})
+    return {'generated_at': timezone.now().isoformat(),
+            'database': connection.vendor,
+            'items': items,
+            'per_page': per_page,
+            'pages': results}
+
+
+SEARCH_QUERIES = [
+    {'query': 'linen'},
+    {'query': 'navy wool coat'},
+    {'query': 'jack'},
+    {'query': 'cotton', 'category': 'S', 'max_price': 40},
+    {'query': '', 'label': 'P', 'min_price': 20, 'max_price': 30},
+    {'query': 'nothingmatches'},
+]
+
+
+def benchmark_finalize(sizes=(1, 10, 100, 500), repeat=5):
+    """Time and queries of payments.snapshot_order and finalize_order,
+    which run around every charge, by cart size."""
+    dataset = Dataset(items=max(sizes), history_users=0)
+    dataset.seed()
+    results = []
+    for size in sizes:
+        carts = []
+        for _ in range(repeat):
+            user = dataset.new_shopper(cart_size=size)
+            carts.append((user, Order.objects.get(user=user, ordered=False)))
+        carts = iter(carts)
+
+        def finalize():
+            user, order = next(carts)
+            amount = payments.snapshot_order(order)
+            payments.finalize_order(order, user, 'ch_benchmark', amount)
+
+        wall_ms, query_count = time_call(finalize, repeat)
+        results.append({'lines': size, 'wall_ms': wall_ms,
+                        'queries': query_count})
+    return {'generated_at': timezone.now().isoformat(),
+            'database': connection.vendor,
+            'carts': results}
+
+
+def benchmark_search(items, backend='memory', repeat=5, queries=SEARCH_QUERIES):
+    """Median latency of representative searches against a seeded catalog."""
+    seed_items(items)
+    bump_catalog_version()
+    with override_settings(SEARCH_BACKEND=backend):
+        index = search.get_backend()
+        start = time.perf_counter()
+        index.build()
+        build_ms = round((time.perf_counter() - start) * 1000, 1)
+        results = []
+        for filters in queries:
+            filters = dict(filters)
+            query = filters.pop('query')
+            total = index.search(query, **filters).total
+            wall_ms, query_count = time_call(
+                lambda: index.search(query, **filters), repeat)
+            results.append({'query': query, 'filters': filters,
+                            'total': total, 'wall_ms': wall_ms,
+                            'queries': query_count})
+    return {'generated_at': timezone.now().isoformat(),
+            'database': connection.vendor,
+            'backend': backend,
+            'items': items,
+            'build_ms': build_ms,
+            'searches': results}
+
+
+def benchmark_export(sizes=(1000, 10000), lines_per_order=3, format='csv'):
+    """Throughput and peak memory of the order export by number of orders."""
+    dataset = Dataset(items=500, history_users=0, lines_per_order=lines_per_order)
+    dataset.seed()
+    results = []
+    exported = 0
+    for size in sizes:
+        # add_orders derives ref codes from the user, so a user per batch
+        user = User.objects.create(username=f'export-{size}')
+        dataset.add_orders(user, size - exported, lines_per_order)
+        exported = size
+        queryset = Order.objects.filter(ordered=True)
+        start = time.perf_counter()
+        written = sum(len(chunk) for chunk in exports.export_orders(queryset, format))
+        elapsed = time.perf_counter() - start
+        # Allocation tracing slows everything down, so it gets its own run
+        tracemalloc.start()
+        try:
+            for chunk in exports.export_orders(queryset, format):
+                pass
+            peak = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+        results.append({'orders': size,
+                        'lines': size * lines_per_order,
+                        'bytes': written,
+                        'rows_per_second': round(size * lines_per_order / elapsed),
+                        'peak_kb': round(peak / 1024, 1)})
+    return {'generated_at': timezone.now().isoformat(),
+            'database': connection.vendor,
+            'format': format,
+            'exports': results}
+
+
+def seed_admin_orders(count, users=100, batch_size=5000):
+    """``count`` paid orders spread over ``users`` customers, each with
+    addresses, a payment and every fifth one a coupon."""
+    start = Order.objects.count()
+    customers = list(User.objects.filter(username__startswith='admin-customer-'))
+    if not customers:
+        User.objects.bulk_create(User(username=f'admin-customer-{n}')
+                                 for n in range(users))
+        customers = list(User.objects.filter(username__startswith='admin-customer-'))
+        Address.objects.bulk_create(
+            Address(user=user, street_address=f'{user.pk} Main St',
+                    apartment_address='', country='US', zip='10001',
+                    address_type=address_type, default=True)
+            for user in customers for address_type in ('S', 'B'))
+    addresses = {(address.user_id, address.address_type): address.pk
+                 for address in Address.objects.filter(user__in=customers)}
+    coupon, _ = Coupon.objects.get_or_create(code='ADMIN5', defaults={'amount': 5})
+    now = timezone.now()
+    for first in range(start, start + count, batch_size):
+        numbers = range(first, min(first + batch_size, start + count))
+        Payment.objects.bulk_create(
+            Payment(stripe_charge_id=f'ch_admin_{n}', amount=20,
+                    user=customers[n % len(customers)]) for n in numbers)
+        # Fresh table, so the newest pks are this batch in insertion order
+        payment_ids = list(Payment.objects.order_by('-pk')
+                           .values_list('pk', flat=True)[:len(numbers)])[::-1]
+        Order.objects.bulk_create(
+            Order(user=user, ref_code=f'admin-{n}', ordered=True,
+                  ordered_date=now, subtotal=20, total=20,
+                  shipping_address_id=addresses[user.pk, 'S'],
+                  billing_address_id=addresses[user.pk, 'B'],
+                  payment_id=payment_id,
+                  coupon=coupon if n % 5 == 0 else None)
+            for n, payment_id in zip(numbers, payment_ids)
+            for user in [customers[n % len(customers)]])
+
+
+def benchmark_admin(sizes=(1000, 10000, 100000), repeat=5):
+    """Queries and latency of the order changelist as the table grows."""
+    admin = User.objects.create_superuser('benchmark-admin', 'admin@example.com', 'pw')
+    client = Client()
+    client.force_login(admin)
+    changelist = reverse('admin:core_order_changelist')
+    results = []
+    seeded = 0
+    for size in sizes:
+        seed_admin_orders(size - seeded)
+        seeded = size
+        pages = [('first-page', {}),
+                 ('page-6', {'p': 5}),
+                 ('filtered', {'refund_requested__exact': 0}),
+                 ('search-ref', {'q': f'admin-{size // 2}'}),
+                 ('search-user', {'q': 'admin-customer-7'})]
+        for name, params in pages:
+            with override_settings(DEBUG=False):
+                wall_ms, query_count = time_call(
+                    lambda: client.get(changelist, params), repeat)
+            results.append({'orders': size, 'page': name,
+                            'wall_ms': wall_ms, 'queries': query_count})
+    return {'generated_at': timezone.now().isoformat(),
+            'database': connection.vendor,
+            'changelists': results}
+
+
+def response_bytes(response):
+    if response.streaming:
+        return len(b''.join(response.streaming_content))
+    return len(response.content)
+
+
+def benchmark_api(items=2000, cart_size=20, repeat=5):
+    """Payload size and latency of the JSON API against the HTML pages.
+
+    Each JSON endpoint is also timed revalidating with the ETag it
+    returned, which is answered with a 304 before anything is built.
+    """
+    dataset = Dataset(items=items, cart_size=cart_size, history_users=0)
+    dataset.seed()
+    client = Client()
+    client.force_login(dataset.new_shopper())
+    slug = dataset.slugs[dataset.item_at(items // 2)]
+    pages = [
+        ('catalog', reverse('core:item-list_url'), reverse('core:api-items_url'),
+         views.HomeView.paginate_by, items),
+        ('item', reverse('core:product_url', args=[slug]),
+         reverse('core:api-item_url', args=[slug]), 1, 1),
+        ('cart', reverse('core:order-summary_url'), reverse('core:api-cart_url'),
+         cart_size, cart_size),
+    ]
+    results = []
+    sizes = {}
+
+    def fetch(path, key=None, **headers):
+        # Read to the end, so streamed bodies are timed in full
+        size = response_bytes(client.get(path, **headers))
+        sizes.setdefault(key or path, size)
+
+    for name, html_path, json_path, html_items, json_items in pages:
+        with override_settings(DEBUG=False):
+            etag = client.get(json_path)['ETag']
+            html_ms, html_queries = time_call(lambda: fetch(html_path), repeat)
+            json_ms, json_queries = time_call(lambda: fetch(json_path), repeat)
+            not_modified_ms, not_modified_queries = time_call(
+                lambda: fetch(json_path, 'not-modified', HTTP_IF_NONE_MATCH=etag),
+                repeat)
+        results.append({'name': name,
+                        'html': {'path': html_path, 'items': html_items,
+                                 'bytes': sizes[html_path],
+                                 'wall_ms': html_ms, 'queries': html_queries},
+                        'json': {'path': json_path, 'items': json_items,
+                                 'bytes': sizes[json_path],
+                                 'wall_ms': json_ms, 'queries': json_queries},
+                        'not_modified': {'bytes': sizes.pop('not-modified'),
+                                         'wall_ms': not_modified_ms,
+                                         'queries': not_modified_queries}})
+    return {'generated_at': timezone.now().isoformat(),
+            'database': connection.vendor,
+            'items': items,
+            'cart_size': cart_size,
+            'pages': results}
+
+
+def benchmark_payments(orders=20, latency=0.25, modes=('sync', 'async')):
+    """Checkouts one request thread gets through against a slow gateway.
+
+    Each mode posts ``orders`` payments back to back through the real
+    stripe library, talking to a FakeStripeServer that sleeps ``latency``
+    seconds per call. In async mode the report also gives how long the
+    background jobs took to settle every charge.
+    """
+    if connection.vendor == 'sqlite':
+        # Lets the request thread and the job threads read while one of
+        # them writes; the setting sticks to the database file
+        with connection.cursor() as cursor:
+            cursor.execute('PRAGMA journal_mode=WAL')
+    dataset = Dataset(items=200, cart_size=5, history_users=0)
+    dataset.seed()
+    client = Client()
+    results = []
+    for mode in modes:
+        shoppers = [dataset.new_shopper() for _ in range(orders)]
+        with override_settings(DEBUG=False, PAYMENT_MODE=mode), \
+                FakeStripeServer(FakeStripe(latency)):
+            timings = []
+            start = time.perf_counter()
+            for user in shoppers:
+                client.force_login(user)
+                started = time.perf_counter()
+                client.post(reverse('core:payment_url', args=['stripe']),
+                            {'stripeToken': 'tok_visa'})
+                timings.append(time.perf_counter() - started)
+            elapsed = time.perf_counter() - start
+            tasks.drain()
+            settled = time.perf_counter() - start
+        completed = Order.objects.filter(user__in=shoppers, ordered=True).count()
+        results.append({'mode': mode,
+                        'orders': orders,
+                        'completed': completed,
+                        'failed': PaymentAttempt.objects.filter(
+                            user__in=shoppers, status=PaymentAttempt.FAILED).count(),
+                        'request_ms': round(statistics.median(timings) * 1000, 3),
+                        'requests_per_second': round(orders / elapsed, 2),
+                        'settled_s': round(settled, 3)})
+    return {'generated_at': timezone.now().isoformat(),
+            'database': connection.vendor,
+            'gateway_latency_s': latency,
+            'modes': results}
+
+
+def benchmark_stock(buyers=200, stock=50, threads=16, latency=0.05,
+                    modes=('held', 'lapsed')):
+    """Buyers racing for one hot item through the cart and payment views.
+
+    ``threads`` request threads each take a share of the buyers, who add
+    the item to their cart and pay for it against a FakeStripeServer that
+    sleeps ``latency`` seconds per call. In 'held' mode buyers past the
+    stock are turned away at the cart by the reservations; in 'lapsed'
+    mode every hold lapses at once, so all of them reach checkout and race
+    for the stock there. Either way no more than ``stock`` may be sold.
+    """
+    pay_url = reverse('core:payment_url', args=['stripe'])
+    summary_url = reverse('core:order-summary_url')
+    results = []
+    for mode in modes:
+        item = Item.objects.create(
+            title=f'Flash sale {mode}', price=20, category=Item.SHIRT,
+            label=Item.DANGER, slug=f'flash-sale-{mode}', description='Hot item',
+            image='sample.jpg', stock=stock)
+        add_url = reverse('core:add-product_url', args=[item.slug])
+        clients = []
+        for n in range(buyers):
+            client = Client()
+            client.force_login(User.objects.create(username=f'buyer-{mode}-{n}'))
+            clients.append(client)
+        barrier = threading.Barrier(threads)
+        errors = []
+        turned_away = []
+
+        def buy(batch):
+            try:
+                barrier.wait()
+                for client in batch:
+                    if client.get(add_url)['Location'] != summary_url:
+                        turned_away.append(client)
+                        continue
+                    client.post(pay_url, {'stripeToken': 'tok_visa'})
+            except Exception as e:
+                errors.append(repr(e))
+            finally:
+                connection.close()
+
+        minutes = 15 if mode == 'held' else 0
+        with override_settings(DEBUG=False, PAYMENT_MODE='sync',
+                               STOCK_RESERVATION_MINUTES=minutes), \
+                FakeStripeServer(FakeStripe(latency)):
+            workers = [threading.Thread(target=buy, args=(clients[n::threads],))
+                       for n in range(threads)]
+            start = time.perf_counter()
+            for worker in workers:
+                worker.start()
+            for worker in workers:
+                worker.join()
+            elapsed = time.perf_counter() - start
+        inventory.release_expired(item.pk)
+        sold = sum(OrderItem.objects.filter(item=item, ordered=True)
+                   .values_list('quantity', flat=True))
+        left, reserved = Item.objects.values_list('stock', 'reserved').get(pk=item.pk)
+        results.append({'mode': mode,
+                        'buyers': buyers,
+                        'stock': stock,
+                        'sold': sold,
+                        'oversold': max(sold - stock, 0),
+                        'stock_left': left,
+                        'stock_consistent': left == stock - sold,
+                        'reserved_after': reserved,
+                        'turned_away_at_cart': len(turned_away),
+                        'turned_away_at_checkout': Order.objects.filter(
+                            items__item=item, ordered=False).count(),
+                        'errors': errors,
+                        'seconds': round(elapsed, 3),
+                        'purchases_per_second': round(sold / elapsed, 2)})
+    return {'generated_at': timezone.now().isoformat(),
+            'database': connection.vendor,
+            'threads': threads,
+            'gateway_latency_s': latency,
+            'modes': results}
+
+
+WEBP_SRCSET = re.compile(r'<source type="image/webp" srcset="([^"]+)"')
+IMG_SRC = re.compile(r'<img src="([^"]+)"')
+PICTURE = re.compile(r'<picture>.*?</picture>', re.S)
+
+
+def media_size(url):
+    return default_storage.size(url[len(settings.MEDIA_URL):])
+
+
+def downloaded_image_bytes(html, slot):
+    """What a WebP-capable browser fetches for the media images in ``html``:
+    from each srcset, the smallest candidate at least ``slot`` pixels wide."""
+    total = 0
+    for picture in PICTURE.findall(html):
+        candidates = sorted((int(width[:-1]), url) for url, width in (
+            candidate.split() for candidate in
+            WEBP_SRCSET.search(picture).group(1).split(', ')))
+        total += media_size(next((url for width, url in candidates if width >= slot),
+                                 candidates[-1][1]))
+    for url in IMG_SRC.findall(PICTURE.sub('', html)):
+        if url.startswith(settings.MEDIA_URL):
+            total += media_size(url)
+    return total
+
+
+def product_photo(n, size):
+    """A JPEG that compresses about as well as a real product shot."""
+    image = Image.merge('RGB', [
+        Image.linear_gradient('L').rotate(n * 37).resize(size),
+        Image.effect_noise(size, 24 + n % 5 * 4),
+        Image.radial_gradient('L').resize(size)])
+    buffer = io.BytesIO()
+    image.save(buffer, 'JPEG', quality=90)
+    return buffer.getvalue()
+
+
+def benchmark_images(items=5, size=(1600, 2000), viewport=1280, dpr=2, repeat=5):
+    """Bytes and render time of the first catalog page before and after
+    the item images get derivatives.
+
+    ``items`` items get a photo of ``size`` each. Bytes count the page
+    plus the images a browser ``viewport`` CSS pixels wide at ``dpr``
+    would download for the cards; render time is for the grid rendered
+    cold, as on a catalog cache miss.
+    """
+    client = Client()
+    url = reverse('core:item-list_url')
+    # The card's sizes attribute: a quarter of the viewport on large screens
+    slot = viewport * dpr * (0.25 if viewport >= 992 else 0.5 if viewport >= 768 else 1)
+    with tempfile.TemporaryDirectory() as media_root, \
+            override_settings(MEDIA_ROOT=media_root, DEBUG=False):
+        seed_items(items)
+        item_ids = list(Item.objects.order_by('pk').values_list('pk', flat=True))
+        for n, pk in enumerate(item_ids):
+            name = default_storage.save(f'photo-{n}.jpg',
+                                        ContentFile(product_photo(n, size)))
+            Item.objects.filter(pk=pk).update(image=name)
+
+        def page():
+            get_cache().clear()
+            return client.get(url)
+
+        def measure():
+            html = page().content.decode()
+            render_ms, queries = time_call(page, repeat)
+            image_bytes = downloaded_image_bytes(html, slot)
+            return {'html_bytes': len(html.encode()),
+                    'image_bytes': image_bytes,
+                    'total_bytes': len(html.encode()) + image_bytes,
+                    'render_ms': render_ms,
+                    'queries': queries}
+
+        before = measure()
+        start = time.perf_counter()
+        for pk in item_ids:
+            images.make_derivatives(pk)
+        derivative_ms = (time.perf_counter() - start) * 1000 / len(item_ids)
+        after = measure()
+    return {'generated_at': timezone.now().isoformat(),
+            'items': items,
+            'image_size': list(size),
+            'viewport': viewport,
+            'dpr': dpr,
+            'slot_px': slot,
+            'before': before,
+            'after': after,
+            'bytes_saved_ratio': round(1 - after['total_bytes'] / before['total_bytes'], 3),
+            'derivatives_ms_per_item': round(derivative_ms, 1)}
+
+
+def static_urls(html):
+    return re.findall(r'(?:href|src)="(%s[^"]+)"' % re.escape(settings.STATIC_URL), html)
+
+
+def benchmark_static(accept_encoding='br, gzip'):
+    """Static bytes and requests a visit to the catalog page costs, with
+    the raw source files and with the output of build_static.
+
+    Built files are fetched through core.assets.serve as a browser sending
+    ``accept_encoding`` would get them. A repeat visit counts the requests
+    a browser still makes: every raw file is revalidated, while
+    fingerprinted ones are cached as immutable.
+    """
+    client = Client()
+    url = reverse('core:item-list_url')
+    with override_settings(
+            STATICFILES_STORAGE='django.contrib.staticfiles.storage.StaticFilesStorage',
+            STATIC_USE_BUNDLES=False, DEBUG=False):
+        html = client.get(url).content.decode()
+        files = [finders.find(path[len(settings.STATIC_URL):]) for path in static_urls(html)]
+        before = {'html_bytes': len(html.encode()),
+                  'requests': len(files),
+                  'static_bytes': sum(os.path.getsize(path) for path in files),
+                  'repeat_visit_requests': len(files)}
+
+    factory = RequestFactory(HTTP_ACCEPT_ENCODING=accept_encoding)
+    with tempfile.TemporaryDirectory() as directory, override_settings(
+            STATIC_ROOT=os.path.join(directory, 'root'),
+            STATIC_BUNDLE_DIR=os.path.join(directory, 'bundles'),
+            STATIC_USE_BUNDLES=True, DEBUG=False):
+        start = time.perf_counter()
+        call_command('build_static', verbosity=0, stdout=io.StringIO())
+        build_s = time.perf_counter() - start
+        html = client.get(url).content.decode()
+        responses = []
+        for path in static_urls(html):
+            path = path[len(settings.STATIC_URL):]
+            responses.append(assets.serve(factory.get(path), path))
+        after = {'html_bytes': len(html.encode()),
+                 'requests': len(responses),
+                 'static_bytes': sum(response_bytes(response) for response in responses),
+                 'encodings': sorted({response.get('Content-Encoding', 'identity')
+                                      for response in responses}),
+                 'repeat_visit_requests': sum('immutable' not in response['Cache-Control']
+                                              for response in responses),
+                 'build_s': round(build_s, 2)}
+    return {'generated_at': timezone.now().isoformat(),
+            'page': url,
+            'accept_encoding': accept_encoding,
+            'brotli_installed': assets.brotli is not None,
+            'before': before,
+            'after': after,
+            'static_bytes_saved_ratio': round(
+                1 - after['static_bytes'] / before['static_bytes'], 3)}
+
+
+def uninstrumented_settings():
+    instrumented = 'core.instrumentation.RequestMetricsMiddleware'
+    return {'MIDDLEWARE': [name for name in settings.MIDDLEWARE if name != instrumented],
+            'TEMPLATES': [dict(engine, BACKEND='django.template.backends.django.DjangoTemplates')
+                          if engine['BACKEND'] == 'core.instrumentation.DjangoTemplates'
+                          else engine for engine in settings.TEMPLATES]}
+
+
+def benchmark_instrumentation(items=40, rounds=40, batch=25, warmup=5):
+    """Catalog page latency with and without core.instrumentation.
+
+    Batches of ``batch`` requests alternate between the two setups for
+    ``rounds`` rounds, which of them goes first alternating too, so drift
+    affects both alike; each setup's figure is
+    the median of its per-batch means. 'warm' is a catalog cache hit (the
+    cheapest page, so the largest relative overhead), 'cold' renders the
+    grid from the database. The middleware is also timed on its own
+    around an empty view, which is steadier than the difference.
+    """
+    seed_items(items)
+    url = reverse('core:item-list_url')
+    plain = uninstrumented_settings()
+    report = {'generated_at': timezone.now().isoformat(),
+              'items': items,
+              'rounds': rounds,
+              'batch': batch}
+    with override_settings(DEBUG=False):
+        clients = {}
+        with override_settings(**plain):
+            clients['off'] = Client()
+            clients['off'].get(url)
+        clients['on'] = Client()
+        clients['on'].get(url)
+
+        def run(setup, cold):
+            def page():
+                if cold:
+                    bump_catalog_version()
+                clients[setup].get(url)
+            # Switching TEMPLATES starts a fresh engine with empty caches
+            for _ in range(warmup):
+                page()
+            start = time.perf_counter()
+            for _ in range(batch):
+                page()
+            return (time.perf_counter() - start) / batch
+
+        for mode in ('warm', 'cold'):
+            timings = {'off': [], 'on': []}
+            for n in range(rounds):
+                for setup in (('off', 'on') if n % 2 else ('on', 'off')):
+                    with override_settings(**(plain if setup == 'off' else {})):
+                        timings[setup].append(run(setup, mode == 'cold'))
+            off = statistics.median(timings['off'])
+            on = statistics.median(timings['on'])
+            report[mode] = {'off_ms': round(off * 1000, 3),
+                            'on_ms': round(on * 1000, 3),
+                            'overhead_ratio': round(on / off - 1, 4)}
+
+    request = RequestFactory().get(url)
+    middleware = instrumentation.RequestMetricsMiddleware(lambda request: HttpResponse())
+    empty = lambda request: HttpResponse()
+    repeat = rounds * batch * 10
+    timings = []
+    for view in (empty, middleware):
+        start = time.perf_counter()
+        for _ in range(repeat):
+            view(request)
+        timings.append((time.perf_counter() - start) / repeat)
+    instrumentation.registry.reset()
+    report['middleware_us'] = round((timings[1] - timings[0]) * 1e6, 2)
+    for mode in ('warm', 'cold'):
+        report[mode]['middleware_ratio'] = round(
+            report['middleware_us'] / 1000 / report[mode]['off_ms'], 4)
+    return report
+
+
+def database_profiles():
+    """(name, settings overrides, CONN_MAX_AGE) for the current engine."""
+    if connection.vendor == 'sqlite':
+        # Django's defaults: rollback journal, sqlite3's 5s busy timeout
+        return [('sqlite-rollback-journal', {'SQLITE_PRAGMAS': {'journal_mode': 'DELETE'}}, 0),
+                ('sqlite-wal', {}, 0),
+                ('sqlite-wal-persistent', {}, 600)]
+    return [(connection.vendor, {}, 0),
+            (f'{connection.vendor}-persistent', {}, 600)]
+
+
+def benchmark_databases(buyers=60, threads=8, readers=2, cart_size=3, latency=0.01):
+    """Concurrent checkout throughput for each profile of database_profiles().
+
+    ``threads`` request threads share the buyers, each of whom adds an
+    item to a ``cart_size`` cart, posts the checkout form and pays against
+    a FakeStripeServer sleeping ``latency`` seconds per call, while
+    ``readers`` threads keep fetching product pages. The test client never
+    closes connections, so the threads call close_old_connections() after
+    every request as the WSGI handler does; that is where CONN_MAX_AGE
+    makes its difference.
+    """
+    dataset = Dataset(items=200, cart_size=cart_size, history_users=0)
+    dataset.seed()
+    checkout_url = reverse('core:checkout_url')
+    pay_url = reverse('core:payment_url', args=['stripe'])
+    product_urls = [reverse('core:product_url', args=[dataset.slugs[pk]])
+                    for pk in dataset.item_ids[:20]]
+    results = []
+    for name, overrides, max_age in database_profiles():
+        shoppers = [dataset.new_shopper() for _ in range(buyers)]
+        clients = []
+        for user in shoppers:
+            client = Client()
+            client.force_login(user)
+            clients.append(client)
+        barrier = threading.Barrier(threads + readers)
+        done = threading.Event()
+        errors = []
+        latencies = []
+        reads = []
+
+        def request(client, method, *args):
+            try:
+                return getattr(client, method)(*args)
+            finally:
+                django.db.close_old_connections()
+
+        def buy(batch):
+            try:
+                barrier.wait()
+                for client, user in batch:
+                    start = time.perf_counter()
+                    request(client, 'get', reverse('core:add-product_url',
+                                                   args=[user.cart_slugs[0]]))
+                    request(client, 'post', checkout_url,
+                            {'use_default_shipping': 'on', 'use_default_billing': 'on',
+                             'payment_option': 'S'})
+                    request(client, 'post', pay_url, {'stripeToken': 'tok_visa'})
+                    latencies.append(time.perf_counter() - start)
+            except Exception as e:
+                errors.append(repr(e))
+            finally:
+                connection.close()
+
+        def browse():
+            client = Client()
+            count = 0
+            try:
+                barrier.wait()
+                while not done.is_set():
+                    request(client, 'get', product_urls[count % len(product_urls)])
+                    count += 1
+            except Exception as e:
+                errors.append(repr(e))
+            finally:
+                reads.append(count)
+                connection.close()
+
+        batches = list(zip(clients, shoppers))
+        old_max_age = connection.settings_dict['CONN_MAX_AGE']
+        connection.settings_dict['CONN_MAX_AGE'] = max_age
+        try:
+            with override_settings(DEBUG=False, PAYMENT_MODE='sync', **overrides), \
+                    FakeStripeServer(FakeStripe(latency)):
+                # The next query reconnects with this profile's pragmas
+                connection.close()
+                journal_mode = None
+                if connection.vendor == 'sqlite':
+                    with connection.cursor() as cursor:
+                        cursor.execute('PRAGMA journal_mode')
+                        journal_mode = cursor.fetchone()[0]
+                workers = [threading.Thread(target=buy, args=(batches[n::threads],))
+                           for n in range(threads)]
+                browsers = [threading.Thread(target=browse) for _ in range(readers)]
+                start = time.perf_counter()
+                for thread in workers + browsers:
+                    thread.start()
+                for thread in workers:
+                    thread.join()
+                elapsed = time.perf_counter() - start
+                done.set()
+                for thread in browsers:
+                    thread.join()
+        finally:
+            connection.settings_dict['CONN_MAX_AGE'] = old_max_age
+            connection.close()
+        completed = Order.objects.filter(user__in=shoppers, ordered=True).count()
+        latencies.sort()
+        results.append({'profile': name,
+                        'journal_mode': journal_mode,
+                        'conn_max_age': max_age,
+                        'buyers': buyers,
+                        'checkouts': completed,
+                        'errors': len(errors),
+                        'error_sample': errors[:3],
+                        'seconds': round(elapsed, 3),
+                        'checkouts_per_second': round(completed / elapsed, 2),
+                        'checkout_p50_ms': round(latencies[len(latencies) // 2] * 1000, 1)
+                        if latencies else None,
+                        'checkout_p95_ms': round(latencies[int(len(latencies) * 0.95)] * 1000, 1)
+                        if latencies else None,
+                        'product_reads_per_second': round(sum(reads) / elapsed, 2)})
+    return {'generated_at': timezone.now().isoformat(),
+            'database': connection.vendor,
+            'threads': threads,
+            'readers': readers,
+            'cart_size': cart_size,
+            'gateway_latency_s': latency,
+            'profiles': results}
+
+
+def benchmark_product_page(threads=8, requests=200, visitors=('anonymous', 'logged-in'),
+                           modes=('uncached', 'cached', 'revalidated')):
+    """Requests per second for one hot product page under concurrency.
+
+    ``threads`` threads with a Client each fetch the same product
+    ``requests`` times. 'uncached' bumps the product's version before
+    every request, so each renders the page from the database as before
+    it was cached; 'cached' renders the navbar around the cached part;
+    'revalidated' sends the ETag of the last response and gets a 304.
+    Logged-in visitors each have a cart, whose badge the page shows.
+    """
+    dataset = Dataset(items=200, cart_size=3, history_users=0)
+    dataset.seed()
+    slug = dataset.slugs[dataset.item_ids[0]]
+    url = reverse('core:product_url', args=[slug])
+    shoppers = [dataset.new_shopper() for _ in range(threads)]
+    results = []
+    with override_settings(DEBUG=False):
+        for visitor in visitors:
+            for mode in modes:
+                clients = [Client() for _ in range(threads)]
+                if visitor == 'logged-in':
+                    for client, user in zip(clients, shoppers):
+                        client.force_login(user)
+                get_cache().clear()
+                barrier = threading.Barrier(threads)
+                errors = []
+                latencies = []
+                statuses = {}
+
+                def browse(client):
+                    etag = client.get(url)['ETag']
+                    headers = {'HTTP_IF_NONE_MATCH': etag} if mode == 'revalidated' else {}
+                    try:
+                        barrier.wait()
+                        for _ in range(requests):
+                            if mode == 'uncached':
+                                bump_product_version(slug)
+                            start = time.perf_counter()
+                            response = client.get(url, **headers)
+                            latencies.append(time.perf_counter() - start)
+                            statuses[response.status_code] = (
+                                statuses.get(response.status_code, 0) + 1)
+                    except Exception as e:
+                        errors.append(repr(e))
+                    finally:
+                        connection.close()
+
+                workers = [threading.Thread(target=browse, args=(client,))
+                           for client in clients]
+                start = time.perf_counter()
+                for thread in workers:
+                    thread.start()
+                for thread in workers:
+                    thread.join()
+                elapsed = time.perf_counter() - start
+                latencies.sort()
+                results.append({'visitor': visitor,
+                                'mode': mode,
+                                'requests': len(latencies),
+                                'statuses': statuses,
+                                'errors': len(errors),
+                                'error_sample': errors[:3],
+                                'requests_per_second': round(len(latencies) / elapsed, 1),
+                                'p50_ms': round(latencies[len(latencies) // 2] * 1000, 2)
+                                if latencies else None,
+                                'p95_ms': round(latencies[int(len(latencies) * 0.95)] * 1000, 2)
+                                if latencies else None})
+    return {'generated_at': timezone.now().isoformat(),
+            'database': connection.vendor,
+            'threads': threads,
+            'requests_per_thread': requests,
+            'results': results}
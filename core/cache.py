@@ -0,0 +1,164 @@
+import threading
+import time
+
+from django.conf import settings
+from django.core.cache import InvalidCacheBackendError, caches
+from django.core.cache.backends.locmem import LocMemCache
+from django.db.models import Count
+
+from .instrumentation import record_cache
+
+
+class CacheStats:
+    def __init__(self, name):
+        self.name = name
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    def hit(self):
+        record_cache(True)
+        with self._lock:
+            self.hits += 1
+
+    def miss(self):
+        record_cache(False)
+        with self._lock:
+            self.misses += 1
+
+    def reset(self):
+        with self._lock:
+            self.hits = 0
+            self.misses = 0
+
+    def as_dict(self):
+        lookups = self.hits + self.misses
+        return {'hits': self.hits,
+                'misses': self.misses,
+                'hit_ratio': self.hits / lookups if lookups else 0.0}
+
+
+class TimedCacheStats(CacheStats):
+    """CacheStats for a cache in front of a slow call: misses record how
+    long the call took, and each hit is credited with the average."""
+
+    def __init__(self, name):
+        super().__init__(name)
+        self.miss_seconds = 0.0
+
+    def miss(self, elapsed=0.0):
+        record_cache(False)
+        with self._lock:
+            self.misses += 1
+            self.miss_seconds += elapsed
+
+    def reset(self):
+        with self._lock:
+            self.hits = 0
+            self.misses = 0
+            self.miss_seconds = 0.0
+
+    def as_dict(self):
+        stats = super().as_dict()
+        average = self.miss_seconds / self.misses if self.misses else 0.0
+        stats.update({'avg_miss_ms': round(average * 1000, 3),
+                      'saved_ms': round(self.hits * average * 1000, 3)})
+        return stats
+
+
+cart_stats = CacheStats('cart')
+catalog_stats = CacheStats('catalog')
+card_stats = TimedCacheStats('stripe-card')
+coupon_stats = CacheStats('coupon')
+product_stats = CacheStats('product')
+
+
+_fallback_cache = LocMemCache('core-fallback', {})
+
+
+def get_cache():
+    try:
+        return caches[getattr(settings, 'CACHE_ALIAS', 'default')]
+    except InvalidCacheBackendError:
+        return _fallback_cache
+
+
+def cart_summary_key(user_id):
+    return f'cart-summary:{user_id}'
+
+
+def get_cart_summary(user):
+    """Item count and total of the user's open order, cached per user."""
+    cache = get_cache()
+    key = cart_summary_key(user.pk)
+    summary = cache.get(key)
+    if summary is not None:
+        cart_stats.hit()
+        return summary
+
+    cart_stats.miss()
+    from .models import Order
+    row = (Order.objects.filter(user=user, ordered=False)
+           .annotate(count=Count('items'))
+           .values_list('count', 'total').first())
+    summary = {'count': row[0], 'total': row[1]} if row else {'count': 0, 'total': 0}
+    cache.set(key, summary, getattr(settings, 'CART_CACHE_TIMEOUT', 300))
+    return summary
+
+
+def invalidate_cart_summary(user):
+    get_cache().delete(cart_summary_key(user.pk))
+
+
+CATALOG_VERSION_KEY = 'catalog-version'
+COUPON_VERSION_KEY = 'coupon-version'
+
+
+def get_version(key):
+    cache = get_cache()
+    version = cache.get(key)
+    if version is None:
+        # A fresh stamp, so entries cached under an evicted version never match
+        cache.add(key, time.time_ns(), None)
+        version = cache.get(key)
+    return version
+
+
+def bump_version(key):
+    cache = get_cache()
+    try:
+        cache.incr(key)
+    except ValueError:
+        cache.set(key, time.time_ns(), None)
+
+
+def get_catalog_version():
+    return get_version(CATALOG_VERSION_KEY)
+
+
+def bump_catalog_version():
+    bump_version(CATALOG_VERSION_KEY)
+
+
+def bump_coupon_version():
+    bump_version(COUPON_VERSION_KEY)
+
+
+def coupon_key(code):
+    return f'coupon:{get_version(COUPON_VERSION_KEY)}:{code}'
+
+
+def catalog_page_key(page):
+    return f'catalog:{get_catalog_version()}:page:{page}'
+
+
+def product_page_key(slug):
+    return f'product:{slug}'
+
+
+def product_version_key(slug):
+    return f'product-version:{slug}'
+
+
+def bump_product_version(slug):
+    bump_version(product_version_key(slug))
@@ -0,0 +1,229 @@
+"""Cart mutations shared by the cart views.
+
+Every operation runs in one transaction and takes the user's open Order
+row lock before touching its lines, so concurrent clicks on the same
+cart serialize instead of overwriting each other's quantities, and
+rebuilds the order's totals from its lines before committing. Lines of
+items with tracked stock also hold their units (core/inventory.py). A
+cart with a payment in flight is left alone (PAYMENT_PENDING), so what
+gets ordered is what was charged.
+
+The purge functions at the bottom clear out abandoned carts and lines
+that belong to no order, a batch per short transaction.
+"""
+import time
+
+from django.db import connection, transaction
+from django.db.models import Exists, F, OuterRef
+from django.utils import timezone
+
+from . import inventory, payments
+from .cache import cart_summary_key, get_cache, invalidate_cart_summary
+from .models import Order, OrderItem
+
+ADDED = 'added'
+UPDATED = 'updated'
+REMOVED = 'removed'
+NOT_IN_CART = 'not_in_cart'
+NO_ORDER = 'no_order'
+OUT_OF_STOCK = 'out_of_stock'
+PAYMENT_PENDING = 'payment_pending'
+
+
+def locked_cart(user):
+    return Order.objects.select_for_update().filter(user=user, ordered=False).annotate(
+        payment_in_flight=payments.has_pending_attempt()).first()
+
+
+def open_order_lines(user, item):
+    return OrderItem.objects.filter(
+        user=user, item=item, ordered=False,
+        order__user=user, order__ordered=False)
+
+
+def reserve_line(user, item):
+    """Hold one more unit for the user's line of a tracked item, or the
+    whole line again if its hold has lapsed."""
+    line = open_order_lines(user, item).values_list('quantity', 'reserved_until').first()
+    if line is None:
+        return inventory.reserve(item.pk, 1)
+    quantity, reserved_until = line
+    if reserved_until is not None and reserved_until >= timezone.now():
+        return inventory.reserve(item.pk, 1)
+    if reserved_until is not None:
+        # Ours to give back, before a sweep in reserve() finds it
+        inventory.release(item.pk, quantity)
+        open_order_lines(user, item).update(reserved_until=None)
+    return inventory.reserve(item.pk, quantity + 1)
+
+
+def add_item(user, item):
+    with transaction.atomic():
+        open_orders = Order.objects.filter(user=user, ordered=False)
+        order = None
+        # Written first so it takes the row lock on the open order
+        if not open_orders.exclude(payments.has_pending_attempt()).update(
+                updated_at=timezone.now()):
+            # No cart yet, or one being paid for; the one-open-order
+            # constraint settles racing creators
+            order, created = Order.objects.select_for_update().get_or_create(
+                user=user, ordered=False,
+                defaults={'ordered_date': timezone.now()})
+            if not created:
+                if payments.payment_pending(order.pk):
+                    return PAYMENT_PENDING
+                open_orders.update(updated_at=timezone.now())
+        hold = {}
+        if item.stock is not None:
+            if not reserve_line(user, item):
+                transaction.set_rollback(True)
+                return OUT_OF_STOCK
+            hold['reserved_until'] = inventory.hold_until()
+        if open_order_lines(user, item).update(quantity=F('quantity') + 1, **hold):
+            status = UPDATED
+        else:
+            if order is None:
+                order = open_orders.get()
+            order.items.add(OrderItem.objects.create(user=user, item=item, **hold))
+            status = ADDED
+        open_orders.update(**Order.totals_from_lines())
+    invalidate_cart_summary(user)
+    return status
+
+
+def remove_item(user, item):
+    with transaction.atomic():
+        order = locked_cart(user)
+        if order is None:
+            return NO_ORDER
+        if order.payment_in_flight and payments.payment_pending(order.pk):
+            return PAYMENT_PENDING
+        line = open_order_lines(user, item).first()
+        if line is None:
+            return NOT_IN_CART
+        line.delete()
+        if line.reserved_until is not None:
+            inventory.release(item.pk, line.quantity)
+        order.refresh_totals()
+    invalidate_cart_summary(user)
+    return REMOVED
+
+
+def decrement_item(user, item):
+    with transaction.atomic():
+        order = locked_cart(user)
+        if order is None:
+            return NO_ORDER
+        if order.payment_in_flight and payments.payment_pending(order.pk):
+            return PAYMENT_PENDING
+        line = open_order_lines(user, item).values_list(
+            'pk', 'quantity', 'reserved_until').first()
+        if line is None:
+            return NOT_IN_CART
+        pk, quantity, reserved_until = line
+        if quantity > 1:
+            OrderItem.objects.filter(pk=pk).update(quantity=F('quantity') - 1)
+            status = UPDATED
+        else:
+            OrderItem.objects.filter(pk=pk).delete()
+            status = REMOVED
+        if reserved_until is not None:
+            inventory.release(item.pk, 1)
+        order.refresh_totals()
+    invalidate_cart_summary(user)
+    return status
+
+
+class PurgeStats:
+    def __init__(self, dry_run=False):
+        self.dry_run = dry_run
+        self.carts = 0
+        self.lines = 0
+        self.orphans = 0
+        self.batches = 0
+        self.started = time.perf_counter()
+
+    def as_dict(self):
+        elapsed = time.perf_counter() - self.started
+        rows = self.carts + self.lines + self.orphans
+        return {'dry_run': self.dry_run,
+                'carts': self.carts,
+                'lines': self.lines,
+                'orphans': self.orphans,
+                'batches': self.batches,
+                'seconds': round(elapsed, 3),
+                'rows_per_second': round(rows / elapsed) if elapsed else 0}
+
+
+def abandoned_carts(cutoff):
+    return Order.objects.filter(ordered=False, updated_at__lt=cutoff)
+
+
+def orphaned_lines():
+    in_an_order = Order.items.through.objects.filter(orderitem_id=OuterRef('pk'))
+    return OrderItem.objects.filter(ordered=False).exclude(Exists(in_an_order))
+
+
+def deleted(queryset):
+    """Delete ``queryset``, returning how many of its own rows went."""
+    return queryset.delete()[1].get(queryset.model._meta.label, 0)
+
+
+def lock_batch(queryset):
+    if connection.features.has_select_for_update_skip_locked:
+        # A cart someone is adding to right now is left for the next run
+        queryset = queryset.select_for_update(skip_locked=True)
+    return queryset
+
+
+def purge_abandoned_carts(cutoff, batch_size=500, pause=0, stats=None):
+    """Delete open orders untouched since ``cutoff`` along with their lines."""
+    stats = stats or PurgeStats()
+    if stats.dry_run:
+        carts = abandoned_carts(cutoff)
+        stats.carts += carts.count()
+        stats.lines += OrderItem.objects.filter(order__in=carts).count()
+        return stats
+    # Their holds lapsed long ago; hand them back before the lines go
+    inventory.release_expired(batch_size=batch_size)
+    last_pk = 0
+    while True:
+        with transaction.atomic():
+            batch = list(lock_batch(abandoned_carts(cutoff))
+                         .filter(pk__gt=last_pk).order_by('pk')
+                         .values_list('pk', 'user_id')[:batch_size])
+            if not batch:
+                break
+            order_ids = [pk for pk, _ in batch]
+            last_pk = order_ids[-1]
+            # Lines first, so their links go with them and not row by row
+            # when the orders are collected
+            stats.lines += deleted(OrderItem.objects.filter(
+                order__in=order_ids, ordered=False))
+            stats.carts += deleted(Order.objects.filter(pk__in=order_ids))
+        get_cache().delete_many([cart_summary_key(user_id) for _, user_id in batch])
+        stats.batches += 1
+        if pause:
+            time.sleep(pause)
+    return stats
+
+
+def purge_orphaned_lines(batch_size=500, pause=0, stats=None):
+    """Delete open OrderItems that are in no order, left by older cart code."""
+    stats = stats or PurgeStats()
+    if stats.dry_run:
+        stats.orphans += orphaned_lines().count()
+        return stats
+    last_pk = 0
+    while True:
+        with transaction.atomic():
+            line_ids = list(orphaned_lines().filter(pk__gt=last_pk).order_by('pk')
+                            .values_list('pk', flat=True)[:batch_size])
+            if not line_ids:
+                break
+            last_pk = line_ids[-1]
+            stats.orphans += deleted(OrderItem.objects.filter(pk__in=line_ids))
+        stats.batches += 1
+        if pause:
+            time.sleep(pause)
+    return stats
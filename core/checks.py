@@ -0,0 +1,30 @@
+"""System checks for settings the app depends on.
+
+Run with ``manage.py check --deploy`` before a release.
+"""
+from django.conf import settings
+from django.core.checks import Error
+
+LOCMEM_BACKEND = 'django.core.cache.backends.locmem.LocMemCache'
+
+# What core/cache.py keeps in the shared cache, expired by version bumps
+CACHED_FOR = ('CART_CACHE_TIMEOUT', 'CATALOG_CACHE_TIMEOUT', 'PRODUCT_CACHE_TIMEOUT',
+              'COUPON_CACHE_TIMEOUT')
+
+
+def check_shared_cache(app_configs, **kwargs):
+    """Cached pages, coupons and the search index are expired by bumping
+    version keys; a per-process locmem cache only sees its own bumps."""
+    if settings.DEBUG:
+        return []
+    alias = getattr(settings, 'CACHE_ALIAS', 'default')
+    # core.cache.get_cache falls back to locmem for an unknown alias
+    backend = settings.CACHES.get(alias, {}).get('BACKEND', LOCMEM_BACKEND)
+    cached = [name for name in CACHED_FOR if getattr(settings, name, 0)]
+    if backend != LOCMEM_BACKEND or not cached:
+        return []
+    return [Error(
+        f'The {alias!r} cache is a per-process LocMemCache, but '
+        f'{", ".join(cached)} keep entries that other workers must see expire.',
+        hint='Point CACHE_BACKEND and CACHE_LOCATION at memcached or redis.',
+        id='core.E001')]
@@ -0,0 +1,92 @@
+"""Coupon lookup, validation and redemption.
+
+Codes are looked up through the cache, misses included, under a version
+stamp that every Coupon save or delete bumps. Checking whether a code
+exists and is currently valid therefore costs no queries, however hard
+a promotion is hit. Only applying a coupon touches the database: one
+conditional UPDATE claims a use against the global cap and takes the
+coupon's row lock, which also serializes the per-user check behind it.
+"""
+from django.conf import settings
+from django.db import transaction
+from django.db.models import F, Q
+from django.utils import timezone
+
+from . import payments
+from .cache import coupon_key, coupon_stats, get_cache, invalidate_cart_summary
+from .models import Coupon, CouponRedemption, Order
+
+# Cached for codes that do not exist, since cache.get() returns None
+MISSING = 0
+
+
+class CouponError(Exception):
+    pass
+
+
+def lookup(code):
+    """The Coupon for ``code`` or None, from the cache when possible."""
+    code = code.strip()
+    cache = get_cache()
+    key = coupon_key(code)
+    coupon = cache.get(key)
+    if coupon is not None:
+        coupon_stats.hit()
+        return coupon or None
+    coupon_stats.miss()
+    coupon = Coupon.objects.filter(code=code).first()
+    cache.set(key, coupon or MISSING, settings.COUPON_CACHE_TIMEOUT)
+    return coupon
+
+
+def validate(code, now=None):
+    coupon = lookup(code)
+    if coupon is None:
+        raise CouponError('This code does not exist')
+    now = now or timezone.now()
+    if not coupon.active or (coupon.valid_until and coupon.valid_until <= now):
+        raise CouponError('This coupon has expired')
+    if coupon.valid_from and now < coupon.valid_from:
+        raise CouponError('This coupon is not valid yet')
+    if coupon.max_uses is not None and coupon.times_used >= coupon.max_uses:
+        # Only a hint, the count is as old as the cache entry; apply()
+        # enforces the cap for real
+        raise CouponError('This coupon has been used up')
+    return coupon
+
+
+def apply(user, code):
+    """Put the coupon for ``code`` on the user's cart.
+
+    Raises CouponError when the code cannot be used, and
+    Order.DoesNotExist when there is no cart to put it on.
+    """
+    coupon = validate(code)
+    with transaction.atomic():
+        # The claim comes first: it is the write that takes the lock, and
+        # the caps are read from the row rather than from the cache
+        claimed = Coupon.objects.filter(
+            Q(max_uses__isnull=True) | Q(times_used__lt=F('max_uses')),
+            pk=coupon.pk, active=True,
+        ).update(times_used=F('times_used') + 1)
+        order = Order.objects.select_for_update().annotate(
+            payment_in_flight=payments.has_pending_attempt()).get(user=user, ordered=False)
+        if order.payment_in_flight and payments.payment_pending(order.pk):
+            raise CouponError('Your payment is being processed')
+        if not claimed and order.coupon_id != coupon.pk:
+            raise CouponError('This coupon has been used up')
+        if order.coupon_id == coupon.pk:
+            # Already on this cart; the use claimed above is given back
+            transaction.set_rollback(True)
+            return order
+        if coupon.max_uses_per_user is not None:
+            used = CouponRedemption.objects.filter(coupon=coupon.pk, user=user).count()
+            if used >= coupon.max_uses_per_user:
+                raise CouponError('You have already used this coupon')
+        if order.coupon_id is not None:
+            # Swapping coupons frees the old one's use
+            CouponRedemption.objects.filter(order=order).delete()
+        CouponRedemption.objects.create(coupon=coupon, user=user, order=order)
+        order.set_coupon(coupon)
+    invalidate_cart_summary(user)
+    return order
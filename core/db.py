@@ -0,0 +1,85 @@
+"""Database connection setup and read-replica routing.
+
+``configure_sqlite`` runs SQLITE_PRAGMAS on every new SQLite connection.
+WAL lets the catalog be read while a checkout writes, and busy_timeout
+makes a writer wait for the lock instead of failing with "database is
+locked".
+
+ReplicaRouter sends reads of REPLICA_READ_MODELS to one of
+DATABASE_REPLICAS, but only inside ``replica_reads()``, which
+ReplicaReadsMixin enters for GETs of the catalog views. Everything else
+goes to 'default': a cart or payment request, and any code with no reason
+to expect stale rows, never reads from a replica that may be behind it.
+Without DATABASE_REPLICAS the router never picks a database.
+"""
+import contextvars
+import random
+from contextlib import contextmanager
+
+from django.conf import settings
+
+_replica_reads = contextvars.ContextVar('core_replica_reads', default=False)
+
+
+def configure_sqlite(sender, connection, **kwargs):
+    """connection_created receiver."""
+    if connection.vendor != 'sqlite':
+        return
+    with connection.cursor() as cursor:
+        for name, value in settings.SQLITE_PRAGMAS.items():
+            cursor.execute(f'PRAGMA {name} = {value}')
+
+
+@contextmanager
+def replica_reads():
+    token = _replica_reads.set(True)
+    try:
+        yield
+    finally:
+        _replica_reads.reset(token)
+
+
+def fill_timeout(timeout):
+    """The timeout for a cache entry built from what was just read. A
+    replica may be behind the write that expired the old entry, so what
+    it returned is only kept for REPLICA_CACHE_TIMEOUT."""
+    if _replica_reads.get() and settings.DATABASE_REPLICAS:
+        return min(timeout, settings.REPLICA_CACHE_TIMEOUT)
+    return timeout
+
+
+def choose_replica():
+    return random.choice(settings.DATABASE_REPLICAS)
+
+
+class ReplicaRouter:
+    def db_for_read(self, model, **hints):
+        if (_replica_reads.get() and settings.DATABASE_REPLICAS
+                and model._meta.label_lower in settings.REPLICA_READ_MODELS):
+            return choose_replica()
+        return None
+
+    def db_for_write(self, model, **hints):
+        return 'default'
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # Replicas hold the same rows as the primary
+        return True
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        return db not in settings.DATABASE_REPLICAS
+
+
+class ReplicaReadsMixin:
+    """For views that only show the catalog. A GET is handled, template
+    included, inside ``replica_reads()``."""
+
+    def dispatch(self, request, *args, **kwargs):
+        if request.method not in ('GET', 'HEAD'):
+            return super().dispatch(request, *args, **kwargs)
+        with replica_reads():
+            response = super().dispatch(request, *args, **kwargs)
+            # A TemplateResponse would otherwise render after we return
+            if hasattr(response, 'render') and not response.is_rendered:
+                response.render()
+        return response
@@ -1,6 +1,7 @@
 from django import forms
 from django_countries.fields import CountryField
 from django_countries.widgets import CountrySelectWidget
+from .models import Item
 
 PAYMENT_CHOICES = (
     ('S','Stripe'),
@@ -51,4 +52,15 @@ class RefundForm(forms.Form):
 class PaymentForm(forms.Form):
     stripeToken = forms.CharField(required=False)
     save = forms.BooleanField(required=False)
-    use_default = forms.BooleanField(required=False)
\ No newline at end of file
+    use_default = forms.BooleanField(required=False)
+
+
+class SearchForm(forms.Form):
+    q = forms.CharField(required=False, max_length=100)
+    category = forms.ChoiceField(required=False,
+                                 choices=[('', 'All')] + Item.CATEGORY_CHOICES)
+    label = forms.ChoiceField(required=False,
+                              choices=[('', 'All')] + Item.LABEL_CHOICES)
+    min_price = forms.DecimalField(required=False, min_value=0, decimal_places=2)
+    max_price = forms.DecimalField(required=False, min_value=0, decimal_places=2)
+    page = forms.IntegerField(required=False, min_value=1)
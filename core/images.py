@@ -0,0 +1,147 @@
+"""Resized and WebP copies of Item.image for responsive catalog pages.
+
+Saving an Item with a new image queues ``make_derivatives`` on the
+background workers (core/tasks.py) once the save commits, so the admin
+request never waits on Pillow. Each width in IMAGE_DERIVATIVE_WIDTHS is
+written as WebP and in the original's own family (JPEG, or PNG for
+images with transparency). The file names carry a hash of their content,
+so they can be served with a far-future Cache-Control and never go
+stale. The names are kept on ``Item.image_derivatives``, and the
+``image_tags`` template tags build srcset attributes from them without
+touching storage.
+"""
+import hashlib
+import io
+import logging
+import os
+
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.db import transaction
+from django.utils import timezone
+from PIL import Image
+
+from . import tasks
+from .cache import bump_catalog_version
+from .models import Item
+
+logger = logging.getLogger(__name__)
+
+WEBP = 'webp'
+FALLBACK_FORMATS = {'JPEG': 'jpeg', 'PNG': 'png'}
+SAVE_OPTIONS = {'webp': {'format': 'WEBP', 'quality': 80, 'method': 4},
+                'jpeg': {'format': 'JPEG', 'quality': 82, 'optimize': True,
+                         'progressive': True},
+                'png': {'format': 'PNG', 'optimize': True}}
+
+
+def has_alpha(image):
+    return image.mode in ('RGBA', 'LA') or (
+        image.mode == 'P' and 'transparency' in image.info)
+
+
+def encode(image, format):
+    if format == 'jpeg' and image.mode != 'RGB':
+        image = image.convert('RGB')
+    buffer = io.BytesIO()
+    image.save(buffer, **SAVE_OPTIONS[format])
+    return buffer.getvalue()
+
+
+def derivative_name(source, width, format, content):
+    stem = os.path.splitext(os.path.basename(source))[0]
+    digest = hashlib.sha256(content).hexdigest()[:12]
+    return f'{settings.IMAGE_DERIVATIVE_DIR}/{stem}-{width}w.{digest}.{format}'
+
+
+def save(name, content):
+    # Same name, same bytes: a rerun finds the file already there
+    if not default_storage.exists(name):
+        default_storage.save(name, ContentFile(content))
+    return name
+
+
+def render_derivatives(source):
+    """``{format: {width: name}}`` for the image stored at ``source``."""
+    with default_storage.open(source) as f:
+        original = Image.open(f)
+        original.load()
+    fallback = 'png' if has_alpha(original) else FALLBACK_FORMATS.get(
+        original.format, 'jpeg')
+    if original.mode not in ('RGB', 'RGBA'):
+        original = original.convert('RGBA' if has_alpha(original) else 'RGB')
+    # Never scaled up: widths past the original collapse into its own
+    widths = sorted({min(width, original.width)
+                     for width in settings.IMAGE_DERIVATIVE_WIDTHS})
+    derivatives = {WEBP: {}, fallback: {}}
+    for width in widths:
+        height = max(round(original.height * width / original.width), 1)
+        resized = original.resize((width, height), Image.LANCZOS)
+        for format in derivatives:
+            content = encode(resized, format)
+            derivatives[format][str(width)] = save(
+                derivative_name(source, width, format, content), content)
+    return derivatives
+
+
+def make_derivatives(item_id):
+    """Build the derivatives of an item's current image; safe to rerun."""
+    source = Item.objects.filter(pk=item_id).values_list('image', flat=True).first()
+    if not source:
+        return None
+    try:
+        derivatives = {'source': source, **render_derivatives(source)}
+    except OSError as e:
+        # Missing or not an image; the page keeps showing the original
+        logger.warning('No derivatives for %s: %s', source, e)
+        return None
+    # Only if the image was not replaced while these were being made
+    if Item.objects.filter(pk=item_id, image=source).update(
+            image_derivatives=derivatives, updated_at=timezone.now()):
+        # update() skips the signal that expires cached catalog pages
+        bump_catalog_version()
+    return derivatives
+
+
+def queue_derivatives(item):
+    if item.image and item.image_derivatives.get('source') != item.image.name:
+        transaction.on_commit(lambda: tasks.enqueue(make_derivatives, item.pk))
+
+
+def derivatives_for(item):
+    """The item's derivatives, or {} while its current image has none."""
+    derivatives = item.image_derivatives or {}
+    if not item.image or derivatives.get('source') != item.image.name:
+        return {}
+    return derivatives
+
+
+def fallback_format(derivatives):
+    return next((format for format in derivatives
+                 if format not in ('source', WEBP)), None)
+
+
+def srcset(item, format=WEBP):
+    """``url 320w, url 640w, ...`` for ``item``, or '' without derivatives."""
+    derivatives = derivatives_for(item)
+    if format != WEBP:
+        format = fallback_format(derivatives)
+    names = derivatives.get(format)
+    if not names:
+        return ''
+    return ', '.join(f'{default_storage.url(name)} {width}w'
+                     for width, name in sorted(names.items(), key=lambda n: int(n[0])))
+
+
+def fallback_url(item):
+    """For browsers without srcset: the smallest fallback derivative at
+    least IMAGE_FALLBACK_WIDTH wide, else the original."""
+    derivatives = derivatives_for(item)
+    names = derivatives.get(fallback_format(derivatives))
+    if not names:
+        return item.image.url
+    widths = sorted(int(width) for width in names)
+    width = next((width for width in widths if width >= settings.IMAGE_FALLBACK_WIDTH),
+                 widths[-1])
+    return default_storage.url(names[str(width)])
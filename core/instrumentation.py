@@ -0,0 +1,328 @@
+"""Per-request timings for production, where debug_toolbar is not loaded.
+
+RequestMetricsMiddleware sits first in MIDDLEWARE. For every request it
+counts and times the database queries (through an execute wrapper put on
+each connection as it opens), the template rendering (through the
+DjangoTemplates backend below), the cache lookups that report to a
+core.cache.CacheStats and the time spent waiting on Stripe
+(``external``). The totals go out with the response as a Server-Timing
+header, and are added to per-view counters that ``metrics`` serves in the
+Prometheus text format. Requests slower than SLOW_REQUEST_SECONDS are
+kept, with their SQL, in a ring buffer of the last SLOW_REQUEST_BUFFER
+that ``slow_request_log`` returns as JSON.
+
+SQL is recorded without its parameters, so no customer data ends up in
+the buffer. Both endpoints are routed only when METRICS_ENABLED, and
+answer only staff users and requests bearing METRICS_TOKEN. Nothing here queries the database or the cache; the cost is
+a few dict updates per request (see benchmark_instrumentation).
+"""
+import bisect
+import contextvars
+import hmac
+import threading
+import time
+from collections import defaultdict, deque
+
+from django.conf import settings
+from django.http import HttpResponse, HttpResponseForbidden, JsonResponse
+from django.template.backends import django as django_backend
+from django.template.exceptions import TemplateDoesNotExist
+from django.utils import timezone
+
+# Upper bounds of the request duration histogram, in seconds
+DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+_current = contextvars.ContextVar('core_request_metrics', default=None)
+
+
+class RequestMetrics:
+    __slots__ = ('start', 'queries', 'db_seconds', 'sql', 'template_seconds',
+                 'template_depth', 'cache_hits', 'cache_misses', 'external')
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.queries = 0
+        self.db_seconds = 0.0
+        self.sql = []
+        self.template_seconds = 0.0
+        self.template_depth = 0
+        self.cache_hits = 0
+        self.cache_misses = 0
+        self.external = {}
+
+    def record_query(self, sql, elapsed):
+        self.queries += 1
+        self.db_seconds += elapsed
+        if len(self.sql) < settings.SLOW_REQUEST_MAX_QUERIES:
+            self.sql.append((sql, elapsed))
+
+    def server_timing(self, total):
+        timings = [f'total;dur={total * 1000:.1f}',
+                   f'db;dur={self.db_seconds * 1000:.1f};desc="{self.queries} queries"',
+                   f'tpl;dur={self.template_seconds * 1000:.1f}']
+        if self.cache_hits or self.cache_misses:
+            timings.append(f'cache;desc="hits={self.cache_hits} misses={self.cache_misses}"')
+        for service, seconds in self.external.items():
+            timings.append(f'{service};dur={seconds * 1000:.1f}')
+        return ', '.join(timings)
+
+    def as_dict(self, request, response, view, total):
+        return {'at': timezone.now().isoformat(),
+                'method': request.method,
+                'path': request.path,
+                'view': view,
+                'status': response.status_code,
+                'total_ms': round(total * 1000, 3),
+                'db_ms': round(self.db_seconds * 1000, 3),
+                'queries': self.queries,
+                'template_ms': round(self.template_seconds * 1000, 3),
+                'external_ms': {service: round(seconds * 1000, 3)
+                                for service, seconds in self.external.items()},
+                'cache': {'hits': self.cache_hits, 'misses': self.cache_misses},
+                'sql': [{'sql': sql, 'ms': round(elapsed * 1000, 3)}
+                        for sql, elapsed in self.sql],
+                'sql_truncated': self.queries > len(self.sql)}
+
+
+def current():
+    """The metrics of the request being handled, or None outside of one."""
+    return _current.get()
+
+
+def record_query(execute, sql, params, many, context):
+    metrics = _current.get()
+    if metrics is None:
+        return execute(sql, params, many, context)
+    start = time.perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        metrics.record_query(sql, time.perf_counter() - start)
+
+
+def install_query_wrapper(sender, connection, **kwargs):
+    """connection_created receiver. The wrapper stays on the connection for
+    good, which is cheaper than adding it for each request; outside of one
+    it only looks up the context variable."""
+    if record_query not in connection.execute_wrappers:
+        connection.execute_wrappers.append(record_query)
+
+
+def record_cache(hit):
+    metrics = _current.get()
+    if metrics is not None:
+        if hit:
+            metrics.cache_hits += 1
+        else:
+            metrics.cache_misses += 1
+
+
+class external:
+    """Times a call to an outside service, as a context manager:
+
+        with instrumentation.external('stripe'):
+            stripe.Charge.create(...)
+    """
+
+    def __init__(self, service):
+        self.service = service
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        elapsed = time.perf_counter() - self.start
+        registry.observe_external(self.service, elapsed)
+        metrics = _current.get()
+        if metrics is not None:
+            metrics.external[self.service] = metrics.external.get(self.service, 0.0) + elapsed
+
+
+class Template(django_backend.Template):
+    def render(self, context=None, request=None):
+        metrics = _current.get()
+        # Only the outermost render; includes run inside it
+        if metrics is None or metrics.template_depth:
+            return super().render(context, request)
+        metrics.template_depth += 1
+        start = time.perf_counter()
+        try:
+            return super().render(context, request)
+        finally:
+            metrics.template_depth -= 1
+            metrics.template_seconds += time.perf_counter() - start
+
+
+class DjangoTemplates(django_backend.DjangoTemplates):
+    """The stock backend, with its templates timed by the middleware."""
+
+    def from_string(self, template_code):
+        return Template(self.engine.from_string(template_code), self)
+
+    def get_template(self, template_name):
+        try:
+            return Template(self.engine.get_template(template_name), self)
+        except TemplateDoesNotExist as exc:
+            django_backend.reraise(exc, self)
+
+
+class ViewStats:
+    __slots__ = ('requests', 'seconds', 'buckets', 'queries', 'db_seconds',
+                 'template_seconds')
+
+    def __init__(self):
+        self.requests = 0
+        self.seconds = 0.0
+        self.buckets = [0] * len(DURATION_BUCKETS)
+        self.queries = 0
+        self.db_seconds = 0.0
+        self.template_seconds = 0.0
+
+
+class Registry:
+    """Counters since the process started, for ``metrics``."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.views = defaultdict(ViewStats)
+            self.responses = defaultdict(int)
+            self.external = defaultdict(lambda: [0, 0.0])
+            self.slow = 0
+        slow_requests.clear()
+
+    def observe(self, view, method, status, metrics, total, slow):
+        with self._lock:
+            stats = self.views[view]
+            stats.requests += 1
+            stats.seconds += total
+            # Cumulative buckets are summed when rendered
+            index = bisect.bisect_left(DURATION_BUCKETS, total)
+            if index < len(DURATION_BUCKETS):
+                stats.buckets[index] += 1
+            stats.queries += metrics.queries
+            stats.db_seconds += metrics.db_seconds
+            stats.template_seconds += metrics.template_seconds
+            self.responses[view, method, status] += 1
+            self.slow += slow
+
+    def observe_external(self, service, elapsed):
+        with self._lock:
+            calls = self.external[service]
+            calls[0] += 1
+            calls[1] += elapsed
+
+    def render(self):
+        from .cache import card_stats, cart_stats, catalog_stats, coupon_stats, product_stats
+
+        with self._lock:
+            views = sorted(self.views.items())
+            responses = sorted(self.responses.items())
+            external = sorted((service, list(calls)) for service, calls in self.external.items())
+            slow = self.slow
+        lines = []
+
+        def metric(name, kind, help, samples):
+            lines.append(f'# HELP {name} {help}')
+            lines.append(f'# TYPE {name} {kind}')
+            for labels, value in samples:
+                if labels:
+                    labels = ','.join(f'{key}="{escape(label)}"' for key, label in labels)
+                    lines.append(f'{name}{{{labels}}} {value}')
+                else:
+                    lines.append(f'{name} {value}')
+
+        metric('core_requests_total', 'counter', 'Responses by view, method and status.',
+               [((('view', view), ('method', method), ('status', status)), count)
+                for (view, method, status), count in responses])
+        name = 'core_request_duration_seconds'
+        lines.append(f'# HELP {name} Wall time of the middleware chain and view.')
+        lines.append(f'# TYPE {name} histogram')
+        for view, stats in views:
+            view = escape(view)
+            cumulative = 0
+            for bound, count in zip(DURATION_BUCKETS, stats.buckets):
+                cumulative += count
+                lines.append(f'{name}_bucket{{view="{view}",le="{bound}"}} {cumulative}')
+            lines.append(f'{name}_bucket{{view="{view}",le="+Inf"}} {stats.requests}')
+            lines.append(f'{name}_sum{{view="{view}"}} {stats.seconds}')
+            lines.append(f'{name}_count{{view="{view}"}} {stats.requests}')
+        metric('core_db_queries_total', 'counter', 'Database queries run by each view.',
+               [((('view', view),), stats.queries) for view, stats in views])
+        metric('core_db_seconds_total', 'counter', 'Time spent in database queries.',
+               [((('view', view),), stats.db_seconds) for view, stats in views])
+        metric('core_template_seconds_total', 'counter', 'Time spent rendering templates.',
+               [((('view', view),), stats.template_seconds) for view, stats in views])
+        metric('core_external_calls_total', 'counter', 'Calls to outside services.',
+               [((('service', service),), calls) for service, (calls, _) in external])
+        metric('core_external_seconds_total', 'counter', 'Time spent waiting on them.',
+               [((('service', service),), seconds) for service, (_, seconds) in external])
+        stats = [cart_stats, catalog_stats, card_stats, coupon_stats, product_stats]
+        metric('core_cache_hits_total', 'counter', 'Cache hits by cache.',
+               [((('cache', s.name),), s.hits) for s in stats])
+        metric('core_cache_misses_total', 'counter', 'Cache misses by cache.',
+               [((('cache', s.name),), s.misses) for s in stats])
+        metric('core_slow_requests_total', 'counter',
+               'Requests slower than SLOW_REQUEST_SECONDS.', [((), slow)])
+        return '\n'.join(lines) + '\n'
+
+
+def escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+slow_requests = deque(maxlen=settings.SLOW_REQUEST_BUFFER)
+registry = Registry()
+
+
+class RequestMetricsMiddleware:
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        metrics = RequestMetrics()
+        token = _current.set(metrics)
+        try:
+            response = self.get_response(request)
+        finally:
+            # Queries a streamed response runs as it is consumed come after
+            # this, and are not counted
+            _current.reset(token)
+        total = time.perf_counter() - metrics.start
+        match = request.resolver_match
+        view = match.view_name if match else 'unresolved'
+        slow = total >= settings.SLOW_REQUEST_SECONDS
+        registry.observe(view, request.method, response.status_code, metrics, total, slow)
+        if slow:
+            slow_requests.append(metrics.as_dict(request, response, view, total))
+        if settings.SERVER_TIMING_HEADER:
+            response['Server-Timing'] = metrics.server_timing(total)
+        return response
+
+
+def allowed(request):
+    if request.user.is_staff:
+        return True
+    if not settings.METRICS_TOKEN:
+        return False
+    scheme, _, token = request.META.get('HTTP_AUTHORIZATION', '').partition(' ')
+    return (scheme.lower() == 'bearer'
+            and hmac.compare_digest(token.encode(), settings.METRICS_TOKEN.encode()))
+
+
+def metrics(request):
+    if not allowed(request):
+        return HttpResponseForbidden()
+    return HttpResponse(registry.render(), content_type='text/plain; version=0.0.4')
+
+
+def slow_request_log(request):
+    if not allowed(request):
+        return HttpResponseForbidden()
+    # Newest first
+    return JsonResponse({'threshold_seconds': settings.SLOW_REQUEST_SECONDS,
+                         'requests': list(reversed(slow_requests))})
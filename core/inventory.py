@@ -0,0 +1,116 @@
+"""Stock levels, cart reservations and the purchase-time decrement.
+
+An Item with ``stock`` set is tracked; blank means unlimited. Putting one
+in a cart holds a unit for STOCK_RESERVATION_MINUTES: a conditional
+UPDATE bumps the item's ``reserved`` count only while ``stock - reserved``
+covers it, and the cart line records until when it holds its units.
+
+Holds are soft. Lapsed ones are handed back by ``release_expired``, and
+checkout takes stock with ``UPDATE ... WHERE stock >= n`` whether the line
+still holds or not, so what decides a sale is the stock that is
+physically left. ``claim`` commits before the charge is made and
+``restock`` puts back exactly what it took if the charge fails, so no
+lock is held while Stripe is called.
+"""
+from collections import Counter
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import connection, transaction
+from django.db.models import F, Value
+from django.db.models.functions import Greatest
+from django.utils import timezone
+
+from .models import Item, Order, OrderItem
+
+
+class OutOfStock(Exception):
+    def __init__(self, title):
+        super().__init__(f'Sorry, {title} is sold out')
+        self.title = title
+
+
+def hold_until():
+    return timezone.now() + timedelta(minutes=settings.STOCK_RESERVATION_MINUTES)
+
+
+def reserve(item_id, quantity):
+    """Hold ``quantity`` units of a tracked item; False if too few are left."""
+    available = Item.objects.filter(pk=item_id, stock__gte=F('reserved') + quantity)
+    if available.update(reserved=F('reserved') + quantity):
+        return True
+    # Lapsed holds may still be counted; only worth sweeping when short
+    return bool(release_expired(item_id)) and bool(
+        available.update(reserved=F('reserved') + quantity))
+
+
+def release(item_id, quantity):
+    Item.objects.filter(pk=item_id).update(
+        reserved=Greatest(F('reserved') - quantity, Value(0)))
+
+
+def release_expired(item_id=None, batch_size=500):
+    """Hand back the units of lapsed holds, returning how many."""
+    expired = OrderItem.objects.filter(ordered=False, reserved_until__lt=timezone.now())
+    if item_id is not None:
+        expired = expired.filter(item=item_id)
+    carts = Order.objects.select_for_update(
+        # A cart someone is changing right now is left for the next sweep
+        skip_locked=connection.features.has_select_for_update_skip_locked)
+    released = 0
+    while True:
+        with transaction.atomic():
+            # Cart changes lock the order before its lines, and so do we
+            order_ids = list(carts.filter(pk__in=expired.values('order'))
+                             .order_by('pk').values_list('pk', flat=True)[:batch_size])
+            if not order_ids:
+                break
+            lines = expired.filter(order__in=order_ids)
+            freed = Counter()
+            for item, quantity in lines.values_list('item_id', 'quantity'):
+                freed[item] += quantity
+            lines.update(reserved_until=None)
+            for item, quantity in sorted(freed.items()):
+                release(item, quantity)
+        released += sum(freed.values())
+    return released
+
+
+def tracked_lines(order_id):
+    return OrderItem.objects.filter(order=order_id, item__stock__isnull=False)
+
+
+def claim(order):
+    """Take the order's tracked units out of stock, all of them or none.
+
+    Returns the ``[item_id, quantity]`` pairs taken, for ``restock``.
+    Raises OutOfStock naming the first item that has run short.
+    """
+    if not tracked_lines(order.pk).exists():
+        return []
+    with transaction.atomic():
+        # Written first so it takes the cart's lock before the lines are read
+        Order.objects.filter(pk=order.pk).update(updated_at=timezone.now())
+        # In item order, so two checkouts cannot deadlock on each other's rows
+        lines = list(tracked_lines(order.pk).order_by('item_id').values_list(
+            'item_id', 'item__title', 'quantity', 'reserved_until'))
+        for item_id, title, quantity, reserved_until in lines:
+            held = quantity if reserved_until is not None else 0
+            if not Item.objects.filter(pk=item_id, stock__gte=quantity).update(
+                    stock=F('stock') - quantity,
+                    reserved=Greatest(F('reserved') - held, Value(0))):
+                raise OutOfStock(title)
+        if any(reserved_until is not None for *_, reserved_until in lines):
+            tracked_lines(order.pk).update(reserved_until=None)
+    return [[item_id, quantity] for item_id, _, quantity, _ in lines]
+
+
+def restock(claimed):
+    """Put back what ``claim`` returned, for an order whose charge failed.
+
+    Not what the order's lines say now: units added to the cart after
+    the claim were never taken.
+    """
+    with transaction.atomic():
+        for item_id, quantity in sorted(claimed):
+            Item.objects.filter(pk=item_id).update(stock=F('stock') + quantity)
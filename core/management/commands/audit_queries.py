@@ -0,0 +1,37 @@
+from django.core.management.base import CommandError
+
+from core.benchmarks import ROUTES, BenchmarkCommand, Dataset, audit_routes
+
+
+class Command(BenchmarkCommand):
+    help = ('Seeds a throwaway test database and reports, for every route in '
+            'core.urls, its queries grouped by fingerprint: N+1s with the '
+            'code and template lines behind them, duplicates and slow queries')
+
+    def add_arguments(self, parser):
+        parser.add_argument('routes', nargs='*', metavar='route',
+                            help='only audit these routes: %s' %
+                            ', '.join(route.name for route in ROUTES))
+        parser.add_argument('--items', type=int, default=200)
+        parser.add_argument('--cart-size', type=int, default=20)
+        parser.add_argument('--history-users', type=int, default=5)
+        parser.add_argument('--orders-per-user', type=int, default=10)
+        parser.add_argument('--strict', action='store_true',
+                            help='exit with an error if any route has an N+1 '
+                            'or is over its query budget')
+        super().add_arguments(parser)
+
+    def run(self, **options):
+        dataset = Dataset(items=options['items'],
+                          cart_size=options['cart_size'],
+                          history_users=options['history_users'],
+                          orders_per_user=options['orders_per_user'])
+        return audit_routes(dataset, options['routes'])
+
+    def handle(self, *args, **options):
+        with self.database():
+            report = self.run(**options)
+        self.write_report(report, options['output'])
+
+        if options['strict'] and report['problems']:
+            raise CommandError('Query audit problems:\n' + '\n'.join(report['problems']))
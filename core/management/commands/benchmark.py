@@ -0,0 +1,48 @@
+import json
+
+from django.core.management.base import CommandError
+from core.benchmarks import (ROUTES, BenchmarkCommand, Dataset, find_regressions,
+                             run_benchmarks)
+
+
+class Command(BenchmarkCommand):
+    help = ('Seeds a throwaway test database and records query count, wall '
+            'time and peak memory for every route in core.urls as JSON')
+
+    def add_arguments(self, parser):
+        parser.add_argument('routes', nargs='*', metavar='route',
+                            help='only run these routes: %s' %
+                            ', '.join(route.name for route in ROUTES))
+        parser.add_argument('--items', type=int, default=2000)
+        parser.add_argument('--cart-size', type=int, default=50)
+        parser.add_argument('--history-users', type=int, default=20)
+        parser.add_argument('--orders-per-user', type=int, default=10)
+        parser.add_argument('--repeat', type=int, default=5)
+        super().add_arguments(parser)
+        parser.add_argument('--baseline', help='previous JSON report to '
+                            'compare wall time and peak memory against')
+        parser.add_argument('--tolerance', type=float, default=0.5,
+                            help='allowed relative slowdown vs the baseline')
+
+    def run(self, **options):
+        dataset = Dataset(items=options['items'],
+                          cart_size=options['cart_size'],
+                          history_users=options['history_users'],
+                          orders_per_user=options['orders_per_user'])
+        return run_benchmarks(dataset, options['routes'], options['repeat'])
+
+    def handle(self, *args, **options):
+        with self.database():
+            report = self.run(**options)
+
+        baseline = None
+        if options['baseline']:
+            with open(options['baseline']) as f:
+                baseline = json.load(f)
+        report['regressions'] = find_regressions(
+            report, baseline, options['tolerance'])
+        self.write_report(report, options['output'])
+
+        if report['regressions']:
+            raise CommandError('Benchmark regressions:\n' +
+                               '\n'.join(report['regressions']))
@@ -0,0 +1,15 @@
+from core.benchmarks import BenchmarkCommand, benchmark_admin
+
+
+class Command(BenchmarkCommand):
+    help = ('Times the order changelist in the admin at increasing table '
+            'sizes and reports the queries each page took')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--sizes', type=int, nargs='+',
+                            default=[1000, 10000, 100000])
+        parser.add_argument('--repeat', type=int, default=5)
+        super().add_arguments(parser)
+
+    def run(self, **options):
+        return benchmark_admin(options['sizes'], options['repeat'])
@@ -0,0 +1,15 @@
+from core.benchmarks import BenchmarkCommand, benchmark_api
+
+
+class Command(BenchmarkCommand):
+    help = ('Compares payload size and latency of the JSON API with the '
+            'HTML pages for the catalog, a product and a cart')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--items', type=int, default=2000)
+        parser.add_argument('--cart-size', type=int, default=20)
+        parser.add_argument('--repeat', type=int, default=5)
+        super().add_arguments(parser)
+
+    def run(self, **options):
+        return benchmark_api(options['items'], options['cart_size'], options['repeat'])
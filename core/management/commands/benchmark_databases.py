@@ -0,0 +1,23 @@
+from core.benchmarks import BenchmarkCommand, benchmark_databases
+
+
+class Command(BenchmarkCommand):
+    help = ('Compares concurrent checkout throughput across database '
+            'configurations: SQLite with the rollback journal, with WAL and '
+            'with persistent connections, or Postgres with and without them '
+            'when run with a Postgres DATABASES')
+    threaded = True
+
+    def add_arguments(self, parser):
+        parser.add_argument('--buyers', type=int, default=60,
+                            help='checkouts per configuration')
+        parser.add_argument('--threads', type=int, default=8)
+        parser.add_argument('--readers', type=int, default=2,
+                            help='threads browsing product pages meanwhile')
+        parser.add_argument('--latency', type=float, default=0.01,
+                            help='seconds per Stripe API call')
+        super().add_arguments(parser)
+
+    def run(self, **options):
+        return benchmark_databases(options['buyers'], options['threads'],
+                                   options['readers'], latency=options['latency'])
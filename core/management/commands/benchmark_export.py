@@ -0,0 +1,18 @@
+from core.benchmarks import BenchmarkCommand, benchmark_export
+from core.exports import FORMATS
+
+
+class Command(BenchmarkCommand):
+    help = ('Times the order export at increasing numbers of orders and '
+            'reports its peak memory, which should stay flat')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--sizes', type=int, nargs='+',
+                            default=[1000, 10000])
+        parser.add_argument('--lines-per-order', type=int, default=3)
+        parser.add_argument('--format', choices=FORMATS, default='csv')
+        super().add_arguments(parser)
+
+    def run(self, **options):
+        return benchmark_export(options['sizes'], options['lines_per_order'],
+                                options['format'])
@@ -0,0 +1,15 @@
+from core.benchmarks import BenchmarkCommand, benchmark_finalize
+
+
+class Command(BenchmarkCommand):
+    help = ('Times order finalization after payment for carts of '
+            'increasing size and reports the queries it took')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--sizes', type=int, nargs='+',
+                            default=[1, 10, 100, 500])
+        parser.add_argument('--repeat', type=int, default=5)
+        super().add_arguments(parser)
+
+    def run(self, **options):
+        return benchmark_finalize(options['sizes'], options['repeat'])
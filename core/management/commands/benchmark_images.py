@@ -0,0 +1,24 @@
+from core.benchmarks import BenchmarkCommand, benchmark_images
+
+
+class Command(BenchmarkCommand):
+    help = ('Compares the bytes a browser downloads and the render time of '
+            'the first catalog page before and after item images get '
+            'resized and WebP derivatives')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--items', type=int, default=5)
+        parser.add_argument('--width', type=int, default=1600,
+                            help='width of the original photos')
+        parser.add_argument('--height', type=int, default=2000)
+        parser.add_argument('--viewport', type=int, default=1280,
+                            help='browser width in CSS pixels')
+        parser.add_argument('--dpr', type=float, default=2,
+                            help='device pixel ratio')
+        parser.add_argument('--repeat', type=int, default=5)
+        super().add_arguments(parser)
+
+    def run(self, **options):
+        return benchmark_images(
+            options['items'], (options['width'], options['height']),
+            options['viewport'], options['dpr'], options['repeat'])
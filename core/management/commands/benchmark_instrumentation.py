@@ -0,0 +1,17 @@
+from core.benchmarks import BenchmarkCommand, benchmark_instrumentation
+
+
+class Command(BenchmarkCommand):
+    help = ('Measures what the request instrumentation middleware adds to '
+            'the catalog page, warm and cold')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--items', type=int, default=40)
+        parser.add_argument('--rounds', type=int, default=40)
+        parser.add_argument('--batch', type=int, default=25,
+                            help='requests per setup per round')
+        super().add_arguments(parser)
+
+    def run(self, **options):
+        return benchmark_instrumentation(options['items'], options['rounds'],
+                                         options['batch'])
@@ -0,0 +1,16 @@
+from core.benchmarks import BenchmarkCommand, benchmark_pagination
+
+
+class Command(BenchmarkCommand):
+    help = ('Compares offset and cursor catalog pagination at the first, '
+            'middle and last page of a large throwaway catalog')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--items', type=int, default=1000000)
+        parser.add_argument('--per-page', type=int, default=5)
+        parser.add_argument('--repeat', type=int, default=5)
+        super().add_arguments(parser)
+
+    def run(self, **options):
+        return benchmark_pagination(options['items'], options['per_page'],
+                                    options['repeat'])
@@ -0,0 +1,17 @@
+from core.benchmarks import BenchmarkCommand, benchmark_payments
+
+
+class Command(BenchmarkCommand):
+    help = ('Compares how many payments one request thread completes per '
+            'second in the sync and async payment modes, against a local '
+            'fake Stripe server with a slow gateway')
+    threaded = True
+
+    def add_arguments(self, parser):
+        parser.add_argument('--orders', type=int, default=20)
+        parser.add_argument('--latency', type=float, default=0.25,
+                            help='seconds per Stripe API call')
+        super().add_arguments(parser)
+
+    def run(self, **options):
+        return benchmark_payments(options['orders'], options['latency'])
@@ -0,0 +1,18 @@
+from core.benchmarks import BenchmarkCommand, benchmark_product_page
+
+
+class Command(BenchmarkCommand):
+    help = ('Measures requests per second for one hot product page under '
+            'concurrency: rendered from the database, served from the product '
+            'cache and revalidated with If-None-Match, for anonymous and '
+            'logged-in visitors')
+    threaded = True
+
+    def add_arguments(self, parser):
+        parser.add_argument('--threads', type=int, default=8)
+        parser.add_argument('--requests', type=int, default=200,
+                            help='requests per thread and mode')
+        super().add_arguments(parser)
+
+    def run(self, **options):
+        return benchmark_product_page(options['threads'], options['requests'])
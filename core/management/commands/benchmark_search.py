@@ -0,0 +1,17 @@
+from core.benchmarks import BenchmarkCommand, benchmark_search
+from core.search import BACKENDS
+
+
+class Command(BenchmarkCommand):
+    help = ('Times representative product searches against a large '
+            'throwaway catalog')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--items', type=int, default=100000)
+        parser.add_argument('--backend', choices=sorted(BACKENDS),
+                            default='memory')
+        parser.add_argument('--repeat', type=int, default=5)
+        super().add_arguments(parser)
+
+    def run(self, **options):
+        return benchmark_search(options['items'], options['backend'], options['repeat'])
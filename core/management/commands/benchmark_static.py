@@ -0,0 +1,14 @@
+from core.benchmarks import BenchmarkCommand, benchmark_static
+
+
+class Command(BenchmarkCommand):
+    help = ('Compares the static bytes and requests of a catalog page visit '
+            'served from the raw sources and from the build_static output')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--accept-encoding', default='br, gzip',
+                            help='what the simulated browser accepts')
+        super().add_arguments(parser)
+
+    def run(self, **options):
+        return benchmark_static(options['accept_encoding'])
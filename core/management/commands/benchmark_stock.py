@@ -0,0 +1,20 @@
+from core.benchmarks import BenchmarkCommand, benchmark_stock
+
+
+class Command(BenchmarkCommand):
+    help = ('Load-tests one hot item with many concurrent buyers, checking '
+            'that no more than its stock is ever sold and reporting the '
+            'purchases per second achieved')
+    threaded = True
+
+    def add_arguments(self, parser):
+        parser.add_argument('--buyers', type=int, default=200)
+        parser.add_argument('--stock', type=int, default=50)
+        parser.add_argument('--threads', type=int, default=16)
+        parser.add_argument('--latency', type=float, default=0.05,
+                            help='seconds per Stripe API call')
+        super().add_arguments(parser)
+
+    def run(self, **options):
+        return benchmark_stock(options['buyers'], options['stock'],
+                               options['threads'], options['latency'])
@@ -0,0 +1,30 @@
+from django.conf import settings
+from django.core.management import call_command
+from django.core.management.base import BaseCommand
+
+from core.assets import brotli, precompress, write_bundles
+
+
+class Command(BaseCommand):
+    help = ('Builds STATIC_ROOT for deployment: writes the STATIC_BUNDLES, '
+            'collects every file under a content-hashed name and writes '
+            'gzip (and, with brotli installed, brotli) copies of them')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--clear', action='store_true',
+                            help='empty STATIC_ROOT first')
+
+    def handle(self, *args, **kwargs):
+        for name, size in write_bundles().items():
+            self.stdout.write(f'Bundled {name}: {size} bytes')
+        call_command('collectstatic', interactive=False, clear=kwargs['clear'],
+                     ignore_patterns=settings.STATIC_BUILD_IGNORE,
+                     verbosity=kwargs['verbosity'], stdout=self.stdout)
+        totals = precompress(settings.STATIC_ROOT)
+        message = (f"Precompressed {totals['files']} files: {totals['bytes']} bytes, "
+                   f"{totals['gzip']} gzipped")
+        if brotli is not None:
+            message += f", {totals['br']} brotli"
+        else:
+            message += ' (install brotli for .br copies)'
+        self.stdout.write(self.style.SUCCESS(message))
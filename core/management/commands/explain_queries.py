@@ -0,0 +1,66 @@
+import re
+
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+
+from core import cart
+from core.models import Address, Coupon, Item, Order
+
+
+def hot_queries():
+    """The lookups core.views and core.cart issue on every request."""
+    user = get_user_model()(pk=1)
+    item = Item(pk=1)
+    return [
+        ('open order', Order.objects.filter(user=user, ordered=False)),
+        ('order history', Order.objects.filter(user=user, ordered=True)),
+        ('open order line', cart.open_order_lines(user, item)),
+        ('item by slug', Item.objects.filter(slug='slug')),
+        ('default address', Address.objects.filter(
+            user=user, address_type=Address.SHIPPING, default=True)),
+        ('order by ref code', Order.objects.filter(ref_code='ref')),
+        ('coupon by code', Coupon.objects.filter(code='code')),
+        ('catalog cursor page', Item.objects.filter(id__gt=1).order_by('id')[:6]),
+    ]
+
+
+# Plan lines that read a whole table (SQLite, Postgres)
+FULL_SCAN = re.compile(r'\bSCAN (?:TABLE )?(\w+)(?!.*USING)|Seq Scan on (\w+)')
+INDEX = re.compile(r'USING (?:COVERING )?INDEX (\w+)|Index (?:Only )?Scan (?:Backward )?using (\w+)')
+
+
+class Command(BaseCommand):
+    help = ('EXPLAINs the hot lookups used by the core views and reports '
+            'whether each one is served by an index')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--strict', action='store_true',
+                            help='exit with an error if any query scans a table')
+        parser.add_argument('--verbose-plans', action='store_true',
+                            help='print the full plan of every query')
+
+    def handle(self, *args, **kwargs):
+        scans = []
+        self.stdout.write(f'Database: {connection.vendor}')
+        for name, queryset in hot_queries():
+            plan = queryset.explain()
+            scanned = sorted({table for match in FULL_SCAN.findall(plan)
+                              for table in match if table})
+            indexes = {index for match in INDEX.findall(plan)
+                       for index in match if index}
+            if 'PRIMARY KEY' in plan:
+                indexes.add('primary key')
+            indexes = sorted(indexes)
+            if scanned:
+                scans.append(name)
+                status = self.style.WARNING(f'SCAN {", ".join(scanned)}')
+            else:
+                status = self.style.SUCCESS('index')
+            detail = f' ({", ".join(indexes)})' if indexes else ''
+            self.stdout.write(f'{name:<20} {status}{detail}')
+            if kwargs['verbose_plans']:
+                self.stdout.write('    ' + plan.replace('\n', '\n    '))
+
+        if scans and kwargs['strict']:
+            raise CommandError('Queries without an index: ' + ', '.join(scans))
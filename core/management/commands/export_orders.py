@@ -0,0 +1,59 @@
+import argparse
+from datetime import datetime, time
+
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+from django.utils.dateparse import parse_date, parse_datetime
+
+from core.exports import DATE_FIELDS, FORMATS, export_orders, filter_orders
+from core.models import Order
+
+
+def parse_moment(value):
+    """A datetime, or a date meaning its midnight in the current time zone.
+
+    An argparse ``type``: the ArgumentTypeError becomes a usage error.
+    """
+    moment = parse_datetime(value)
+    if moment is None:
+        day = parse_date(value)
+        if day is None:
+            raise argparse.ArgumentTypeError(f'Not a date: {value!r}')
+        moment = datetime.combine(day, time())
+    if timezone.is_naive(moment):
+        moment = timezone.make_aware(moment)
+    return moment
+
+
+class Command(BaseCommand):
+    help = ('Streams completed orders with their lines, payment, coupon and '
+            'refund status as CSV or JSONL')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--format', choices=FORMATS, default='csv')
+        parser.add_argument('--since', type=parse_moment,
+                            help='date or datetime, inclusive')
+        parser.add_argument('--until', type=parse_moment,
+                            help='date or datetime, exclusive')
+        parser.add_argument('--date-field', choices=DATE_FIELDS,
+                            default='ordered_date',
+                            help='which date --since/--until apply to')
+        parser.add_argument('--all', action='store_true',
+                            help='include open carts, not just completed orders')
+        parser.add_argument('--chunk-size', type=int)
+        parser.add_argument('--output', help='write the export here '
+                            'instead of stdout')
+
+    def handle(self, *args, **kwargs):
+        queryset = Order.objects.all()
+        if not kwargs['all']:
+            queryset = queryset.filter(ordered=True)
+        queryset = filter_orders(queryset, kwargs['since'], kwargs['until'],
+                                 kwargs['date_field'])
+        chunks = export_orders(queryset, kwargs['format'], kwargs['chunk_size'])
+        if kwargs['output']:
+            with open(kwargs['output'], 'w', newline='') as f:
+                f.writelines(chunks)
+        else:
+            for chunk in chunks:
+                self.stdout.write(chunk, ending='')
@@ -0,0 +1,22 @@
+from django.core.management.base import BaseCommand
+
+from core.images import make_derivatives
+from core.models import Item
+
+
+class Command(BaseCommand):
+    help = ('Makes the resized and WebP copies of item images that do not '
+            'have them yet, e.g. after a deploy or a change of widths')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--all', action='store_true',
+                            help='remake them for every item with an image')
+
+    def handle(self, *args, **kwargs):
+        rows = Item.objects.exclude(image='').exclude(image__isnull=True).values_list(
+            'pk', 'image', 'image_derivatives').order_by('pk')
+        made = 0
+        for pk, image, derivatives in rows.iterator():
+            if kwargs['all'] or (derivatives or {}).get('source') != image:
+                made += make_derivatives(pk) is not None
+        self.stdout.write(self.style.SUCCESS(f'Made derivatives for {made} items'))
@@ -0,0 +1,37 @@
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from core.cart import PurgeStats, purge_abandoned_carts, purge_orphaned_lines
+
+
+class Command(BaseCommand):
+    help = ('Deletes open carts left untouched for --days and cart lines '
+            'that belong to no order, a small batch per transaction')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--days', type=int,
+                            default=settings.ABANDONED_CART_DAYS)
+        parser.add_argument('--batch-size', type=int,
+                            default=settings.PURGE_BATCH_SIZE)
+        parser.add_argument('--pause', type=float, default=0,
+                            help='seconds to sleep between batches')
+        parser.add_argument('--dry-run', action='store_true',
+                            help='only count what would be deleted')
+
+    def handle(self, *args, **kwargs):
+        cutoff = timezone.now() - timedelta(days=kwargs['days'])
+        stats = PurgeStats(dry_run=kwargs['dry_run'])
+        purge_abandoned_carts(cutoff, kwargs['batch_size'], kwargs['pause'], stats)
+        purge_orphaned_lines(kwargs['batch_size'], kwargs['pause'], stats)
+
+        report = stats.as_dict()
+        verb = 'Would delete' if stats.dry_run else 'Deleted'
+        message = (f"{verb} {report['carts']} carts older than {kwargs['days']} days "
+                   f"with {report['lines']} lines, and {report['orphans']} orphaned lines")
+        if not stats.dry_run:
+            message += (f" in {report['batches']} batches, {report['seconds']}s "
+                        f"({report['rows_per_second']} rows/s)")
+        self.stdout.write(self.style.SUCCESS(message))
@@ -0,0 +1,19 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from core.search import get_backend
+
+
+class Command(BaseCommand):
+    help = 'Rebuilds the product search index of the configured backend'
+
+    def handle(self, *args, **kwargs):
+        backend = get_backend()
+        if backend.name == 'memory':
+            # Building one here would only fill this command's own process
+            raise CommandError(
+                'The memory search index lives in each server process, which '
+                'builds it on first use and again after catalog changes; there '
+                'is nothing to rebuild from here')
+        backend.build()
+        self.stdout.write(self.style.SUCCESS(
+            f'Rebuilt the {backend.name} search index'))
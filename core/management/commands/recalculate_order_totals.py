@@ -0,0 +1,61 @@
+from decimal import Decimal
+
+from django.core.management.base import BaseCommand
+from django.db.models import DecimalField, F, Sum
+from django.db.models.functions import Coalesce
+from core.models import Item, Order
+
+
+def annotate_subtotals(queryset):
+    # Paid lines keep the price they were bought at
+    unit_price = Coalesce('items__unit_price',
+                          Item.price_expression('items__item__'))
+    return queryset.annotate(computed_subtotal=Coalesce(
+        Sum(F('items__quantity') * unit_price,
+            output_field=DecimalField(max_digits=10, decimal_places=2)),
+        Decimal(0)))
+
+
+class Command(BaseCommand):
+    help = 'Recomputes the denormalized subtotal/discount/total of orders'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--all', action='store_true',
+                            help='include completed orders, not just open carts')
+        parser.add_argument('--batch-size', type=int, default=500)
+
+    def handle(self, *args, **kwargs):
+        batch_size = kwargs['batch_size']
+        queryset = Order.objects.all()
+        if not kwargs['all']:
+            # Completed orders keep the totals they were charged with
+            queryset = queryset.filter(ordered=False)
+        queryset = annotate_subtotals(queryset).select_related('coupon')
+
+        checked = 0
+        changed = []
+        fixed = 0
+        for order in queryset.iterator(chunk_size=batch_size):
+            checked += 1
+            subtotal = order.computed_subtotal
+            discount = order.coupon.discount_for(subtotal) if order.coupon else 0
+            total = max(subtotal - discount, 0)
+            if (order.subtotal, order.discount, order.total) != (subtotal, discount, total):
+                order.subtotal = subtotal
+                order.discount = discount
+                order.total = total
+                changed.append(order)
+            if len(changed) >= batch_size:
+                fixed += self.flush(changed)
+        fixed += self.flush(changed)
+
+        self.stdout.write(self.style.SUCCESS(
+            f'Checked {checked} orders, corrected {fixed}'))
+
+    def flush(self, orders):
+        count = len(orders)
+        if count:
+            Order.objects.bulk_update(
+                orders, ['subtotal', 'discount', 'total'])
+            orders.clear()
+        return count
@@ -0,0 +1,15 @@
+from django.core.management.base import BaseCommand
+
+from core.inventory import release_expired
+
+
+class Command(BaseCommand):
+    help = ('Hands back the stock held by cart lines whose reservation has '
+            'lapsed, a small batch of carts per transaction')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=500)
+
+    def handle(self, *args, **kwargs):
+        released = release_expired(batch_size=kwargs['batch_size'])
+        self.stdout.write(self.style.SUCCESS(f'Released {released} held units'))
@@ -0,0 +1,55 @@
+from django.conf import settings
+from django.contrib.auth.models import AnonymousUser
+from django.core.management.base import BaseCommand
+from django.http import Http404
+from django.test import RequestFactory
+from django.urls import reverse
+
+from core.views import HomeView
+
+
+class Command(BaseCommand):
+    help = 'Renders the first pages of the catalog into the cache'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--pages', type=int, default=10,
+                            help='number of catalog pages to warm')
+
+    def handle(self, *args, **kwargs):
+        if settings.CATALOG_PAGINATION == 'cursor':
+            warmed = self.warm_cursor_pages(kwargs['pages'])
+        else:
+            warmed = self.warm_numbered_pages(kwargs['pages'])
+        self.stdout.write(self.style.SUCCESS(f'Warmed {warmed} catalog pages'))
+
+    def get_view(self, query):
+        request = RequestFactory().get(reverse('core:item-list_url'), query)
+        request.user = AnonymousUser()
+        view = HomeView()
+        view.setup(request)
+        return view
+
+    def warm_numbered_pages(self, pages):
+        warmed = 0
+        for page in range(1, pages + 1):
+            try:
+                self.get_view({'page': page}).get_catalog_grid()
+            except Http404:
+                break
+            warmed += 1
+        return warmed
+
+    def warm_cursor_pages(self, pages):
+        # Each page is cached under its own cursor, which only the page
+        # before it can tell
+        warmed = 0
+        query = {}
+        while warmed < pages:
+            view = self.get_view(query)
+            view.get_catalog_grid()
+            warmed += 1
+            next_cursor = view.get_cursor_page().next_cursor
+            if next_cursor is None:
+                break
+            query = {HomeView.cursor_kwarg: next_cursor}
+        return warmed
@@ -0,0 +1,54 @@
+# Generated by Django 3.1.3 on 2026-10-18 18:40
+
+from django.db import migrations, models
+from django.db.models import Case, F, FloatField, Sum, When
+from django.db.models.functions import Coalesce
+
+
+def backfill_order_totals(apps, schema_editor):
+    Order = apps.get_model('core', 'Order')
+    unit_price = Case(
+        When(items__item__discount_price__gt=0,
+             then=F('items__item__discount_price')),
+        default=F('items__item__price'),
+        output_field=FloatField())
+    orders = Order.objects.select_related('coupon', 'payment').annotate(
+        computed_subtotal=Coalesce(
+            Sum(F('items__quantity') * unit_price, output_field=FloatField()), 0.0))
+    for order in orders.iterator():
+        order.subtotal = order.computed_subtotal
+        if order.payment is not None:
+            # What was charged, whatever the items cost now
+            order.total = order.payment.amount
+            order.discount = max(order.subtotal - order.total, 0)
+        else:
+            order.discount = order.coupon.amount if order.coupon else 0
+            order.total = max(order.subtotal - order.discount, 0)
+        order.save(update_fields=['subtotal', 'discount', 'total'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0005_auto_20201215_1354'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='order',
+            name='discount',
+            field=models.FloatField(default=0),
+        ),
+        migrations.AddField(
+            model_name='order',
+            name='subtotal',
+            field=models.FloatField(default=0),
+        ),
+        migrations.AddField(
+            model_name='order',
+            name='total',
+            field=models.FloatField(default=0),
+        ),
+        migrations.RunPython(backfill_order_totals,
+                             migrations.RunPython.noop),
+    ]
@@ -0,0 +1,31 @@
+# Generated by Django 3.1.3 on 2026-10-18 18:42
+
+from django.db import migrations, models
+from django.db.models import Count, Min
+
+
+def drop_duplicate_open_orders(apps, schema_editor):
+    # The cart views always worked on the first open order, later
+    # duplicates were unreachable
+    Order = apps.get_model('core', 'Order')
+    duplicated = (Order.objects.filter(ordered=False).values('user')
+                  .annotate(n=Count('pk'), keep=Min('pk')).filter(n__gt=1))
+    for row in duplicated:
+        Order.objects.filter(user=row['user'], ordered=False).exclude(
+            pk=row['keep']).delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0006_order_totals'),
+    ]
+
+    operations = [
+        migrations.RunPython(drop_duplicate_open_orders,
+                             migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name='order',
+            constraint=models.UniqueConstraint(condition=models.Q(ordered=False), fields=('user',), name='unique_open_order_per_user'),
+        ),
+    ]
@@ -0,0 +1,58 @@
+# Generated by Django 3.1.3 on 2026-10-18 18:51
+
+from django.db import migrations, models
+from django.db.models import Count
+
+
+def dedupe(model, field, max_length):
+    duplicated = (model.objects.values(field).annotate(n=Count('pk'))
+                  .filter(n__gt=1).values_list(field, flat=True))
+    for value in list(duplicated):
+        # The lowest pk keeps the value, the rest get their pk appended
+        for obj in model.objects.filter(**{field: value}).order_by('pk')[1:]:
+            suffix = f'-{obj.pk}'
+            setattr(obj, field, value[:max_length - len(suffix)] + suffix)
+            obj.save(update_fields=[field])
+
+
+def dedupe_lookup_keys(apps, schema_editor):
+    dedupe(apps.get_model('core', 'Item'), 'slug', 50)
+    dedupe(apps.get_model('core', 'Coupon'), 'code', 15)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0007_unique_open_order'),
+    ]
+
+    operations = [
+        migrations.RunPython(dedupe_lookup_keys, migrations.RunPython.noop),
+        migrations.AlterField(
+            model_name='coupon',
+            name='code',
+            field=models.CharField(max_length=15, unique=True),
+        ),
+        migrations.AlterField(
+            model_name='item',
+            name='slug',
+            field=models.SlugField(unique=True),
+        ),
+        migrations.AlterField(
+            model_name='order',
+            name='ref_code',
+            field=models.CharField(blank=True, max_length=20, null=True, unique=True),
+        ),
+        migrations.AddIndex(
+            model_name='address',
+            index=models.Index(condition=models.Q(default=True), fields=['user', 'address_type'], name='address_default_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='order',
+            index=models.Index(fields=['user', 'ordered'], name='order_user_ordered_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='orderitem',
+            index=models.Index(condition=models.Q(ordered=False), fields=['user', 'item'], name='orderitem_open_user_item_idx'),
+        ),
+    ]
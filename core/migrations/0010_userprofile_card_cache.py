@@ -0,0 +1,38 @@
+# Generated by Django 3.1.3 on 2026-10-18 19:09
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0009_payment_attempt'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='userprofile',
+            name='card_brand',
+            field=models.CharField(blank=True, max_length=20),
+        ),
+        migrations.AddField(
+            model_name='userprofile',
+            name='card_cached_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='userprofile',
+            name='card_exp_month',
+            field=models.PositiveSmallIntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='userprofile',
+            name='card_exp_year',
+            field=models.PositiveSmallIntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='userprofile',
+            name='card_last4',
+            field=models.CharField(blank=True, max_length=4),
+        ),
+    ]
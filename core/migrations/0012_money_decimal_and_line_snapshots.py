@@ -0,0 +1,126 @@
+# Generated by Django 3.1.3 on 2026-10-18 19:12
+
+from django.db import migrations, models
+from django.db.models import (Case, DecimalField, ExpressionWrapper, F, Max,
+                              OuterRef, Subquery, Sum, Value, When)
+from django.db.models.functions import Coalesce, Greatest
+
+BATCH_SIZE = 1000
+
+
+def snapshot_ordered_lines(apps, schema_editor):
+    """Copy title and prices onto already-ordered lines, BATCH_SIZE pks
+    per UPDATE so no single statement locks the whole table.
+
+    The Item's current values are the best record left of what was paid;
+    unit_price already captured by finalize_order is kept.
+    """
+    Item = apps.get_model('core', 'Item')
+    OrderItem = apps.get_model('core', 'OrderItem')
+    money = DecimalField(max_digits=10, decimal_places=2)
+    price = Case(When(discount_price__gt=0, then=F('discount_price')),
+                 default=F('price'), output_field=money)
+    items = Item.objects.filter(pk=OuterRef('item_id'))
+    snapshot = {
+        'title': Subquery(items.values('title')),
+        'unit_price': Coalesce('unit_price',
+                               Subquery(items.values(effective_price=price))),
+        'unit_discount': Subquery(items.values(
+            saved=ExpressionWrapper(F('price') - price, output_field=money))),
+    }
+    last = OrderItem.objects.aggregate(n=Max('pk'))['n'] or 0
+    for start in range(0, last, BATCH_SIZE):
+        OrderItem.objects.filter(ordered=True, pk__gt=start,
+                                 pk__lte=start + BATCH_SIZE).update(**snapshot)
+
+
+def backfill_paid_order_totals(apps, schema_editor):
+    """Give paid orders that never had totals stored (all three still 0)
+    a subtotal summed from their snapshotted lines and a total equal to
+    what was charged, so history and exports stop showing 0.00.
+    """
+    Order = apps.get_model('core', 'Order')
+    Payment = apps.get_model('core', 'Payment')
+    money = DecimalField(max_digits=10, decimal_places=2)
+    lines = Order.items.through.objects.filter(order_id=OuterRef('pk')).values(
+        'order_id').annotate(amount=Sum(F('orderitem__quantity') * F('orderitem__unit_price'),
+                                        output_field=money)).values('amount')
+    subtotal = Coalesce(Subquery(lines, output_field=money), Value(0), output_field=money)
+    charged = Subquery(Payment.objects.filter(pk=OuterRef('payment_id')).values('amount'),
+                       output_field=money)
+    total = Coalesce(charged, subtotal, output_field=money)
+    # Plain 0, not a Decimal: SQLite binds Decimals as text
+    totals = {'subtotal': subtotal,
+              'discount': Greatest(subtotal - total, Value(0), output_field=money),
+              'total': total}
+    last = Order.objects.aggregate(n=Max('pk'))['n'] or 0
+    for start in range(0, last, BATCH_SIZE):
+        Order.objects.filter(ordered=True, subtotal=0, discount=0, total=0,
+                             pk__gt=start, pk__lte=start + BATCH_SIZE).update(**totals)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0011_orderitem_unit_price'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='orderitem',
+            name='title',
+            field=models.CharField(blank=True, max_length=100),
+        ),
+        migrations.AddField(
+            model_name='orderitem',
+            name='unit_discount',
+            field=models.DecimalField(blank=True, decimal_places=2, max_digits=10, null=True),
+        ),
+        migrations.AlterField(
+            model_name='coupon',
+            name='amount',
+            field=models.DecimalField(decimal_places=2, max_digits=10),
+        ),
+        migrations.AlterField(
+            model_name='item',
+            name='discount_price',
+            field=models.DecimalField(blank=True, decimal_places=2, max_digits=10, null=True),
+        ),
+        migrations.AlterField(
+            model_name='item',
+            name='price',
+            field=models.DecimalField(decimal_places=2, max_digits=10),
+        ),
+        migrations.AlterField(
+            model_name='order',
+            name='discount',
+            field=models.DecimalField(decimal_places=2, default=0, max_digits=10),
+        ),
+        migrations.AlterField(
+            model_name='order',
+            name='subtotal',
+            field=models.DecimalField(decimal_places=2, default=0, max_digits=10),
+        ),
+        migrations.AlterField(
+            model_name='order',
+            name='total',
+            field=models.DecimalField(decimal_places=2, default=0, max_digits=10),
+        ),
+        migrations.AlterField(
+            model_name='orderitem',
+            name='unit_price',
+            field=models.DecimalField(blank=True, decimal_places=2, max_digits=10, null=True),
+        ),
+        migrations.AlterField(
+            model_name='payment',
+            name='amount',
+            field=models.DecimalField(decimal_places=2, max_digits=10),
+        ),
+        migrations.AlterField(
+            model_name='paymentattempt',
+            name='amount',
+            field=models.DecimalField(decimal_places=2, max_digits=10),
+        ),
+        migrations.RunPython(snapshot_ordered_lines, migrations.RunPython.noop),
+        migrations.RunPython(backfill_paid_order_totals, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,17 @@
+# Generated by Django 3.1.3 on 2026-10-18 19:16
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0012_money_decimal_and_line_snapshots'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='order',
+            index=models.Index(condition=models.Q(ordered=True), fields=['user', '-ordered_date', '-id'], name='order_history_idx'),
+        ),
+    ]
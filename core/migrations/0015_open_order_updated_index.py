@@ -0,0 +1,17 @@
+# Generated by Django 3.1.3 on 2026-10-18 19:33
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0014_row_versions'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='order',
+            index=models.Index(condition=models.Q(ordered=False), fields=['updated_at'], name='order_open_updated_idx'),
+        ),
+    ]
@@ -0,0 +1,98 @@
+# Generated by Django 3.1.3 on 2026-10-18 19:35
+
+from django.conf import settings
+from django.db import migrations, models
+from django.db.models import Count, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+import django.db.models.deletion
+
+
+BATCH_SIZE = 1000
+
+
+def record_redemptions(apps, schema_editor):
+    """Give every order already holding a coupon its redemption, and
+    start each coupon's use count from them."""
+    Coupon = apps.get_model('core', 'Coupon')
+    CouponRedemption = apps.get_model('core', 'CouponRedemption')
+    Order = apps.get_model('core', 'Order')
+    orders = Order.objects.filter(coupon__isnull=False).order_by('pk').values_list(
+        'pk', 'coupon_id', 'user_id')
+    last = 0
+    while True:
+        batch = list(orders.filter(pk__gt=last)[:BATCH_SIZE])
+        if not batch:
+            break
+        CouponRedemption.objects.bulk_create(
+            CouponRedemption(order_id=pk, coupon_id=coupon_id, user_id=user_id)
+            for pk, coupon_id, user_id in batch)
+        last = batch[-1][0]
+    uses = CouponRedemption.objects.filter(coupon=OuterRef('pk')).order_by().values(
+        'coupon').annotate(n=Count('pk')).values('n')
+    Coupon.objects.update(times_used=Coalesce(Subquery(uses), 0))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('core', '0015_open_order_updated_index'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='coupon',
+            name='active',
+            field=models.BooleanField(default=True),
+        ),
+        migrations.AddField(
+            model_name='coupon',
+            name='kind',
+            field=models.CharField(choices=[('F', 'fixed amount'), ('P', 'percent of subtotal')], default='F', max_length=1),
+        ),
+        migrations.AddField(
+            model_name='coupon',
+            name='max_uses',
+            field=models.PositiveIntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='coupon',
+            name='max_uses_per_user',
+            field=models.PositiveIntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='coupon',
+            name='times_used',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name='coupon',
+            name='valid_from',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='coupon',
+            name='valid_until',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='order',
+            name='coupon_percent',
+            field=models.DecimalField(blank=True, decimal_places=2, max_digits=5, null=True),
+        ),
+        migrations.CreateModel(
+            name='CouponRedemption',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('created', models.DateTimeField(auto_now_add=True)),
+                ('coupon', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='core.coupon')),
+                ('order', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='coupon_redemption', to='core.order')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to=settings.AUTH_USER_MODEL)),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='couponredemption',
+            index=models.Index(fields=['coupon', 'user'], name='redemption_coupon_user_idx'),
+        ),
+        migrations.RunPython(record_redemptions, migrations.RunPython.noop),
+    ]
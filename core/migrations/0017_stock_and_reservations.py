@@ -0,0 +1,32 @@
+# Generated by Django 3.1.3 on 2026-10-18 19:42
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0016_coupon_rules_and_redemptions'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='item',
+            name='reserved',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name='item',
+            name='stock',
+            field=models.PositiveIntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='orderitem',
+            name='reserved_until',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddIndex(
+            model_name='orderitem',
+            index=models.Index(condition=models.Q(reserved_until__isnull=False), fields=['reserved_until'], name='orderitem_held_idx'),
+        ),
+    ]
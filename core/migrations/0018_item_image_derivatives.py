@@ -0,0 +1,18 @@
+# Generated by Django 3.1.3 on 2026-10-18 19:46
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0017_stock_and_reservations'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='item',
+            name='image_derivatives',
+            field=models.JSONField(blank=True, default=dict, editable=False),
+        ),
+    ]
@@ -0,0 +1,31 @@
+# Generated by Django 3.1.3 on 2026-10-18 21:05
+
+from django.db import migrations, models
+
+
+def record_pending_claims(apps, schema_editor):
+    """Attempts pending across the upgrade claimed their cart's tracked
+    lines, which could not change while they were pending."""
+    PaymentAttempt = apps.get_model('core', 'PaymentAttempt')
+    OrderItem = apps.get_model('core', 'OrderItem')
+    for attempt in PaymentAttempt.objects.filter(status='P'):
+        attempt.claimed = [list(line) for line in OrderItem.objects.filter(
+            order=attempt.order_id, item__stock__isnull=False).values_list(
+            'item_id', 'quantity')]
+        attempt.save(update_fields=['claimed'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0018_item_image_derivatives'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='paymentattempt',
+            name='claimed',
+            field=models.JSONField(default=list, editable=False),
+        ),
+        migrations.RunPython(record_pending_claims, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,53 @@
+# Generated by Django 3.1.3 on 2026-10-18 21:40
+
+from django.db import migrations
+
+# The database search backend's index on Postgres (core/search.py); the
+# SQLite one is an FTS5 table set up after migrate instead
+POSTGRES_SCHEMA = [
+    "ALTER TABLE core_item ADD COLUMN IF NOT EXISTS search_vector tsvector",
+    """CREATE OR REPLACE FUNCTION core_item_search_vector() RETURNS trigger AS $$
+    BEGIN
+        NEW.search_vector :=
+            setweight(to_tsvector('simple', coalesce(NEW.title, '')), 'A') ||
+            setweight(to_tsvector('simple', coalesce(NEW.description, '')), 'B');
+        RETURN NEW;
+    END $$ LANGUAGE plpgsql""",
+    "DROP TRIGGER IF EXISTS core_item_search_vector_trigger ON core_item",
+    """CREATE TRIGGER core_item_search_vector_trigger
+        BEFORE INSERT OR UPDATE OF title, description ON core_item
+        FOR EACH ROW EXECUTE PROCEDURE core_item_search_vector()""",
+    "UPDATE core_item SET title = title WHERE search_vector IS NULL",
+    """CREATE INDEX IF NOT EXISTS core_item_search_vector_idx
+        ON core_item USING gin (search_vector)""",
+]
+
+POSTGRES_SCHEMA_REVERSE = [
+    "DROP INDEX IF EXISTS core_item_search_vector_idx",
+    "DROP TRIGGER IF EXISTS core_item_search_vector_trigger ON core_item",
+    "DROP FUNCTION IF EXISTS core_item_search_vector()",
+    "ALTER TABLE core_item DROP COLUMN IF EXISTS search_vector",
+]
+
+
+class PostgresRunSQL(migrations.RunSQL):
+    """RunSQL that leaves every other database alone."""
+
+    def database_forwards(self, app_label, schema_editor, from_state, to_state):
+        if schema_editor.connection.vendor == 'postgresql':
+            super().database_forwards(app_label, schema_editor, from_state, to_state)
+
+    def database_backwards(self, app_label, schema_editor, from_state, to_state):
+        if schema_editor.connection.vendor == 'postgresql':
+            super().database_backwards(app_label, schema_editor, from_state, to_state)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0019_paymentattempt_claimed'),
+    ]
+
+    operations = [
+        PostgresRunSQL(POSTGRES_SCHEMA, POSTGRES_SCHEMA_REVERSE),
+    ]
@@ -1,8 +1,19 @@
+import uuid
+from datetime import timedelta
+from decimal import ROUND_HALF_UP, Decimal
+
 from django.conf import settings
+from django.core.exceptions import ValidationError
 from django.db import models
+from django.db.models import Case, F, Func, OuterRef, Subquery, Sum, Value, When
+from django.db.models.functions import Cast, Coalesce, Greatest
 from django.shortcuts import reverse
+from django.utils import timezone
 from django_countries.fields import CountryField
-from django.db.models.signals import post_save
+from django.db.models.signals import post_delete, post_save, pre_save
+from .cache import bump_catalog_version, bump_coupon_version, bump_product_version
+
+CENTS = Decimal('0.01')
 
 # Create your models here.
 
@@ -10,10 +21,43 @@ class UserProfile(models.Model):
     user = models.OneToOneField(settings.AUTH_USER_MODEL,on_delete=models.CASCADE)
     stripe_customer_id = models.CharField(max_length=50,blank=True,null=True)
     one_click_purchasing = models.BooleanField(default=False)
+    # Default card shown on the payment page, copied from Stripe so the
+    # page doesn't wait on the API; empty card_last4 means no card
+    card_brand = models.CharField(max_length=20, blank=True)
+    card_last4 = models.CharField(max_length=4, blank=True)
+    card_exp_month = models.PositiveSmallIntegerField(blank=True, null=True)
+    card_exp_year = models.PositiveSmallIntegerField(blank=True, null=True)
+    card_cached_at = models.DateTimeField(blank=True, null=True)
 
     def __str__(self):
         return self.user.username
 
+    def card_is_fresh(self):
+        return (self.card_cached_at is not None and
+                timezone.now() - self.card_cached_at <
+                timedelta(seconds=settings.CARD_CACHE_TIMEOUT))
+
+    def saved_card(self):
+        if not self.card_last4:
+            return None
+        return {'brand': self.card_brand,
+                'last4': self.card_last4,
+                'exp_month': self.card_exp_month,
+                'exp_year': self.card_exp_year}
+
+    def cache_card(self, card):
+        self.card_brand = card['brand'] if card else ''
+        self.card_last4 = card['last4'] if card else ''
+        self.card_exp_month = card['exp_month'] if card else None
+        self.card_exp_year = card['exp_year'] if card else None
+        self.card_cached_at = timezone.now()
+        self.save(update_fields=['card_brand', 'card_last4', 'card_exp_month',
+                                 'card_exp_year', 'card_cached_at'])
+
+    def forget_card(self):
+        self.card_cached_at = None
+        UserProfile.objects.filter(pk=self.pk).update(card_cached_at=None)
+
 class Item(models.Model):
     SHIRT = 'S'
     SPORT_WEAR = 'SW'
@@ -33,17 +77,41 @@ class Item(models.Model):
         (DANGER, 'danger'),
     ]
     title = models.CharField(max_length=100)
-    price = models.FloatField()
-    discount_price = models.FloatField(blank=True, null=True)
+    price = models.DecimalField(max_digits=10, decimal_places=2)
+    discount_price = models.DecimalField(max_digits=10, decimal_places=2, blank=True, null=True)
     category = models.CharField(choices=CATEGORY_CHOICES, max_length=2)
     label = models.CharField(choices=LABEL_CHOICES, max_length=1)
-    slug = models.SlugField()
+    slug = models.SlugField(unique=True)
     description = models.TextField()
     image = models.ImageField(null=True)
+    # Names of the resized/WebP copies of image, filled in by core/images.py
+    image_derivatives = models.JSONField(default=dict, blank=True, editable=False)
+    # Blank means the item is not tracked. reserved counts the units held
+    # by carts (core/inventory.py); both only move in conditional UPDATEs
+    stock = models.PositiveIntegerField(blank=True, null=True)
+    reserved = models.PositiveIntegerField(default=0, editable=False)
+    # Row version for HTTP validators; QuerySet.update() does not bump it
+    updated_at = models.DateTimeField(auto_now=True, db_index=True)
 
     def __str__(self):
         return self.title
 
+    def get_price(self):
+        if self.discount_price:
+            return self.discount_price
+        return self.price
+
+    @staticmethod
+    def price_expression(prefix=''):
+        """get_price() in SQL; ``prefix`` is the path to Item, e.g. 'item__'."""
+        # The Cast gives the CASE numeric affinity on SQLite, which would
+        # otherwise compare it as text with the string-bound Decimal params
+        return Cast(Case(
+            When(**{f'{prefix}discount_price__gt': 0},
+                 then=F(f'{prefix}discount_price')),
+            default=F(f'{prefix}price')),
+            output_field=models.DecimalField(max_digits=10, decimal_places=2))
+
     def get_absolute_url(self):
         return reverse("core:product_url", kwargs={"slug": self.slug})
 
@@ -61,20 +129,52 @@ class OrderItem(models.Model):
     ordered = models.BooleanField(default=False)
     item = models.ForeignKey(Item, on_delete=models.CASCADE)
     quantity = models.IntegerField(default=1)
+    # Copied from Item when the order is paid for, so history, refunds
+    # and reports never need the live Item; open cart lines follow it
+    title = models.CharField(max_length=100, blank=True)
+    unit_price = models.DecimalField(max_digits=10, decimal_places=2, blank=True, null=True)
+    unit_discount = models.DecimalField(max_digits=10, decimal_places=2, blank=True, null=True)
+    # Set while the line holds its quantity of a tracked item's stock
+    reserved_until = models.DateTimeField(blank=True, null=True)
 
     def __str__(self):
-        return f'{self.quantity} of {self.item.title}'
+        return f'{self.quantity} of {self.get_title()}'
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['user', 'item'],
+                         condition=models.Q(ordered=False),
+                         name='orderitem_open_user_item_idx'),
+            # Only lines holding stock, for the sweep of lapsed holds
+            models.Index(fields=['reserved_until'],
+                         condition=models.Q(reserved_until__isnull=False),
+                         name='orderitem_held_idx'),
+        ]
     
+    def get_title(self):
+        return self.title or self.item.title
+
+    def get_unit_price(self):
+        if self.unit_price is not None:
+            return self.unit_price
+        return self.item.get_price()
+
+    def get_unit_discount(self):
+        if self.unit_discount is not None:
+            return self.unit_discount
+        return self.item.price - self.item.get_price()
+
     def get_total_price(self):
-        if self.item.discount_price:
-            return self.quantity * self.item.discount_price
-        return self.quantity * self.item.price
+        return self.quantity * self.get_unit_price()
+
+    def get_amount_saved(self):
+        return self.quantity * self.get_unit_discount()
 
 
 class Order(models.Model):
     user = models.ForeignKey(settings.AUTH_USER_MODEL,
                              on_delete=models.CASCADE)
-    ref_code = models.CharField(max_length=20,blank=True,null=True)
+    ref_code = models.CharField(max_length=20,blank=True,null=True,unique=True)
     items = models.ManyToManyField(OrderItem)
     start_date = models.DateTimeField(auto_now_add=True)
     ordered_date = models.DateTimeField()
@@ -87,17 +187,87 @@ class Order(models.Model):
     received = models.BooleanField(default=False)
     refund_requested = models.BooleanField(default=False)
     refund_granted = models.BooleanField(default=False)
+    # Denormalized totals, kept in step by the cart views and
+    # rebuilt in bulk by the `recalculate_order_totals` command
+    subtotal = models.DecimalField(max_digits=10, decimal_places=2, default=0)
+    discount = models.DecimalField(max_digits=10, decimal_places=2, default=0)
+    total = models.DecimalField(max_digits=10, decimal_places=2, default=0)
+    # Copied from a percent coupon so totals_from_lines can rescale the discount
+    coupon_percent = models.DecimalField(max_digits=5, decimal_places=2,
+                                         blank=True, null=True)
+    # Bumped by every cart change, all of which rebuild the totals
+    updated_at = models.DateTimeField(auto_now=True)
 
     def __str__(self):
         return self.user.username
-    
+
     def get_total(self):
-        total = 0
-        for order_item in self.items.all():
-            total += order_item.get_total_price()
-        if self.items.all() and self.coupon:
-            total -= self.coupon.amount
-        return total
+        return self.total
+
+    @staticmethod
+    def lines_subtotal():
+        """The order's lines summed in SQL, each at the price it shows:
+        its snapshot once taken, the item's current price until then."""
+        money = models.DecimalField(max_digits=10, decimal_places=2)
+        unit_price = Coalesce('orderitem__unit_price',
+                              Item.price_expression('orderitem__item__'))
+        lines = Order.items.through.objects.filter(order_id=OuterRef('pk')).values(
+            'order_id').annotate(amount=Sum(F('orderitem__quantity') * unit_price,
+                                            output_field=money)).values('amount')
+        return Coalesce(Subquery(lines, output_field=money), Value(0), output_field=money)
+
+    @staticmethod
+    def totals_from_lines():
+        money = models.DecimalField(max_digits=10, decimal_places=2)
+        subtotal = Order.lines_subtotal()
+        # Percent coupons follow the subtotal; fixed ones keep their amount
+        discount = Case(
+            When(coupon_percent__isnull=True, then=F('discount')),
+            default=Func(subtotal * F('coupon_percent') / 100, Value(2),
+                         function='ROUND', output_field=money),
+            output_field=money)
+        # Plain 0, not a Decimal: SQLite binds Decimals as text, and MAX()
+        # ranks any text above any number
+        return {'subtotal': subtotal,
+                'discount': discount,
+                'total': Greatest(subtotal - discount, Value(0), output_field=money),
+                'updated_at': timezone.now()}
+
+    def refresh_totals(self):
+        """Rebuild the totals from the lines in a single UPDATE; this
+        instance keeps its old values.
+
+        Rebuilt rather than adjusted by the price of what changed, which
+        may no longer be the price the line was added at.
+        """
+        Order.objects.filter(pk=self.pk).update(**Order.totals_from_lines())
+
+    def set_coupon(self, coupon):
+        self.coupon = coupon
+        self.coupon_percent = coupon.percent if coupon else None
+        self.discount = coupon.discount_for(self.subtotal) if coupon else 0
+        self.total = max(self.subtotal - self.discount, 0)
+        self.save(update_fields=['coupon', 'coupon_percent', 'discount', 'total',
+                                 'updated_at'])
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['user'],
+                                    condition=models.Q(ordered=False),
+                                    name='unique_open_order_per_user'),
+        ]
+        indexes = [
+            models.Index(fields=['user', 'ordered'],
+                         name='order_user_ordered_idx'),
+            # Keyset pages of the order history
+            models.Index(fields=['user', '-ordered_date', '-id'],
+                         condition=models.Q(ordered=True),
+                         name='order_history_idx'),
+            # Finding abandoned carts for purge_carts
+            models.Index(fields=['updated_at'],
+                         condition=models.Q(ordered=False),
+                         name='order_open_updated_idx'),
+        ]
 
 
 class Address(models.Model):
@@ -120,23 +290,117 @@ class Address(models.Model):
 
     class Meta:
         verbose_name_plural = 'Addresses'
+        indexes = [
+            models.Index(fields=['user', 'address_type'],
+                         condition=models.Q(default=True),
+                         name='address_default_idx'),
+        ]
 
 class Payment(models.Model):
     stripe_charge_id = models.CharField(max_length=50)
     user = models.ForeignKey(settings.AUTH_USER_MODEL,on_delete=models.SET_NULL,blank=True,null=True)
-    amount = models.FloatField()
+    amount = models.DecimalField(max_digits=10, decimal_places=2)
     timestap = models.DateTimeField(auto_now_add=True)
 
     def __str__(self):
         return self.user.username
 
+class PaymentAttempt(models.Model):
+    """A charge in flight, or how it ended. While one is pending its cart
+    cannot change (core/cart.py)."""
+    PENDING = 'P'
+    SUCCEEDED = 'S'
+    FAILED = 'F'
+    STATUS_CHOICES = [
+        (PENDING, 'pending'),
+        (SUCCEEDED, 'succeeded'),
+        (FAILED, 'failed')
+    ]
+    # Public handle for the status page, and the Stripe idempotency key
+    key = models.UUIDField(default=uuid.uuid4, unique=True, editable=False)
+    user = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE)
+    order = models.ForeignKey(Order, on_delete=models.CASCADE)
+    amount = models.DecimalField(max_digits=10, decimal_places=2)
+    status = models.CharField(max_length=1, choices=STATUS_CHOICES, default=PENDING)
+    error = models.CharField(max_length=255, blank=True)
+    payment = models.ForeignKey(Payment, on_delete=models.SET_NULL, blank=True, null=True)
+    # [item_id, quantity] pairs inventory.claim took, given back on failure
+    claimed = models.JSONField(default=list, editable=False)
+    created = models.DateTimeField(auto_now_add=True)
+    updated = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f'{self.key}'
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['order'],
+                                    condition=models.Q(status='P'),
+                                    name='one_pending_attempt_per_order'),
+        ]
+
 class Coupon(models.Model):
-    code = models.CharField(max_length=15)
-    amount = models.FloatField()
+    FIXED = 'F'
+    PERCENT = 'P'
+    KIND_CHOICES = [
+        (FIXED, 'fixed amount'),
+        (PERCENT, 'percent of subtotal')
+    ]
+    code = models.CharField(max_length=15, unique=True)
+    kind = models.CharField(max_length=1, choices=KIND_CHOICES, default=FIXED)
+    # Dollars off for FIXED coupons, percent off for PERCENT ones
+    amount = models.DecimalField(max_digits=10, decimal_places=2)
+    active = models.BooleanField(default=True)
+    valid_from = models.DateTimeField(blank=True, null=True)
+    valid_until = models.DateTimeField(blank=True, null=True)
+    # Blank means unlimited. times_used counts the carts and orders
+    # holding the coupon, and only ever moves in conditional UPDATEs
+    max_uses = models.PositiveIntegerField(blank=True, null=True)
+    max_uses_per_user = models.PositiveIntegerField(blank=True, null=True)
+    times_used = models.PositiveIntegerField(default=0, editable=False)
 
     def __str__(self):
         return self.code
 
+    def clean(self):
+        if self.kind == Coupon.PERCENT and not 0 < self.amount <= 100:
+            raise ValidationError({'amount': 'A percentage must be between 0 and 100'})
+        if self.valid_from and self.valid_until and self.valid_from >= self.valid_until:
+            raise ValidationError({'valid_until': 'Must be after valid from'})
+
+    @property
+    def percent(self):
+        return self.amount if self.kind == Coupon.PERCENT else None
+
+    def is_live(self, now=None):
+        now = now or timezone.now()
+        return (self.active
+                and (self.valid_from is None or self.valid_from <= now)
+                and (self.valid_until is None or now < self.valid_until))
+
+    def discount_for(self, subtotal):
+        if self.kind == Coupon.PERCENT:
+            return (subtotal * self.amount / 100).quantize(CENTS, ROUND_HALF_UP)
+        return self.amount
+
+
+class CouponRedemption(models.Model):
+    """A coupon claimed by a cart; it stays with the order once paid."""
+    coupon = models.ForeignKey(Coupon, on_delete=models.CASCADE)
+    user = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE)
+    order = models.OneToOneField(Order, on_delete=models.CASCADE,
+                                 related_name='coupon_redemption')
+    created = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return f'{self.coupon} for {self.order_id}'
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['coupon', 'user'],
+                         name='redemption_coupon_user_idx'),
+        ]
+
 class Refund(models.Model):
     order = models.ForeignKey(Order,on_delete=models.CASCADE)
     reason = models.TextField()
@@ -150,4 +414,46 @@ def userprofile_receiver(sender,instance,created,*args,**kwargs):
     if created:
         userprofile = UserProfile.objects.create(user=instance)
 
-post_save.connect(userprofile_receiver,sender=settings.AUTH_USER_MODEL)
\ No newline at end of file
+post_save.connect(userprofile_receiver,sender=settings.AUTH_USER_MODEL)
+
+def catalog_changed_receiver(sender, *args, **kwargs):
+    bump_catalog_version()
+
+post_save.connect(catalog_changed_receiver, sender=Item)
+
+def item_image_receiver(sender, instance, *args, **kwargs):
+    from .images import queue_derivatives
+    queue_derivatives(instance)
+
+post_save.connect(item_image_receiver, sender=Item)
+post_delete.connect(catalog_changed_receiver, sender=Item)
+
+def item_slug_receiver(sender, instance, raw=False, *args, **kwargs):
+    # A renamed item's page must leave the cache under its old slug too
+    if instance.pk is not None and not raw:
+        instance._saved_slug = Item.objects.filter(pk=instance.pk).values_list(
+            'slug', flat=True).first()
+
+pre_save.connect(item_slug_receiver, sender=Item)
+
+def product_changed_receiver(sender, instance, *args, **kwargs):
+    bump_product_version(instance.slug)
+    saved_slug = getattr(instance, '_saved_slug', None)
+    if saved_slug and saved_slug != instance.slug:
+        bump_product_version(saved_slug)
+
+post_save.connect(product_changed_receiver, sender=Item)
+post_delete.connect(product_changed_receiver, sender=Item)
+
+def coupon_changed_receiver(sender, *args, **kwargs):
+    bump_coupon_version()
+
+post_save.connect(coupon_changed_receiver, sender=Coupon)
+post_delete.connect(coupon_changed_receiver, sender=Coupon)
+
+def redemption_deleted_receiver(sender, instance, *args, **kwargs):
+    # A cart that gave its coupon back, or was purged, frees the use
+    Coupon.objects.filter(pk=instance.coupon_id, times_used__gt=0).update(
+        times_used=F('times_used') - 1)
+
+post_delete.connect(redemption_deleted_receiver, sender=CouponRedemption)
@@ -0,0 +1,152 @@
+"""Keyset (cursor) pagination.
+
+Pages are addressed by an opaque token holding the ordering values of
+the row they start after, so fetching any page is an index range scan
+of ``per_page + 1`` rows, however deep it is. There is no COUNT; an
+approximate total can be asked for separately.
+
+Where numbered pages are still wanted, as in the admin, the
+EstimatedCountPaginator bounds what their COUNT costs instead.
+"""
+import base64
+import binascii
+import json
+
+from django.core.exceptions import ValidationError
+from django.core.paginator import Paginator
+from django.db import connection
+from django.db.models import Max, Q
+from django.utils.functional import cached_property
+
+
+class InvalidCursor(Exception):
+    pass
+
+
+def encode_cursor(values, forward=True):
+    payload = json.dumps({'v': values, 'd': 'n' if forward else 'p'},
+                         separators=(',', ':'), default=str)
+    return base64.urlsafe_b64encode(payload.encode()).decode().rstrip('=')
+
+
+def decode_cursor(token):
+    try:
+        padded = token + '=' * (-len(token) % 4)
+        payload = json.loads(base64.urlsafe_b64decode(padded.encode()))
+        if not isinstance(payload['v'], list):
+            raise InvalidCursor(token)
+        return payload['v'], payload['d'] == 'n'
+    except (binascii.Error, ValueError, TypeError, KeyError):
+        raise InvalidCursor(token)
+
+
+def approximate_count(model):
+    """Cheap row estimate: planner statistics on Postgres, MAX(pk) elsewhere."""
+    if connection.vendor == 'postgresql':
+        with connection.cursor() as cursor:
+            cursor.execute('SELECT reltuples FROM pg_class WHERE relname = %s',
+                           [model._meta.db_table])
+            row = cursor.fetchone()
+            if row and row[0] >= 0:
+                return int(row[0])
+    return model._default_manager.aggregate(n=Max('pk'))['n'] or 0
+
+
+class EstimatedCountPaginator(Paginator):
+    """A Paginator that estimates the size of a whole, huge table.
+
+    An unfiltered queryset with more than ``exact_count_limit`` rows
+    reports approximate_count() for its table instead of a full COUNT.
+    Filtered ones are always counted exactly, which their indexes keep
+    affordable; a capped total would hide every page past the cap.
+    """
+    exact_count_limit = 10000
+
+    @cached_property
+    def count(self):
+        if self.object_list.query.where:
+            return self.object_list.count()
+        # COUNT over a LIMIT subquery stops scanning at the limit
+        count = self.object_list[:self.exact_count_limit + 1].count()
+        if count <= self.exact_count_limit:
+            return count
+        return max(approximate_count(self.object_list.model), count)
+
+
+class CursorPage:
+    def __init__(self, object_list, ordering, has_next, has_previous,
+                 approximate_count=None):
+        self.object_list = object_list
+        self.ordering = ordering
+        self.has_next = has_next
+        self.has_previous = has_previous
+        self.approximate_count = approximate_count
+
+    def __iter__(self):
+        return iter(self.object_list)
+
+    def __len__(self):
+        return len(self.object_list)
+
+    def _values(self, obj):
+        return [getattr(obj, field.lstrip('-')) for field in self.ordering]
+
+    @property
+    def next_cursor(self):
+        if self.has_next:
+            return encode_cursor(self._values(self.object_list[-1]))
+
+    @property
+    def previous_cursor(self):
+        if self.has_previous:
+            return encode_cursor(self._values(self.object_list[0]), forward=False)
+
+
+class CursorPaginator:
+    """``ordering`` must end in a unique field (the pk) to be a total order."""
+
+    def __init__(self, queryset, per_page, ordering=('id',),
+                 with_count=False):
+        self.queryset = queryset
+        self.per_page = per_page
+        self.ordering = list(ordering)
+        self.with_count = with_count
+
+    def _after(self, values, forward):
+        condition = Q()
+        for n, field in enumerate(self.ordering):
+            name = field.lstrip('-')
+            descending = field.startswith('-')
+            lookup = 'lt' if descending == forward else 'gt'
+            step = Q(**{f'{name}__{lookup}': values[n]})
+            for previous, value in zip(self.ordering[:n], values[:n]):
+                step &= Q(**{previous.lstrip('-'): value})
+            condition |= step
+        return condition
+
+    def _flipped(self):
+        return [field[1:] if field.startswith('-') else '-' + field
+                for field in self.ordering]
+
+    def page(self, cursor=None):
+        forward = True
+        queryset = self.queryset
+        if cursor:
+            values, forward = decode_cursor(cursor)
+            if len(values) != len(self.ordering):
+                raise InvalidCursor(cursor)
+            try:
+                queryset = queryset.filter(self._after(values, forward))
+            except (TypeError, ValueError, ValidationError):
+                raise InvalidCursor(cursor)
+        ordering = self.ordering if forward else self._flipped()
+        rows = list(queryset.order_by(*ordering)[:self.per_page + 1])
+        has_more = len(rows) > self.per_page
+        rows = rows[:self.per_page]
+        if forward:
+            has_next, has_previous = has_more, bool(cursor)
+        else:
+            rows.reverse()
+            has_next, has_previous = True, has_more
+        count = approximate_count(self.queryset.model) if self.with_count else None
+        return CursorPage(rows, self.ordering, has_next, has_previous, count)
@@ -0,0 +1,288 @@
+"""Stripe charges and order completion.
+
+Either way PaymentView first records a pending PaymentAttempt with
+``open_attempt``, which snapshots the cart's prices and claims its stock.
+The 'sync' payment mode then calls ``process_payment`` inline; 'async'
+mode runs it in a background job (core/tasks.py).
+
+The queue does not outlive its process, so an attempt pending for longer
+than PAYMENT_ATTEMPT_TIMEOUT is taken to be lost and failed by
+``payment_pending``, giving its stock back. The cart cannot change while
+an attempt is pending, so what it charges is what gets ordered.
+"""
+import logging
+import random
+import string
+import time
+from datetime import timedelta
+
+import stripe
+from django.conf import settings
+from django.db import IntegrityError, transaction
+from django.db.models import Exists, ExpressionWrapper, F, OuterRef, Subquery
+from django.utils import timezone
+
+from . import instrumentation, inventory, tasks
+from .cache import card_stats, invalidate_cart_summary
+from .models import Item, Order, OrderItem, Payment, PaymentAttempt, UserProfile
+
+stripe.api_key = settings.STRIPE_SECRET_KEY
+
+logger = logging.getLogger(__name__)
+
+EXPIRED_ERROR = 'Your payment did not go through in time. Please try again'
+
+
+def create_ref_code():
+    return ''.join(random.choices(string.ascii_lowercase + string.digits, k=20))
+
+
+def default_card(userprofile):
+    """The card to offer for one-click purchasing, from the local copy on
+    the profile while it is fresh and from Stripe otherwise."""
+    if not userprofile.one_click_purchasing:
+        return None
+    if userprofile.card_is_fresh():
+        card_stats.hit()
+        return userprofile.saved_card()
+    start = time.perf_counter()
+    with instrumentation.external('stripe'):
+        cards = stripe.Customer.list_sources(
+            userprofile.stripe_customer_id,
+            limit=3,
+            object='card'
+        )
+    card_stats.miss(time.perf_counter() - start)
+    card_list = cards['data']
+    userprofile.cache_card(card_list[0] if len(card_list) > 0 else None)
+    return userprofile.saved_card()
+
+
+def charge(user, amount, token, save=False, use_default=False,
+           idempotency_key=None):
+    """Charge ``amount`` dollars, saving the card first if asked to."""
+    userprofile = UserProfile.objects.get(user=user)
+    if save:
+        if userprofile.stripe_customer_id != '' and userprofile.stripe_customer_id is not None:
+            with instrumentation.external('stripe'):
+                customer = stripe.Customer.retrieve(
+                    userprofile.stripe_customer_id)
+                customer.sources.create(source=token)
+            userprofile.forget_card()
+
+        else:
+            with instrumentation.external('stripe'):
+                customer = stripe.Customer.create(
+                    email=user.email,
+                    source=token
+                )
+            userprofile.stripe_customer_id = customer['id']
+            userprofile.one_click_purchasing = True
+            userprofile.card_cached_at = None
+            userprofile.save()
+
+    cents = int(round(amount * 100))
+    with instrumentation.external('stripe'):
+        if use_default or save:
+            return stripe.Charge.create(
+                amount=cents,
+                currency="usd",
+                customer=userprofile.stripe_customer_id,
+                idempotency_key=idempotency_key
+            )
+        return stripe.Charge.create(
+            amount=cents,
+            currency="usd",
+            source=token,
+            idempotency_key=idempotency_key
+        )
+
+
+def error_message(error):
+    """What to tell the customer when ``charge`` raised ``error``."""
+    if isinstance(error, stripe.error.CardError):
+        # Since it's a decline, stripe.error.CardError will be caught
+        return f"{error.user_message}"
+    if isinstance(error, stripe.error.RateLimitError):
+        # Too many requests made to the API too quickly
+        return "Rate Limit Error"
+    if isinstance(error, stripe.error.InvalidRequestError):
+        # Invalid parameters were supplied to Stripe's API
+        return "Invalid Request"
+    if isinstance(error, stripe.error.AuthenticationError):
+        # Authentication with Stripe's API failed
+        # (maybe you changed API keys recently)
+        return "Not Authenticated"
+    if isinstance(error, stripe.error.APIConnectionError):
+        # Network communication with Stripe failed
+        return "Network Error"
+    if isinstance(error, stripe.error.StripeError):
+        return "Something went wrong. You were not charged. Please try again"
+    # Something else happened, completely unrelated to Stripe
+    return "A serious error occurred. We've been notified"
+
+
+def snapshot_fields():
+    """UPDATE values copying each line's Item title and prices onto it."""
+    items = Item.objects.filter(pk=OuterRef('item_id'))
+    price = Item.price_expression()
+    return {'title': Subquery(items.values('title')),
+            'unit_price': Subquery(items.values(effective_price=price)),
+            'unit_discount': Subquery(items.values(
+                saved=ExpressionWrapper(F('price') - price,
+                                        output_field=price.output_field)))}
+
+
+def snapshot_order(order):
+    """Copy each line's Item title and prices onto it and rebuild the
+    order's totals from those copies; returns the total to charge.
+
+    Taken before the charge, so the charge, the Payment and the lines
+    all come from the same numbers, however the items are repriced
+    meanwhile. ``release_snapshot`` undoes it if the payment fails.
+    """
+    with transaction.atomic():
+        OrderItem.objects.filter(order=order).update(**snapshot_fields())
+        order.refresh_totals()
+        order.refresh_from_db(fields=['subtotal', 'discount', 'total', 'updated_at'])
+    return order.total
+
+
+def release_snapshot(order_id):
+    """Let an unpaid cart follow its items' prices again."""
+    with transaction.atomic():
+        OrderItem.objects.filter(order=order_id, ordered=False).update(
+            title='', unit_price=None, unit_discount=None)
+        Order.objects.filter(pk=order_id).update(**Order.totals_from_lines())
+
+
+def finalize_order(order, user, charge_id, amount):
+    """Record the payment and close ``order`` in one transaction.
+
+    ``amount`` is what ``snapshot_order`` returned and was charged.
+    Three statements whatever the cart size: the Payment INSERT, one
+    UPDATE marking every line ordered and one UPDATE closing the order.
+    """
+    with transaction.atomic():
+        payment = Payment.objects.create(stripe_charge_id=charge_id,
+                                         user=user, amount=amount)
+        OrderItem.objects.filter(order=order).update(ordered=True)
+        ref_code = create_ref_code()
+        ordered_date = timezone.now()
+        Order.objects.filter(pk=order.pk).update(
+            ordered=True, ordered_date=ordered_date, updated_at=ordered_date,
+            payment=payment, ref_code=ref_code)
+    order.ordered = True
+    order.ordered_date = ordered_date
+    order.updated_at = ordered_date
+    order.payment = payment
+    order.ref_code = ref_code
+    return payment
+
+
+def open_attempt(order):
+    """Record a pending attempt for ``order``, returning it and whether it
+    is new; the cart cannot change until it settles.
+
+    Submitting twice while a charge is in flight returns the attempt that
+    is already pending, which the caller must not charge again. The
+    order's stock is claimed along with the attempt, so only once too.
+    Raises OutOfStock.
+    """
+    try:
+        with transaction.atomic():
+            # user_id, not user: a lazy SELECT here would turn this into a
+            # read transaction that SQLite cannot upgrade while others write
+            # The snapshot's UPDATEs come first and take the write lock
+            amount = snapshot_order(order)
+            # Raises OutOfStock, which takes the snapshot back with it
+            claimed = inventory.claim(order)
+            return PaymentAttempt.objects.create(
+                user_id=order.user_id, order=order, amount=amount,
+                claimed=claimed), True
+    except IntegrityError:
+        if payment_pending(order.pk):
+            return PaymentAttempt.objects.get(order=order, status=PaymentAttempt.PENDING), False
+        # The attempt in the way had expired and is failed now
+        return open_attempt(order)
+
+
+def start_payment(order, token, save=False, use_default=False):
+    """``open_attempt`` and queue its charge, unless one was pending."""
+    attempt, created = open_attempt(order)
+    if created:
+        # Not before the attempt is committed, or the job may not find it
+        transaction.on_commit(lambda: tasks.enqueue(
+            process_payment, attempt.pk, token, save, use_default))
+    return attempt
+
+
+def has_pending_attempt():
+    """Order annotation, the cheap half of ``payment_pending``."""
+    return Exists(PaymentAttempt.objects.filter(
+        order=OuterRef('pk'), status=PaymentAttempt.PENDING))
+
+
+def payment_pending(order_id):
+    """Whether a payment for the order is still in flight.
+
+    A pending attempt older than PAYMENT_ATTEMPT_TIMEOUT lost its job with
+    the process that queued it; it is failed here instead.
+    """
+    attempt = PaymentAttempt.objects.filter(
+        order=order_id, status=PaymentAttempt.PENDING).values_list('pk', 'created').first()
+    if attempt is None:
+        return False
+    pk, created = attempt
+    if created > timezone.now() - timedelta(seconds=settings.PAYMENT_ATTEMPT_TIMEOUT):
+        return True
+    fail_attempt(pk, EXPIRED_ERROR)
+    return False
+
+
+def process_payment(attempt_id, token, save=False, use_default=False):
+    attempt = PaymentAttempt.objects.select_related('user').get(pk=attempt_id)
+    if attempt.status != PaymentAttempt.PENDING:
+        return attempt
+    try:
+        # Same key on every retry, so Stripe never charges an attempt twice
+        result = charge(attempt.user, attempt.amount, token, save, use_default,
+                        idempotency_key=str(attempt.key))
+    except Exception as e:
+        return fail_attempt(attempt_id, error_message(e))
+    return complete_attempt(attempt_id, result['id'])
+
+
+def complete_attempt(attempt_id, charge_id):
+    """Finalize the order behind a successful charge; safe to repeat."""
+    with transaction.atomic():
+        # Conditional UPDATE first: only one caller can claim the attempt,
+        # and the write lock is taken before anything is read
+        claimed = PaymentAttempt.objects.filter(
+            pk=attempt_id, status=PaymentAttempt.PENDING).update(
+            status=PaymentAttempt.SUCCEEDED, updated=timezone.now())
+        attempt = PaymentAttempt.objects.select_related('user').get(pk=attempt_id)
+        if not claimed:
+            if attempt.status == PaymentAttempt.FAILED:
+                # Expired while its job was still charging
+                logger.error('Charge %s completed after payment attempt %s had '
+                             'failed; it needs refunding', charge_id, attempt.key)
+            return attempt
+        order = Order.objects.select_for_update().get(pk=attempt.order_id)
+        attempt.payment = finalize_order(order, attempt.user, charge_id,
+                                         attempt.amount)
+        attempt.save(update_fields=['payment'])
+    invalidate_cart_summary(attempt.user)
+    return attempt
+
+
+def fail_attempt(attempt_id, error):
+    failed = PaymentAttempt.objects.filter(
+        pk=attempt_id, status=PaymentAttempt.PENDING).update(
+        status=PaymentAttempt.FAILED, error=error[:255], updated=timezone.now())
+    attempt = PaymentAttempt.objects.get(pk=attempt_id)
+    if failed:
+        # Only the caller that failed the attempt gives its stock back
+        inventory.restock(attempt.claimed)
+        release_snapshot(attempt.order_id)
+    return attempt
@@ -0,0 +1,236 @@
+"""N+1, repeated and slow query detection for development and CI.
+
+``record`` collects the queries run inside it through an execute wrapper,
+each with a normalized fingerprint (literals, placeholders and IN lists
+collapsed), its duration and where it came from: the innermost frames of
+this project's code and, while a template renders, the template line.
+``Audit`` groups a request's queries by fingerprint. One issued
+QUERY_AUDIT_REPEAT_THRESHOLD times or more is an N+1, reported with the
+call sites behind it; the same statement run twice with the same values
+is a duplicate; anything over QUERY_AUDIT_SLOW_MS is slow.
+
+AuditClient is a test Client that attaches an Audit to every response as
+``response.query_audit``; in strict mode it raises QueryBudgetExceeded
+when a request goes over its query budget or has an N+1. The
+audit_queries command runs every route in core.benchmarks.ROUTES through
+it against the budget declared there, and QueryAuditMiddleware logs the
+findings of each request on the development server.
+"""
+import logging
+import os
+import re
+import sys
+import time
+from collections import Counter, defaultdict, namedtuple
+from contextlib import ExitStack, contextmanager
+
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+from django.db import connections
+from django.template.base import TokenType
+from django.test import Client
+
+from . import instrumentation
+
+logger = logging.getLogger(__name__)
+
+Query = namedtuple('Query', 'sql fingerprint params seconds stack')
+
+STRING = re.compile(r"'(?:[^']|'')*'")
+NUMBER = re.compile(r'(?<![\w".])-?\d+(?:\.\d+)?\b')
+PLACEHOLDER_LIST = re.compile(r'\(\s*\?(?:\s*,\s*\?)+\s*\)')
+# Frames worth showing: the project's own, minus the execute wrappers
+PROJECT_ROOT = settings.BASE_DIR + os.sep
+WRAPPERS = {__file__, instrumentation.__file__}
+STACK_DEPTH = 5
+
+
+class QueryBudgetExceeded(AssertionError):
+    pass
+
+
+def is_transaction_control(sql):
+    return sql == 'BEGIN' or 'SAVEPOINT' in sql
+
+
+def fingerprint(sql):
+    """``sql`` with its values replaced by ``?``, so the statements of a
+    loop all get the same fingerprint whatever they look up."""
+    sql = STRING.sub('?', sql)
+    sql = NUMBER.sub('?', sql.replace('%s', '?'))
+    sql = PLACEHOLDER_LIST.sub('(...)', sql)
+    return ' '.join(sql.split())
+
+
+def template_line(frame):
+    node = frame.f_locals.get('self')
+    token = getattr(node, 'token', None)
+    origin = getattr(node, 'origin', None)
+    if token is None or origin is None:
+        return None
+    if token.token_type == TokenType.BLOCK:
+        source = f'{{% {token.contents} %}}'
+    else:
+        source = f'{{{{ {token.contents} }}}}'
+    return f'{origin.template_name or origin.name}:{token.lineno} {source}'
+
+
+def callsite():
+    """The innermost project frames, and the template node being rendered
+    if any, innermost first."""
+    stack = []
+    template = None
+    frame = sys._getframe(2)
+    while frame is not None and len(stack) < STACK_DEPTH:
+        code = frame.f_code
+        filename = code.co_filename
+        if template is None and code.co_name == 'render_annotated':
+            template = template_line(frame)
+        elif (filename.startswith(PROJECT_ROOT) and filename not in WRAPPERS
+              and 'site-packages' not in filename):
+            stack.append(f'{os.path.relpath(filename, settings.BASE_DIR)}:'
+                         f'{frame.f_lineno} in {code.co_name}')
+        frame = frame.f_back
+    if template:
+        stack.insert(0, template)
+    return tuple(stack)
+
+
+class Recorder:
+    def __init__(self):
+        self.queries = []
+
+    def __call__(self, execute, sql, params, many, context):
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            elapsed = time.perf_counter() - start
+            self.queries.append(Query(sql, fingerprint(sql), params, elapsed, callsite()))
+
+
+@contextmanager
+def record():
+    recorder = Recorder()
+    with ExitStack() as stack:
+        for alias in connections:
+            stack.enter_context(connections[alias].execute_wrapper(recorder))
+        yield recorder
+
+
+def freeze(params):
+    if isinstance(params, (list, tuple)):
+        return tuple(freeze(param) for param in params)
+    if isinstance(params, dict):
+        return tuple(sorted((key, freeze(value)) for key, value in params.items()))
+    return params
+
+
+class Audit:
+    def __init__(self, queries, budget=None):
+        self.queries = [query for query in queries if not is_transaction_control(query.sql)]
+        self.budget = budget
+        groups = defaultdict(list)
+        for query in self.queries:
+            groups[query.fingerprint].append(query)
+        threshold = settings.QUERY_AUDIT_REPEAT_THRESHOLD
+        self.repeated = [group for group in groups.values() if len(group) >= threshold]
+        self.duplicates = []
+        for group in groups.values():
+            if len(group) >= threshold:
+                continue
+            same = Counter((query.sql, freeze(query.params)) for query in group)
+            if any(count > 1 for count in same.values()):
+                self.duplicates.append(group)
+        self.slow = [query for query in self.queries
+                     if query.seconds * 1000 >= settings.QUERY_AUDIT_SLOW_MS]
+
+    @property
+    def over_budget(self):
+        return self.budget is not None and len(self.queries) > self.budget
+
+    def problems(self):
+        """What strict mode fails on, as readable strings."""
+        problems = []
+        if self.over_budget:
+            problems.append(f'{len(self.queries)} queries, budget {self.budget}')
+        for group in self.repeated:
+            problems.append(f'N+1: {len(group)}x {group[0].fingerprint}\n'
+                            + describe_callsites(group))
+        return problems
+
+    def as_dict(self):
+        def summary(group):
+            return {'fingerprint': group[0].fingerprint,
+                    'count': len(group),
+                    'ms': round(sum(query.seconds for query in group) * 1000, 3),
+                    'callsites': [{'count': count, 'stack': list(stack)}
+                                  for stack, count in Counter(
+                                      query.stack for query in group).most_common()]}
+
+        return {'queries': len(self.queries),
+                'query_budget': self.budget,
+                'over_budget': self.over_budget,
+                'ms': round(sum(query.seconds for query in self.queries) * 1000, 3),
+                'n_plus_one': [summary(group) for group in self.repeated],
+                'duplicates': [summary(group) for group in self.duplicates],
+                'slow': [{'sql': query.sql, 'ms': round(query.seconds * 1000, 3),
+                          'stack': list(query.stack)} for query in self.slow]}
+
+
+def describe_callsites(group):
+    lines = []
+    for stack, count in Counter(query.stack for query in group).most_common():
+        lines.append(f'  {count}x from:')
+        lines.extend(f'    {frame}' for frame in stack or ('(no project frames)',))
+    return '\n'.join(lines)
+
+
+class AuditClient(Client):
+    """A test Client that audits the queries of each request.
+
+    Set ``query_budget`` before a request to check it against a budget;
+    with ``strict`` (QUERY_AUDIT_STRICT by default) problems raise instead
+    of only being reported on ``response.query_audit``.
+    """
+
+    def __init__(self, *args, strict=None, query_budget=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.strict = settings.QUERY_AUDIT_STRICT if strict is None else strict
+        self.query_budget = query_budget
+
+    def request(self, **request):
+        with record() as recorder:
+            response = super().request(**request)
+        response.query_audit = Audit(recorder.queries, self.query_budget)
+        problems = response.query_audit.problems()
+        if self.strict and problems:
+            raise QueryBudgetExceeded(
+                f"{request['REQUEST_METHOD']} {request['PATH_INFO']}: " + '\n'.join(problems))
+        return response
+
+
+class QueryAuditMiddleware:
+    """Logs each request's N+1s, duplicates and slow queries. For the
+    development server only: recording the stacks is far from free, so it
+    steps aside when DEBUG is off, as in the tests and benchmarks."""
+
+    def __init__(self, get_response):
+        if not settings.DEBUG:
+            raise MiddlewareNotUsed
+        self.get_response = get_response
+
+    def __call__(self, request):
+        with record() as recorder:
+            response = self.get_response(request)
+        audit = Audit(recorder.queries)
+        for group in audit.repeated:
+            logger.warning('N+1 on %s: %dx %s\n%s', request.path, len(group),
+                           group[0].fingerprint, describe_callsites(group))
+        for group in audit.duplicates:
+            logger.warning('Duplicate query on %s: %s\n%s', request.path,
+                           group[0].fingerprint, describe_callsites(group))
+        for query in audit.slow:
+            logger.warning('Slow query on %s (%.1f ms): %s', request.path,
+                           query.seconds * 1000, query.sql)
+        return response
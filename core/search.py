@@ -0,0 +1,426 @@
+"""Product search over Item.title/description.
+
+Two backends, picked by settings.SEARCH_BACKEND:
+
+``memory``
+    A per-process inverted index with prefix matching, built on first use
+    and kept current by Item signals. Other processes' edits are noticed
+    through the catalog version stamp and trigger a rebuild, which runs
+    beside the searches still served by the old index until it is done.
+``database``
+    SQLite FTS5 or a Postgres tsvector column with a GIN index, kept
+    current by database triggers, for catalogs too big to hold in memory.
+    The Postgres column comes from migration 0020; the SQLite table is
+    (re)created after every migrate, as SQLite drops its triggers.
+
+Both filter on category, label and effective price and return facet
+counts for category and label.
+"""
+import heapq
+import itertools
+import math
+import re
+import threading
+from bisect import bisect_left, bisect_right, insort
+from collections import Counter, namedtuple
+
+from django.conf import settings
+from django.db import connection
+from django.db.models import Count
+from django.db.models.signals import post_delete, post_save
+
+from .cache import get_catalog_version
+from .models import Item
+
+TOKEN_RE = re.compile(r'\w+')
+TITLE_WEIGHT = 3
+
+SearchResults = namedtuple('SearchResults', 'items total facets')
+Document = namedtuple('Document', 'category label price tokens')
+
+
+def tokenize(text):
+    return TOKEN_RE.findall(text.lower())
+
+
+def effective_price(price, discount_price):
+    return discount_price if discount_price else price
+
+
+def label_facets(field, counts):
+    names = dict(Item._meta.get_field(field).choices)
+    return [(value, names.get(value, value), counts[value])
+            for value in sorted(counts, key=lambda value: (-counts[value], value))]
+
+
+class MemoryBackend:
+    """Posting lists per token plus id sets per facet value and a price-
+    sorted id list, so filtering and facet counts are set operations."""
+    name = 'memory'
+    fields = ('id', 'title', 'description', 'category', 'label', 'price',
+              'discount_price')
+
+    # Everything build() replaces in one swap
+    index_attributes = ('postings', 'vocabulary', 'ranked', 'documents', 'facets',
+                        'price_keys', 'price_ids', 'prices')
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        # Held by the one thread rebuilding, so others do not start another
+        self._build_lock = threading.Lock()
+        self.version = None
+        self._reset()
+
+    def _reset(self):
+        self.postings = {}
+        self.vocabulary = []
+        self.ranked = {}
+        self.documents = {}
+        self.facets = {'category': {}, 'label': {}}
+        self.price_keys = []
+        self.price_ids = []
+        self.prices = {}
+
+    @property
+    def built(self):
+        return self.version is not None
+
+    def rows(self):
+        return sorted(Item.objects.values_list(*self.fields).iterator(chunk_size=2000),
+                      key=lambda row: (effective_price(row[5], row[6]), row[0]))
+
+    def build(self):
+        """Index the catalog into fresh structures, then swap them in.
+
+        Searches keep using the current index meanwhile, as the lock is
+        only held for the swap. The version is read first: an edit made
+        while the rows are read leaves the new index stale, not wrong.
+        """
+        version = get_catalog_version()
+        fresh = MemoryBackend()
+        for row in self.rows():
+            fresh._add(*row)
+        fresh.vocabulary = sorted(fresh.postings)
+        with self._lock:
+            for name in self.index_attributes:
+                setattr(self, name, getattr(fresh, name))
+            self.version = version
+
+    def _add(self, item_id, title, description, category, label, price,
+             discount_price):
+        weights = Counter()
+        for token in tokenize(title):
+            weights[token] += TITLE_WEIGHT
+        for token in tokenize(description):
+            weights[token] += 1
+        for token, weight in weights.items():
+            if token not in self.postings:
+                self.postings[token] = {}
+                if self.built:
+                    insort(self.vocabulary, token)
+            self.postings[token][item_id] = weight
+            self.ranked.pop(token, None)
+        self.facets['category'].setdefault(category, set()).add(item_id)
+        self.facets['label'].setdefault(label, set()).add(item_id)
+        price = self.prices[item_id] = effective_price(price, discount_price)
+        if self.built:
+            position = bisect_left(self.price_keys, (price, item_id))
+            self.price_keys.insert(position, (price, item_id))
+            self.price_ids.insert(position, item_id)
+        else:
+            # build() feeds rows in price order
+            self.price_keys.append((price, item_id))
+            self.price_ids.append(item_id)
+        self.documents[item_id] = Document(category, label, price, tuple(weights))
+
+    def _remove(self, item_id):
+        document = self.documents.pop(item_id, None)
+        if document is None:
+            return
+        for token in document.tokens:
+            self.ranked.pop(token, None)
+            postings = self.postings[token]
+            del postings[item_id]
+            if not postings:
+                del self.postings[token]
+                del self.vocabulary[bisect_left(self.vocabulary, token)]
+        self.facets['category'][document.category].discard(item_id)
+        self.facets['label'][document.label].discard(item_id)
+        position = bisect_left(self.price_keys, (document.price, item_id))
+        del self.price_keys[position]
+        del self.price_ids[position]
+        del self.prices[item_id]
+
+    def update(self, item):
+        with self._lock:
+            if not self.built:
+                return
+            self._remove(item.pk)
+            self._add(*(getattr(item, field) for field in self.fields))
+            self.version = get_catalog_version()
+
+    def delete(self, item_id):
+        with self._lock:
+            if not self.built:
+                return
+            self._remove(item_id)
+            self.version = get_catalog_version()
+
+    def ensure_fresh(self):
+        version = get_catalog_version()
+        if self.version == version:
+            return
+        if not self.built:
+            # Nothing to serve until the first build is done
+            with self._build_lock:
+                if not self.built:
+                    self.build()
+            return
+        # A stale index keeps answering while one thread rebuilds
+        if self._build_lock.acquire(blocking=False):
+            try:
+                if self.version != get_catalog_version():
+                    self.build()
+            finally:
+                self._build_lock.release()
+
+    def _expand(self, token):
+        start = bisect_left(self.vocabulary, token)
+        for word in self.vocabulary[start:]:
+            if not word.startswith(token):
+                break
+            yield word
+
+    def _ranking(self, word):
+        """Ids in ``word``'s posting list, best first; cached until it changes."""
+        ranked = self.ranked.get(word)
+        if ranked is None:
+            postings = self.postings[word]
+            ranked = self.ranked[word] = sorted(
+                postings, key=lambda item_id: (-postings[item_id], item_id))
+        return ranked
+
+    def _score(self, tokens):
+        """Return (scores, ranked ids or None)."""
+        expanded = [list(self._expand(token)) for token in tokens]
+        if len(tokens) == 1 and len(expanded[0]) == 1:
+            # One posting list: its weights already give the ranking
+            word = expanded[0][0]
+            return self.postings[word], self._ranking(word)
+        # Intersect id sets first so only the final matches get scored
+        matched = None
+        for words in expanded:
+            ids = set().union(*(self.postings[word].keys() for word in words))
+            matched = ids if matched is None else matched & ids
+            if not matched:
+                return {}, None
+        scores = dict.fromkeys(matched, 0)
+        for token, words in zip(tokens, expanded):
+            for word in words:
+                # Whole-word hits outrank prefix hits
+                boost = 2 if word == token else 1
+                postings = self.postings[word]
+                for item_id in matched & postings.keys():
+                    scores[item_id] += postings[item_id] * boost
+        return scores, None
+
+    def _within_price(self, candidates, min_price, max_price):
+        low = 0 if min_price is None else bisect_left(self.price_keys, (min_price,))
+        high = (len(self.price_keys) if max_price is None
+                else bisect_right(self.price_keys, (max_price, math.inf)))
+        # A Python-level check per candidate costs roughly ten times a C-level
+        # set insert, so only walk the candidates when they are much fewer
+        if candidates is not None and len(candidates) * 10 < high - low:
+            low = -math.inf if min_price is None else min_price
+            high = math.inf if max_price is None else max_price
+            prices = self.prices
+            return {item_id for item_id in candidates
+                    if low <= prices[item_id] <= high}
+        ids = set(self.price_ids[low:high])
+        return ids if candidates is None else ids & candidates
+
+    def search(self, query='', category=None, label=None, min_price=None,
+               max_price=None, limit=20, offset=0):
+        self.ensure_fresh()
+
+        def within(ids, base):
+            # ``None`` stands for every document
+            if base is None:
+                return ids
+            return base & ids if len(base) < len(ids) else ids & base
+
+        with self._lock:
+            tokens = tokenize(query)
+            scores, ranked = self._score(tokens) if tokens else (None, None)
+            candidates = None if scores is None else set(scores)
+            if min_price is not None or max_price is not None:
+                candidates = self._within_price(candidates, min_price, max_price)
+
+            # Each facet is counted with the other facet's filter applied
+            by_category, by_label = self.facets['category'], self.facets['label']
+            label_ok = (candidates if label is None
+                        else within(by_label.get(label, set()), candidates))
+            category_ok = (candidates if category is None
+                           else within(by_category.get(category, set()), candidates))
+            categories = Counter({value: len(within(ids, label_ok))
+                                  for value, ids in by_category.items()})
+            labels = Counter({value: len(within(ids, category_ok))
+                              for value, ids in by_label.items()})
+            if category is None:
+                matches = label_ok
+            else:
+                matches = within(by_category.get(category, set()), label_ok)
+            if matches is None:
+                matches = self.documents.keys()
+            total = len(matches)
+
+            wanted = offset + limit
+            if scores is None:
+                top = heapq.nsmallest(wanted, matches)
+            elif ranked is not None:
+                top = list(itertools.islice(
+                    (item_id for item_id in ranked if item_id in matches), wanted))
+            else:
+                # nlargest is stable, so ties keep id order
+                top = heapq.nlargest(wanted, sorted(matches),
+                                     key=scores.__getitem__)
+        page = top[offset:]
+        items = Item.objects.in_bulk(page)
+        return SearchResults([items[item_id] for item_id in page if item_id in items],
+                             total,
+                             {'category': label_facets('category', +categories),
+                              'label': label_facets('label', +labels)})
+
+
+SQLITE_SCHEMA = [
+    """CREATE VIRTUAL TABLE IF NOT EXISTS core_item_fts USING fts5(
+        title, description, content='core_item', content_rowid='id')""",
+    """CREATE TRIGGER IF NOT EXISTS core_item_fts_insert AFTER INSERT ON core_item BEGIN
+        INSERT INTO core_item_fts(rowid, title, description)
+        VALUES (new.id, new.title, new.description);
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS core_item_fts_delete AFTER DELETE ON core_item BEGIN
+        INSERT INTO core_item_fts(core_item_fts, rowid, title, description)
+        VALUES ('delete', old.id, old.title, old.description);
+    END""",
+    # Only on the indexed columns: stock and reservation updates of hot
+    # items must not rewrite their index rows. Dropped first so databases
+    # with the older catch-all trigger get this one
+    "DROP TRIGGER IF EXISTS core_item_fts_update",
+    """CREATE TRIGGER core_item_fts_update AFTER UPDATE OF title, description ON core_item
+    BEGIN
+        INSERT INTO core_item_fts(core_item_fts, rowid, title, description)
+        VALUES ('delete', old.id, old.title, old.description);
+        INSERT INTO core_item_fts(rowid, title, description)
+        VALUES (new.id, new.title, new.description);
+    END""",
+]
+
+class DatabaseBackend:
+    name = 'database'
+
+    def install(self, rebuild=False):
+        """Create the SQLite index table and triggers; safe to re-run.
+
+        Triggers are re-created on every migrate because SQLite drops them
+        whenever Django rebuilds core_item to alter a column. Postgres has
+        its column, trigger and index from migration 0020 already.
+        """
+        with connection.cursor() as cursor:
+            if connection.vendor == 'sqlite':
+                cursor.execute("SELECT 1 FROM sqlite_master WHERE name = 'core_item_fts'")
+                rebuild = rebuild or cursor.fetchone() is None
+                for statement in SQLITE_SCHEMA:
+                    cursor.execute(statement)
+                if rebuild:
+                    cursor.execute("INSERT INTO core_item_fts(core_item_fts) VALUES ('rebuild')")
+            elif connection.vendor == 'postgresql':
+                if rebuild:
+                    cursor.execute('UPDATE core_item SET title = title')
+            else:
+                raise NotImplementedError(
+                    f'No full-text search support for {connection.vendor}')
+
+    def build(self):
+        self.install(rebuild=True)
+
+    def match(self, queryset, tokens):
+        if connection.vendor == 'sqlite':
+            expression = ' '.join(f'"{token}"*' for token in tokens)
+            return queryset.extra(
+                tables=['core_item_fts'],
+                where=['core_item_fts.rowid = core_item.id',
+                       'core_item_fts MATCH %s'],
+                params=[expression],
+                select={'rank': 'bm25(core_item_fts, %s, 1.0)' % float(TITLE_WEIGHT)},
+            ).order_by('rank', 'id')
+        expression = ' & '.join(f'{token}:*' for token in tokens)
+        return queryset.extra(
+            where=["search_vector @@ to_tsquery('simple', %s)"],
+            params=[expression],
+            select={'rank': "ts_rank(search_vector, to_tsquery('simple', %s))"},
+            select_params=[expression],
+        ).order_by('-rank', 'id')
+
+    def search(self, query='', category=None, label=None, min_price=None,
+               max_price=None, limit=20, offset=0):
+        queryset = Item.objects.annotate(effective_price=Item.price_expression())
+        if min_price is not None:
+            queryset = queryset.filter(effective_price__gte=min_price)
+        if max_price is not None:
+            queryset = queryset.filter(effective_price__lte=max_price)
+        tokens = tokenize(query)
+        if tokens:
+            queryset = self.match(queryset, tokens)
+        else:
+            queryset = queryset.order_by('id')
+
+        by_label = queryset if label is None else queryset.filter(label=label)
+        by_category = queryset if category is None else queryset.filter(category=category)
+        facets = {}
+        for field, base in (('category', by_label), ('label', by_category)):
+            counts = base.order_by().values(field).annotate(n=Count('id'))
+            facets[field] = label_facets(field, Counter(
+                {row[field]: row['n'] for row in counts}))
+        matches = by_label if category is None else by_label.filter(category=category)
+        return SearchResults(list(matches[offset:offset + limit]),
+                             matches.count(), facets)
+
+
+BACKENDS = {'memory': MemoryBackend, 'database': DatabaseBackend}
+_backend = None
+_backend_lock = threading.Lock()
+
+
+def get_backend():
+    global _backend
+    name = settings.SEARCH_BACKEND
+    if _backend is None or _backend.name != name:
+        with _backend_lock:
+            if _backend is None or _backend.name != name:
+                _backend = BACKENDS[name]()
+    return _backend
+
+
+def search(query='', **filters):
+    return get_backend().search(query, **filters)
+
+
+def item_saved_receiver(sender, instance, *args, **kwargs):
+    if isinstance(_backend, MemoryBackend):
+        _backend.update(instance)
+
+
+def item_deleted_receiver(sender, instance, *args, **kwargs):
+    if isinstance(_backend, MemoryBackend):
+        _backend.delete(instance.pk)
+
+
+def search_schema_receiver(sender, using='default', *args, **kwargs):
+    if (settings.SEARCH_BACKEND == 'database' and connection.alias == using
+            and connection.vendor == 'sqlite'):
+        DatabaseBackend().install()
+
+
+post_save.connect(item_saved_receiver, sender=Item)
+post_delete.connect(item_deleted_receiver, sender=Item)
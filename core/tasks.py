@@ -0,0 +1,66 @@
+"""A minimal in-process background job queue.
+
+Jobs run on a pool of ``settings.BACKGROUND_WORKERS`` threads, each with
+its own database connection, closed once the job is done. Nothing here
+persists them: jobs still queued or running when the process dies are
+lost, and their callers must notice that themselves (payment attempts
+expire after PAYMENT_ATTEMPT_TIMEOUT, see core/payments.py).
+
+With ``settings.BACKGROUND_TASKS_EAGER`` jobs run inline in the caller,
+which is what the tests use.
+"""
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait
+
+from django.conf import settings
+from django.db import connections
+
+logger = logging.getLogger(__name__)
+
+_executor = None
+_pending = set()
+_lock = threading.Lock()
+
+
+def get_executor():
+    global _executor
+    with _lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(
+                max_workers=settings.BACKGROUND_WORKERS,
+                thread_name_prefix='core-task')
+        return _executor
+
+
+def _run(func, args, kwargs):
+    try:
+        return func(*args, **kwargs)
+    except Exception:
+        logger.exception('Background job %s failed', func.__name__)
+        raise
+    finally:
+        connections.close_all()
+
+
+def _done(future):
+    with _lock:
+        _pending.discard(future)
+
+
+def enqueue(func, *args, **kwargs):
+    if settings.BACKGROUND_TASKS_EAGER:
+        func(*args, **kwargs)
+        return None
+    future = get_executor().submit(_run, func, args, kwargs)
+    with _lock:
+        _pending.add(future)
+    future.add_done_callback(_done)
+    return future
+
+
+def drain(timeout=None):
+    """Block until every job queued so far has finished."""
+    with _lock:
+        pending = list(_pending)
+    wait(pending, timeout=timeout)
@@ -0,0 +1,18 @@
+from django import template
+from django.conf import settings
+from django.templatetags.static import static
+from django.utils.html import format_html_join
+
+register = template.Library()
+
+TAGS = {'.css': '<link href="{}" rel="stylesheet" />',
+        '.js': '<script type="text/javascript" src="{}"></script>'}
+
+
+@register.simple_tag
+def bundle(name):
+    """The one tag for bundle ``name`` with STATIC_USE_BUNDLES on, or a tag
+    per source file without it."""
+    paths = [name] if settings.STATIC_USE_BUNDLES else settings.STATIC_BUNDLES[name]
+    tag = TAGS['.css' if name.endswith('.css') else '.js']
+    return format_html_join('\n    ', tag, ((static(path),) for path in paths))
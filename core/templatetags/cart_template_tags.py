@@ -1,12 +1,10 @@
 from django import template
-from core.models import Order
+from core.cache import get_cart_summary
 
 register = template.Library()
 
 @register.filter
 def cart_item_tag(user):
     if user.is_authenticated:
-        qs = Order.objects.filter(user=user, ordered=False)
-        if qs.exists():
-            return qs[0].items.count()
-    return 0
\ No newline at end of file
+        return get_cart_summary(user)['count']
+    return 0
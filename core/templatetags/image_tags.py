@@ -0,0 +1,25 @@
+from django import template
+
+from core import images
+
+register = template.Library()
+
+
+@register.simple_tag
+def srcset(item, format='webp'):
+    """The srcset of ``item``'s WebP derivatives, or of its JPEG/PNG ones
+    for any other ``format``."""
+    return images.srcset(item, format)
+
+
+@register.inclusion_tag('includes/responsive_image.html')
+def responsive_image(item, sizes='100vw', css_class='', alt=''):
+    """A <picture> offering WebP and the original's format at every
+    derivative width, falling back to a plain <img> of the original."""
+    return {'item': item,
+            'webp_srcset': images.srcset(item, images.WEBP),
+            'srcset': images.srcset(item, 'fallback'),
+            'src': images.fallback_url(item),
+            'sizes': sizes,
+            'css_class': css_class,
+            'alt': alt}
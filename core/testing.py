@@ -0,0 +1,192 @@
+"""Stand-ins used by the test-suite and the benchmark command."""
+import itertools
+import json
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qsl, urlsplit
+
+import stripe
+
+DECLINED_TOKEN = 'tok_chargeDeclined'
+
+
+class StripeObject(dict):
+    def __getattr__(self, name):
+        try:
+            return self[name]
+        except KeyError:
+            raise AttributeError(name)
+
+
+class FakeStripe:
+    """Drop-in for the parts of the ``stripe`` module PaymentView uses.
+
+    ``latency`` (seconds) is slept on every call to mimic the gateway
+    round-trip; each call is recorded in ``calls``. Charges honour
+    ``idempotency_key`` and ``DECLINED_TOKEN`` is declined like Stripe's
+    test token of the same name.
+    """
+    error = stripe.error
+
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.calls = []
+        self.customers = {}
+        self.charges = {}
+        self._ids = itertools.count(1)
+        self._lock = threading.Lock()
+        self.Customer = StripeObject(create=self.create_customer,
+                                     retrieve=self.retrieve_customer,
+                                     list_sources=self.list_sources)
+        self.Charge = StripeObject(create=self.create_charge)
+
+    def _call(self, name):
+        with self._lock:
+            self.calls.append(name)
+            next_id = next(self._ids)
+        if self.latency:
+            time.sleep(self.latency)
+        return next_id
+
+    def _customer(self, customer_id):
+        def create_source(source):
+            return self.add_source(customer_id, source)
+        return StripeObject(id=customer_id,
+                            sources=StripeObject(create=create_source))
+
+    def add_source(self, customer_id, source):
+        next_id = self._call('Customer.sources.create')
+        card = StripeObject(id=f'card_{next_id}', object='card', brand='Visa',
+                            last4='4242', exp_month=12, exp_year=2030)
+        self.customers.setdefault(customer_id, []).insert(0, card)
+        return card
+
+    def create_customer(self, email=None, source=None):
+        customer_id = f'cus_{self._call("Customer.create")}'
+        self.customers[customer_id] = []
+        if source:
+            self.add_source(customer_id, source)
+        return self._customer(customer_id)
+
+    def retrieve_customer(self, customer_id):
+        self._call('Customer.retrieve')
+        return self._customer(customer_id)
+
+    def list_sources(self, customer_id, limit=10, object=None):
+        self._call('Customer.list_sources')
+        return StripeObject(data=self.customers.get(customer_id, [])[:limit])
+
+    def create_charge(self, amount, currency, customer=None, source=None,
+                      idempotency_key=None):
+        next_id = self._call('Charge.create')
+        if source == DECLINED_TOKEN:
+            raise stripe.error.CardError('Your card was declined.', None,
+                                         'card_declined', http_status=402)
+        with self._lock:
+            if idempotency_key in self.charges:
+                return self.charges[idempotency_key]
+            charge = StripeObject(id=f'ch_{next_id}', object='charge',
+                                  amount=amount, currency=currency, paid=True)
+            if idempotency_key:
+                self.charges[idempotency_key] = charge
+        return charge
+
+
+class FakeStripeHandler(BaseHTTPRequestHandler):
+    """The Stripe REST endpoints behind FakeStripe's methods."""
+    routes = [
+        ('POST', re.compile(r'^/v1/customers$'), 'create_customer'),
+        ('GET', re.compile(r'^/v1/customers/(?P<customer_id>[^/]+)$'), 'retrieve_customer'),
+        ('POST', re.compile(r'^/v1/customers/(?P<customer_id>[^/]+)/sources$'), 'add_source'),
+        ('GET', re.compile(r'^/v1/customers/(?P<customer_id>[^/]+)/sources$'), 'list_sources'),
+        ('POST', re.compile(r'^/v1/charges$'), 'create_charge'),
+    ]
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        url = urlsplit(self.path)
+        self.dispatch('GET', url.path, dict(parse_qsl(url.query)))
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        self.dispatch('POST', self.path,
+                      dict(parse_qsl(self.rfile.read(length).decode())))
+
+    def dispatch(self, method, path, params):
+        for route_method, pattern, name in self.routes:
+            match = pattern.match(path)
+            if route_method == method and match:
+                break
+        else:
+            return self.respond(404, {'error': {'type': 'invalid_request_error',
+                                                'message': f'No such route {path}'}})
+        try:
+            body = getattr(self, name)(self.server.fake, params, **match.groupdict())
+        except stripe.error.CardError as e:
+            return self.respond(402, {'error': {'type': 'card_error', 'code': e.code,
+                                                'message': e.user_message}})
+        self.respond(200, body)
+
+    def respond(self, status, body):
+        payload = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def customer(self, fake, customer_id):
+        return {'id': customer_id, 'object': 'customer',
+                'sources': {'object': 'list', 'has_more': False,
+                            'data': fake.customers.get(customer_id, [])[:10],
+                            'url': f'/v1/customers/{customer_id}/sources'}}
+
+    def create_customer(self, fake, params):
+        customer = fake.create_customer(email=params.get('email'),
+                                        source=params.get('source'))
+        return self.customer(fake, customer.id)
+
+    def retrieve_customer(self, fake, params, customer_id):
+        fake.retrieve_customer(customer_id)
+        return self.customer(fake, customer_id)
+
+    def add_source(self, fake, params, customer_id):
+        return fake.add_source(customer_id, params['source'])
+
+    def list_sources(self, fake, params, customer_id):
+        cards = fake.list_sources(customer_id, limit=int(params.get('limit', 10)))
+        return {'object': 'list', 'data': cards['data'], 'has_more': False,
+                'url': f'/v1/customers/{customer_id}/sources'}
+
+    def create_charge(self, fake, params):
+        return fake.create_charge(
+            int(params['amount']), params['currency'],
+            customer=params.get('customer'), source=params.get('source'),
+            idempotency_key=self.headers.get('Idempotency-Key'))
+
+
+class FakeStripeServer:
+    """Serves a FakeStripe over HTTP on localhost and points the real
+    ``stripe`` library at it for the duration of a ``with`` block."""
+
+    def __init__(self, fake=None):
+        self.fake = fake or FakeStripe()
+
+    def __enter__(self):
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), FakeStripeHandler)
+        self.server.daemon_threads = True
+        self.server.fake = self.fake
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        self.old_api_base = stripe.api_base
+        stripe.api_base = f'http://127.0.0.1:{self.server.server_port}'
+        return self
+
+    def __exit__(self, *exc_info):
+        stripe.api_base = self.old_api_base
+        self.server.shutdown()
+        self.server.server_close()
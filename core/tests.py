@@ -1,3 +1,1745 @@
-from django.test import TestCase
+import csv
+import gzip
+import json
+import os
+import tempfile
+import threading
+import time
+from decimal import Decimal
+from io import BytesIO, StringIO
+from unittest import mock
 
-# Create your tests here.
+import stripe
+from PIL import Image
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.contrib.auth.models import AnonymousUser
+from django.core.cache import cache
+from django.core.files.base import ContentFile
+from django.contrib.staticfiles.storage import staticfiles_storage
+from django.core.files.storage import default_storage
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.db import IntegrityError, OperationalError, connection, transaction
+from django.template import Context, Template
+from django.http import Http404, HttpResponse
+from django.test import Client, RequestFactory, TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
+from django.utils.http import http_date
+
+from . import (assets, cart, checks, coupons, db, images, instrumentation, inventory, payments,
+               querycheck, search)
+from .benchmarks import (ROUTES, Dataset, audit_routes, find_regressions, is_transaction_control,
+                         run_benchmarks, seed_admin_orders)
+from .cache import (card_stats, cart_stats, catalog_stats, coupon_stats, get_cart_summary,
+                    product_stats)
+from .models import (Address, Coupon, CouponRedemption, Item, Order, OrderItem, Payment,
+                     PaymentAttempt, UserProfile)
+from .pagination import (CursorPaginator, EstimatedCountPaginator, InvalidCursor,
+                         encode_cursor)
+from .testing import DECLINED_TOKEN, FakeStripe, FakeStripeServer
+
+User = get_user_model()
+
+
+def make_item(slug, price=10.0, discount_price=None):
+    if discount_price is not None:
+        discount_price = Decimal(str(discount_price))
+    return Item.objects.create(
+        title=slug.title(), price=Decimal(str(price)), discount_price=discount_price,
+        category=Item.SHIRT, label=Item.PRIMARY, slug=slug,
+        description='A fine %s' % slug, image='sample.jpg')
+
+
+class OrderTotalsTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user('alice', 'alice@example.com', 'pw')
+        self.client.force_login(self.user)
+        self.shirt = make_item('shirt', price=20.0, discount_price=15.0)
+        self.jacket = make_item('jacket', price=50.0)
+
+    def get_order(self):
+        return Order.objects.get(user=self.user, ordered=False)
+
+    def test_cart_views_keep_totals_in_step(self):
+        self.client.get(reverse('core:add-product_url', args=['shirt']))
+        self.client.get(reverse('core:add-product_url', args=['shirt']))
+        self.client.get(reverse('core:add-product_url', args=['jacket']))
+        self.assertEqual(self.get_order().total, 80.0)
+
+        self.client.get(reverse('core:remove-single-product_url', args=['shirt']))
+        self.assertEqual(self.get_order().total, 65.0)
+
+        self.client.get(reverse('core:remove-product_url', args=['jacket']))
+        order = self.get_order()
+        self.assertEqual((order.subtotal, order.total), (15.0, 15.0))
+
+    def test_repricing_does_not_leave_totals_behind(self):
+        make_item('cap', price=10.0)
+        self.client.get(reverse('core:add-product_url', args=['cap']))
+        Item.objects.filter(slug='cap').update(price=5)
+        self.client.get(reverse('core:remove-product_url', args=['cap']))
+        self.client.get(reverse('core:add-product_url', args=['jacket']))
+        order = self.get_order()
+        self.assertEqual((order.subtotal, order.total), (50.0, 50.0))
+        Item.objects.filter(slug='jacket').update(price=40)
+        self.client.get(reverse('core:add-product_url', args=['jacket']))
+        self.client.get(reverse('core:remove-single-product_url', args=['jacket']))
+        self.assertEqual(self.get_order().total, 40.0)
+
+    def test_coupon_discount(self):
+        Coupon.objects.create(code='TEN', amount=10.0)
+        self.client.get(reverse('core:add-product_url', args=['jacket']))
+        self.client.post(reverse('core:add-coupon_url'), {'code': 'TEN'})
+        order = self.get_order()
+        self.assertEqual((order.discount, order.total), (10.0, 40.0))
+
+    def test_unknown_coupon_leaves_order_untouched(self):
+        self.client.get(reverse('core:add-product_url', args=['jacket']))
+        self.client.post(reverse('core:add-coupon_url'), {'code': 'NOPE'})
+        order = self.get_order()
+        self.assertIsNone(order.coupon)
+        self.assertEqual(order.total, 50.0)
+
+    def test_recalculate_command_repairs_drift(self):
+        self.client.get(reverse('core:add-product_url', args=['shirt']))
+        self.client.get(reverse('core:add-product_url', args=['jacket']))
+        Order.objects.update(subtotal=0, total=0)
+        call_command('recalculate_order_totals', stdout=StringIO())
+        self.assertEqual(self.get_order().total, 65.0)
+
+    def test_summary_query_count_is_independent_of_cart_size(self):
+        self.client.get(reverse('core:add-product_url', args=['shirt']))
+        with self.assertNumQueries(5):
+            self.client.get(reverse('core:order-summary_url'))
+        for n in range(10):
+            make_item('item-%d' % n)
+            self.client.get(reverse('core:add-product_url', args=['item-%d' % n]))
+        with self.assertNumQueries(5):
+            self.client.get(reverse('core:order-summary_url'))
+
+
+class CouponTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        coupon_stats.reset()
+        self.user = User.objects.create_user('erin', 'erin@example.com', 'pw')
+        self.jacket = make_item('jacket', price=50.0)
+        self.shirt = make_item('shirt', price=20.0)
+        cart.add_item(self.user, self.jacket)
+
+    def get_order(self):
+        return Order.objects.get(user=self.user, ordered=False)
+
+    def test_percent_discount_follows_subtotal(self):
+        Coupon.objects.create(code='TENPC', kind=Coupon.PERCENT, amount=Decimal('10'))
+        coupons.apply(self.user, 'TENPC')
+        order = self.get_order()
+        self.assertEqual((order.discount, order.total), (5, 45))
+        cart.add_item(self.user, self.shirt)
+        cart.add_item(self.user, self.shirt)
+        order = self.get_order()
+        self.assertEqual((order.subtotal, order.discount, order.total), (90, 9, 81))
+        cart.remove_item(self.user, self.jacket)
+        order = self.get_order()
+        self.assertEqual((order.discount, order.total), (4, 36))
+
+    def test_validity_window(self):
+        now = timezone.now()
+        Coupon.objects.create(code='OLD', amount=5, valid_until=now)
+        Coupon.objects.create(code='SOON', amount=5,
+                              valid_from=now + timezone.timedelta(days=1))
+        Coupon.objects.create(code='OFF', amount=5, active=False)
+        for code, message in [('OLD', 'expired'), ('SOON', 'not valid yet'),
+                              ('OFF', 'expired'), ('NOPE', 'does not exist')]:
+            with self.assertRaisesMessage(coupons.CouponError, message):
+                coupons.apply(self.user, code)
+        self.assertIsNone(self.get_order().coupon)
+
+    def test_lookups_are_cached_until_coupon_changes(self):
+        coupon = Coupon.objects.create(code='TEN', amount=10)
+        coupons.validate('TEN')
+        coupons.lookup('NOPE')
+        with self.assertNumQueries(0):
+            self.assertEqual(coupons.validate('TEN').amount, 10)
+            self.assertIsNone(coupons.lookup('NOPE'))
+        self.assertEqual(coupon_stats.as_dict()['hits'], 2)
+        coupon.amount = 15
+        coupon.save()
+        self.assertEqual(coupons.validate('TEN').amount, 15)
+
+    def test_global_cap(self):
+        Coupon.objects.create(code='ONCE', amount=5, max_uses=1)
+        coupons.apply(self.user, 'ONCE')
+        # Applying the same code again is a no-op, not a second use
+        coupons.apply(self.user, 'ONCE')
+        self.assertEqual(Coupon.objects.get(code='ONCE').times_used, 1)
+        other = User.objects.create_user('frank')
+        cart.add_item(other, self.shirt)
+        with self.assertRaisesMessage(coupons.CouponError, 'used up'):
+            coupons.apply(other, 'ONCE')
+
+    def test_per_user_cap_survives_checkout(self):
+        Coupon.objects.create(code='WELCOME', amount=5, max_uses_per_user=1)
+        coupons.apply(self.user, 'WELCOME')
+        order = self.get_order()
+        payments.finalize_order(order, self.user, 'ch_1', payments.snapshot_order(order))
+        cart.add_item(self.user, self.shirt)
+        with self.assertRaisesMessage(coupons.CouponError, 'already used'):
+            coupons.apply(self.user, 'WELCOME')
+        self.assertEqual(CouponRedemption.objects.get().order.ordered, True)
+
+    def test_swapping_or_purging_frees_the_use(self):
+        Coupon.objects.create(code='A', amount=5, max_uses=1)
+        Coupon.objects.create(code='B', amount=8)
+        coupons.apply(self.user, 'A')
+        order = coupons.apply(self.user, 'B')
+        self.assertEqual((order.discount, order.total), (8, 42))
+        self.assertEqual(dict(Coupon.objects.values_list('code', 'times_used')),
+                         {'A': 0, 'B': 1})
+        Order.objects.filter(pk=order.pk).update(
+            updated_at=timezone.now() - timezone.timedelta(days=45))
+        call_command('purge_carts', stdout=StringIO())
+        self.assertEqual(Coupon.objects.get(code='B').times_used, 0)
+        self.assertFalse(CouponRedemption.objects.exists())
+
+    def test_add_coupon_view(self):
+        self.client.force_login(self.user)
+        Coupon.objects.create(code='OLD', amount=5, valid_until=timezone.now())
+        response = self.client.post(reverse('core:add-coupon_url'), {'code': 'OLD'},
+                                    follow=True)
+        self.assertRedirects(response, reverse('core:checkout_url'))
+        self.assertContains(response, 'This coupon has expired')
+
+
+class CartSummaryCacheTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        cart_stats.reset()
+        self.user = User.objects.create_user('bob', 'bob@example.com', 'pw')
+        self.client.force_login(self.user)
+        make_item('shirt', price=20.0)
+
+    def render_badge(self):
+        template = Template('{% load cart_template_tags %}{{ user|cart_item_tag }}')
+        return template.render(Context({'user': self.user}))
+
+    def test_badge_is_free_on_cache_hit(self):
+        self.assertEqual(self.render_badge(), '0')
+        with self.assertNumQueries(0):
+            self.assertEqual(self.render_badge(), '0')
+        self.assertEqual(cart_stats.as_dict()['hits'], 1)
+        self.assertEqual(cart_stats.as_dict()['misses'], 1)
+
+    def test_cart_views_invalidate_summary(self):
+        self.assertEqual(get_cart_summary(self.user)['count'], 0)
+        self.client.get(reverse('core:add-product_url', args=['shirt']))
+        self.assertEqual(get_cart_summary(self.user), {'count': 1, 'total': 20.0})
+        self.client.get(reverse('core:remove-product_url', args=['shirt']))
+        self.assertEqual(get_cart_summary(self.user)['count'], 0)
+
+    def test_deploy_check_wants_a_shared_cache(self):
+        self.assertEqual([error.id for error in checks.check_shared_cache(None)], ['core.E001'])
+        with override_settings(DEBUG=True):
+            self.assertEqual(checks.check_shared_cache(None), [])
+        shared = {'default': {'BACKEND': 'django.core.cache.backends.memcached.MemcachedCache'}}
+        with override_settings(CACHES=shared):
+            self.assertEqual(checks.check_shared_cache(None), [])
+
+    def test_anonymous_badge_skips_cache(self):
+        template = Template('{% load cart_template_tags %}{{ user|cart_item_tag }}')
+        with self.assertNumQueries(0):
+            self.assertEqual(template.render(Context({'user': AnonymousUser()})), '0')
+        self.assertEqual(cart_stats.as_dict()['misses'], 0)
+
+
+class CartServiceTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user('carol', 'carol@example.com', 'pw')
+        self.shirt = make_item('shirt', price=20.0)
+
+    def test_repeat_add_query_count(self):
+        cart.add_item(self.user, self.shirt)
+        # Three UPDATEs, wrapped in the test transaction's savepoint
+        with self.assertNumQueries(5):
+            self.assertEqual(cart.add_item(self.user, self.shirt), cart.UPDATED)
+        order = Order.objects.get(user=self.user, ordered=False)
+        self.assertEqual(order.items.get().quantity, 2)
+        self.assertEqual(order.total, 40.0)
+
+    def test_decrement_and_remove(self):
+        self.assertEqual(cart.decrement_item(self.user, self.shirt), cart.NO_ORDER)
+        cart.add_item(self.user, self.shirt)
+        cart.add_item(self.user, self.shirt)
+        self.assertEqual(cart.decrement_item(self.user, self.shirt), cart.UPDATED)
+        self.assertEqual(cart.decrement_item(self.user, self.shirt), cart.REMOVED)
+        self.assertEqual(cart.remove_item(self.user, self.shirt), cart.NOT_IN_CART)
+        self.assertFalse(OrderItem.objects.exists())
+        self.assertEqual(Order.objects.get(user=self.user).total, 0)
+
+    def test_one_open_order_per_user(self):
+        cart.add_item(self.user, self.shirt)
+        with self.assertRaises(IntegrityError), transaction.atomic():
+            Order.objects.create(user=self.user, ordered_date=timezone.now())
+
+
+class PurgeCartsTests(TestCase):
+    def setUp(self):
+        self.item = make_item('shirt', price=20.0)
+        self.users = [User.objects.create_user(name) for name in ('old', 'fresh', 'paid')]
+        for user in self.users:
+            cart.add_item(user, self.item)
+            cart.add_item(user, make_item('cap-%s' % user.username, price=5.0))
+        long_ago = timezone.now() - timezone.timedelta(days=45)
+        Order.objects.filter(user=self.users[0]).update(updated_at=long_ago)
+        paid = Order.objects.get(user=self.users[2])
+        payments.finalize_order(paid, self.users[2], 'ch_1', payments.snapshot_order(paid))
+        Order.objects.filter(pk=paid.pk).update(updated_at=long_ago)
+        # Left behind by older cart code that only unlinked removed lines
+        for _ in range(3):
+            OrderItem.objects.create(user=self.users[1], item=self.item)
+
+    def purge(self, *args):
+        out = StringIO()
+        call_command('purge_carts', '--batch-size', '2', *args, stdout=out)
+        return out.getvalue()
+
+    def test_dry_run_only_counts(self):
+        self.assertIn('Would delete 1 carts older than 30 days with 2 lines, '
+                      'and 3 orphaned lines', self.purge('--dry-run'))
+        self.assertEqual(OrderItem.objects.count(), 9)
+
+    def test_purges_abandoned_carts_and_orphans_only(self):
+        get_cart_summary(self.users[0])
+        self.assertIn('Deleted 1 carts older than 30 days with 2 lines, '
+                      'and 3 orphaned lines in 3 batches', self.purge())
+        self.assertEqual(sorted(Order.objects.values_list('user__username', flat=True)),
+                         ['fresh', 'paid'])
+        self.assertEqual(OrderItem.objects.filter(user=self.users[1]).count(), 2)
+        self.assertEqual(OrderItem.objects.filter(user=self.users[2], ordered=True).count(), 2)
+        self.assertEqual(get_cart_summary(self.users[0])['count'], 0)
+        self.assertIn('Deleted 0 carts', self.purge('--days', '60'))
+        cart.add_item(self.users[0], self.item)
+        self.assertEqual(Order.objects.get(user=self.users[0]).total, 20)
+
+
+class StockTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.alice, self.bob = [User.objects.create_user(name) for name in ('alice', 'bob')]
+        self.shirt = make_item('shirt', price=20.0)
+        self.shirt.stock = 2
+        self.shirt.save()
+
+    def stock(self):
+        return tuple(Item.objects.values_list('stock', 'reserved').get(pk=self.shirt.pk))
+
+    def lapse_holds(self):
+        OrderItem.objects.filter(reserved_until__isnull=False).update(
+            reserved_until=timezone.now() - timezone.timedelta(minutes=1))
+
+    def test_carts_hold_stock(self):
+        self.assertEqual(cart.add_item(self.alice, self.shirt), cart.ADDED)
+        self.assertEqual(cart.add_item(self.alice, self.shirt), cart.UPDATED)
+        self.assertEqual(cart.add_item(self.bob, self.shirt), cart.OUT_OF_STOCK)
+        self.assertFalse(Order.objects.filter(user=self.bob, total__gt=0).exists())
+        self.assertEqual(self.stock(), (2, 2))
+
+        cart.decrement_item(self.alice, self.shirt)
+        self.assertEqual(cart.add_item(self.bob, self.shirt), cart.ADDED)
+        cart.remove_item(self.bob, self.shirt)
+        self.assertEqual(self.stock(), (2, 1))
+
+    def test_lapsed_holds_are_handed_back(self):
+        cart.add_item(self.alice, self.shirt)
+        cart.add_item(self.alice, self.shirt)
+        self.lapse_holds()
+        self.assertEqual(cart.add_item(self.bob, self.shirt), cart.ADDED)
+        self.assertEqual(self.stock(), (2, 1))
+        self.assertIsNone(OrderItem.objects.get(user=self.alice).reserved_until)
+        # Alice's line has to hold all of its units again
+        self.assertEqual(cart.add_item(self.alice, self.shirt), cart.OUT_OF_STOCK)
+
+        self.lapse_holds()
+        out = StringIO()
+        call_command('release_stock_holds', stdout=out)
+        self.assertIn('Released 1 held units', out.getvalue())
+        self.assertEqual(self.stock(), (2, 0))
+
+    def test_checkout_takes_stock_held_or_not(self):
+        cart.add_item(self.alice, self.shirt)
+        cart.add_item(self.alice, self.shirt)
+        self.lapse_holds()
+        cart.add_item(self.bob, self.shirt)
+        bob_cart = Order.objects.get(user=self.bob)
+        claimed = inventory.claim(bob_cart)
+        self.assertEqual(claimed, [[self.shirt.pk, 1]])
+        self.assertEqual(self.stock(), (1, 0))
+        with self.assertRaisesMessage(inventory.OutOfStock, 'Shirt is sold out'):
+            inventory.claim(Order.objects.get(user=self.alice))
+        self.assertEqual(self.stock(), (1, 0))
+        inventory.restock(claimed)
+        self.assertEqual(self.stock(), (2, 0))
+
+    def test_payment_view_claims_and_gives_back(self):
+        stripe = FakeStripe()
+        patcher = mock.patch.object(payments, 'stripe', stripe)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.client.force_login(self.alice)
+        url = reverse('core:payment_url', args=['stripe'])
+        cart.add_item(self.alice, self.shirt)
+
+        self.client.post(url, {'stripeToken': DECLINED_TOKEN})
+        self.assertEqual(self.stock(), (2, 0))
+        self.client.post(url, {'stripeToken': 'tok_visa'})
+        self.assertTrue(Order.objects.get(user=self.alice).ordered)
+        self.assertEqual(self.stock(), (1, 0))
+
+        cart.add_item(self.bob, self.shirt)
+        # The last one goes to a sale taken off the books elsewhere
+        Item.objects.filter(pk=self.shirt.pk).update(stock=0, reserved=0)
+        self.client.force_login(self.bob)
+        response = self.client.post(url, {'stripeToken': 'tok_visa'}, follow=True)
+        self.assertContains(response, 'Shirt is sold out')
+        self.assertFalse(Order.objects.get(user=self.bob).ordered)
+        self.assertEqual(stripe.calls.count('Charge.create'), 2)
+
+    def test_cart_is_locked_during_a_sync_charge(self):
+        self.shirt.stock = 5
+        self.shirt.save()
+        self.client.force_login(self.alice)
+        url = reverse('core:payment_url', args=['stripe'])
+        cart.add_item(self.alice, self.shirt)
+        charge = payments.charge
+        added = []
+
+        def second_tab(user, *args, **kwargs):
+            added.append(cart.add_item(user, self.shirt))
+            return charge(user, *args, **kwargs)
+
+        with mock.patch.object(payments, 'stripe', FakeStripe()), \
+                mock.patch.object(payments, 'charge', second_tab):
+            self.client.post(url, {'stripeToken': DECLINED_TOKEN})
+            self.assertEqual(self.stock(), (5, 0))
+            self.client.post(url, {'stripeToken': 'tok_visa'})
+        self.assertEqual(added, [cart.PAYMENT_PENDING] * 2)
+        order = Order.objects.get(user=self.alice)
+        self.assertEqual((order.items.get().quantity, order.total, order.payment.amount),
+                         (1, Decimal('20.00'), Decimal('20.00')))
+        self.assertEqual(self.stock(), (4, 0))
+
+    @override_settings(PAYMENT_MODE='async', BACKGROUND_TASKS_EAGER=True)
+    def test_async_decline_gives_stock_back(self):
+        stripe = FakeStripe()
+        # TestCase never commits; run the job as autocommit would
+        with mock.patch.object(payments, 'stripe', stripe), \
+                mock.patch.object(transaction, 'on_commit', lambda func: func()):
+            cart.add_item(self.alice, self.shirt)
+            self.client.force_login(self.alice)
+            self.client.post(reverse('core:payment_url', args=['stripe']),
+                             {'stripeToken': DECLINED_TOKEN})
+        self.assertEqual(PaymentAttempt.objects.get().status, PaymentAttempt.FAILED)
+        self.assertEqual(self.stock(), (2, 0))
+
+    def test_purge_releases_holds(self):
+        cart.add_item(self.alice, self.shirt)
+        Order.objects.update(updated_at=timezone.now() - timezone.timedelta(days=45))
+        self.lapse_holds()
+        call_command('purge_carts', stdout=StringIO())
+        self.assertEqual(self.stock(), (2, 0))
+
+
+class ConcurrentCartTests(TransactionTestCase):
+    THREADS = 8
+    CLICKS = 5
+
+    def setUp(self):
+        self.user = User.objects.create_user('dave', 'dave@example.com', 'pw')
+        self.items = [make_item('shirt', price=20.0), make_item('cap', price=5.0)]
+
+    def hammer(self, barrier, errors):
+        try:
+            barrier.wait()
+            for n in range(self.CLICKS):
+                item = self.items[n % 2]
+                # SQLite reports lock contention instead of waiting; the
+                # whole transaction is rolled back, so a retry is safe
+                for attempt in range(200):
+                    try:
+                        cart.add_item(self.user, item)
+                        break
+                    except OperationalError:
+                        time.sleep(0.005)
+                else:
+                    raise AssertionError('cart stayed locked')
+        except Exception as e:
+            errors.append(e)
+        finally:
+            connection.close()
+
+    def test_concurrent_adds_lose_no_updates(self):
+        barrier = threading.Barrier(self.THREADS)
+        errors = []
+        threads = [threading.Thread(target=self.hammer, args=(barrier, errors))
+                   for _ in range(self.THREADS)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(errors, [])
+
+        order = Order.objects.get(user=self.user, ordered=False)
+        quantities = dict(order.items.values_list('item__slug', 'quantity'))
+        shirts = self.THREADS * ((self.CLICKS + 1) // 2)
+        caps = self.THREADS * (self.CLICKS // 2)
+        self.assertEqual(quantities, {'shirt': shirts, 'cap': caps})
+        self.assertEqual(order.total, shirts * 20.0 + caps * 5.0)
+        self.assertEqual(OrderItem.objects.count(), 2)
+
+
+class ConcurrentCouponTests(TransactionTestCase):
+    THREADS = 8
+    MAX_USES = 3
+
+    def setUp(self):
+        cache.clear()
+        item = make_item('shirt', price=20.0)
+        self.users = [User.objects.create_user('user%d' % n) for n in range(self.THREADS)]
+        for user in self.users:
+            cart.add_item(user, item)
+        Coupon.objects.create(code='FLASH', amount=5, max_uses=self.MAX_USES)
+
+    def redeem(self, user, barrier, results):
+        try:
+            barrier.wait()
+            for attempt in range(200):
+                try:
+                    coupons.apply(user, 'FLASH')
+                    results.append(True)
+                    break
+                except OperationalError:
+                    time.sleep(0.005)
+                except coupons.CouponError:
+                    results.append(False)
+                    break
+        finally:
+            connection.close()
+
+    def test_cap_holds_under_contention(self):
+        barrier = threading.Barrier(self.THREADS)
+        results = []
+        threads = [threading.Thread(target=self.redeem, args=(user, barrier, results))
+                   for user in self.users]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(sorted(results), [False] * (self.THREADS - self.MAX_USES) + [True] * self.MAX_USES)
+        self.assertEqual(Coupon.objects.get().times_used, self.MAX_USES)
+        self.assertEqual(CouponRedemption.objects.count(), self.MAX_USES)
+        self.assertEqual(Order.objects.filter(coupon__isnull=False).count(), self.MAX_USES)
+
+
+class ConcurrentStockTests(TransactionTestCase):
+    THREADS = 8
+    STOCK = 3
+
+    def setUp(self):
+        item = make_item('shirt', price=20.0)
+        Item.objects.filter(pk=item.pk).update(stock=self.STOCK)
+        # Carts whose holds have all lapsed, so every one races at checkout
+        self.carts = []
+        for n in range(self.THREADS):
+            user = User.objects.create_user('user%d' % n)
+            order = Order.objects.create(user=user, ordered_date=timezone.now())
+            order.items.add(OrderItem.objects.create(user=user, item=item))
+            self.carts.append(order)
+
+    def checkout(self, order, barrier, results):
+        try:
+            barrier.wait()
+            for attempt in range(200):
+                try:
+                    inventory.claim(order)
+                    results.append(True)
+                    break
+                except OperationalError:
+                    time.sleep(0.005)
+                except inventory.OutOfStock:
+                    results.append(False)
+                    break
+        finally:
+            connection.close()
+
+    def test_no_overselling(self):
+        barrier = threading.Barrier(self.THREADS)
+        results = []
+        threads = [threading.Thread(target=self.checkout, args=(order, barrier, results))
+                   for order in self.carts]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(sorted(results),
+                         [False] * (self.THREADS - self.STOCK) + [True] * self.STOCK)
+        self.assertEqual(Item.objects.get().stock, 0)
+
+
+class RouteBudgetTests(TestCase):
+    def test_every_route_within_query_budget(self):
+        dataset = Dataset(items=30, cart_size=5, history_users=2, orders_per_user=3)
+        report = run_benchmarks(dataset, repeat=1)
+        self.assertEqual(len(report['routes']), len(ROUTES))
+        for route in report['routes']:
+            self.assertLess(route['status'], 400, route['name'])
+        self.assertEqual(find_regressions(report), [])
+        json.dumps(report)
+
+    def test_no_route_has_an_n_plus_one(self):
+        dataset = Dataset(items=30, cart_size=5, history_users=2, orders_per_user=3)
+        report = audit_routes(dataset, strict=True)
+        self.assertEqual(report['problems'], [])
+        self.assertEqual(len(report['routes']), len(ROUTES))
+
+    def test_baseline_comparison(self):
+        route = {'name': 'home', 'queries': 2, 'query_budget': 2,
+                 'wall_ms': 30.0, 'peak_kb': 100.0}
+        baseline = {'routes': [dict(route, wall_ms=10.0)]}
+        self.assertEqual(find_regressions({'routes': [route]}, baseline),
+                         ['home: wall_ms 30.0 vs 10.0 in baseline'])
+
+
+
+@override_settings(BACKGROUND_TASKS_EAGER=True)
+class PaymentTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user('alice', 'alice@example.com', 'pw')
+        self.client.force_login(self.user)
+        make_item('jacket', price=50.0)
+        self.client.get(reverse('core:add-product_url', args=['jacket']))
+        address = Address.objects.create(
+            user=self.user, street_address='1 Main St', apartment_address='',
+            country='US', zip='10001', address_type='B', default=True)
+        Order.objects.filter(user=self.user).update(billing_address=address)
+        self.stripe = FakeStripe()
+        patcher = mock.patch.object(payments, 'stripe', self.stripe)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        # TestCase never commits; run jobs at once, as autocommit would
+        patcher = mock.patch.object(transaction, 'on_commit', lambda func: func())
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def pay(self, token='tok_visa', **data):
+        return self.client.post(reverse('core:payment_url', args=['stripe']),
+                                dict(data, stripeToken=token))
+
+    def test_sync_payment(self):
+        response = self.pay()
+        self.assertRedirects(response, '/', fetch_redirect_response=False)
+        order = Order.objects.get(user=self.user)
+        self.assertTrue(order.ordered)
+        self.assertEqual(order.payment.amount, 50.0)
+        self.assertEqual(PaymentAttempt.objects.get().payment, order.payment)
+
+    def test_stripe_time_is_reported(self):
+        self.stripe.latency = 0.01
+        response = self.pay()
+        stripe_ms = float(response['Server-Timing'].split('stripe;dur=')[1].split(',')[0])
+        self.assertGreaterEqual(stripe_ms, 10)
+
+    def test_sync_decline_keeps_cart_open(self):
+        self.pay(DECLINED_TOKEN)
+        self.assertFalse(Order.objects.get(user=self.user).ordered)
+        self.assertFalse(Payment.objects.exists())
+
+    @override_settings(PAYMENT_MODE='async')
+    def test_async_payment(self):
+        response = self.pay()
+        attempt = PaymentAttempt.objects.get()
+        self.assertRedirects(response, reverse('core:payment-status_url', args=[attempt.key]),
+                             fetch_redirect_response=False)
+        self.assertEqual(attempt.status, PaymentAttempt.SUCCEEDED)
+        self.assertEqual(attempt.payment.stripe_charge_id, 'ch_1')
+        self.assertTrue(Order.objects.get(user=self.user).ordered)
+        response = self.client.get(reverse('core:payment-status_url', args=[attempt.key]))
+        self.assertRedirects(response, '/', fetch_redirect_response=False)
+
+    @override_settings(PAYMENT_MODE='async')
+    def test_async_decline(self):
+        self.pay(DECLINED_TOKEN)
+        attempt = PaymentAttempt.objects.get()
+        self.assertEqual((attempt.status, attempt.error),
+                         (PaymentAttempt.FAILED, 'Your card was declined.'))
+        self.assertFalse(Order.objects.get(user=self.user).ordered)
+
+    @override_settings(PAYMENT_MODE='async')
+    def test_job_is_queued_once_the_attempt_is_committed(self):
+        with mock.patch.object(transaction, 'on_commit') as on_commit, \
+                mock.patch.object(payments.tasks, 'enqueue') as enqueue:
+            self.pay()
+            enqueue.assert_not_called()
+            on_commit.call_args[0][0]()
+        self.assertEqual(enqueue.call_args[0][1], PaymentAttempt.objects.get().pk)
+
+    @override_settings(PAYMENT_MODE='async')
+    def test_pending_attempt_completes_once(self):
+        with mock.patch.object(payments.tasks, 'enqueue') as enqueue:
+            self.pay()
+            self.pay()
+        attempt = PaymentAttempt.objects.get()
+        self.assertEqual(enqueue.call_count, 1)
+        response = self.client.get(reverse('core:payment-status_url', args=[attempt.key]))
+        self.assertContains(response, 'Processing your payment')
+
+        # A retried job re-sends the same idempotency key and finds the
+        # attempt already settled
+        for _ in range(2):
+            payments.process_payment(*enqueue.call_args[0][1:])
+        payments.complete_attempt(attempt.pk, 'ch_other')
+        self.assertEqual(self.stripe.calls.count('Charge.create'), 1)
+        self.assertEqual(Payment.objects.count(), 1)
+        self.assertEqual(Order.objects.get(user=self.user).payment.stripe_charge_id, 'ch_1')
+
+    @override_settings(PAYMENT_MODE='async')
+    def test_cart_is_locked_while_payment_is_pending(self):
+        make_item('cap', price=5.0)
+        Coupon.objects.create(code='TEN', amount=10.0)
+        with mock.patch.object(payments.tasks, 'enqueue'):
+            self.pay()
+        self.assertEqual(cart.add_item(self.user, Item.objects.get(slug='cap')),
+                         cart.PAYMENT_PENDING)
+        jacket = Item.objects.get(slug='jacket')
+        self.assertEqual(cart.decrement_item(self.user, jacket), cart.PAYMENT_PENDING)
+        self.assertEqual(cart.remove_item(self.user, jacket), cart.PAYMENT_PENDING)
+        with self.assertRaisesMessage(coupons.CouponError, 'being processed'):
+            coupons.apply(self.user, 'TEN')
+        response = self.client.get(reverse('core:add-product_url', args=['cap']))
+        self.assertRedirects(response, reverse('core:product_url', args=['cap']),
+                             fetch_redirect_response=False)
+        order = Order.objects.get(user=self.user)
+        self.assertEqual((order.items.count(), order.total, order.coupon), (1, 50.0, None))
+
+    @override_settings(PAYMENT_MODE='async')
+    def test_lost_attempt_expires(self):
+        with mock.patch.object(payments.tasks, 'enqueue') as enqueue:
+            self.pay()
+            lost = PaymentAttempt.objects.get()
+            PaymentAttempt.objects.update(created=timezone.now() - timezone.timedelta(
+                seconds=settings.PAYMENT_ATTEMPT_TIMEOUT + 1))
+            response = self.client.get(reverse('core:payment-status_url', args=[lost.key]))
+            self.assertRedirects(response, '/', fetch_redirect_response=False)
+            lost.refresh_from_db()
+            self.assertEqual((lost.status, lost.error),
+                             (PaymentAttempt.FAILED, payments.EXPIRED_ERROR))
+            self.assertEqual(cart.add_item(self.user, Item.objects.get(slug='jacket')),
+                             cart.UPDATED)
+            self.pay()
+        self.assertEqual(enqueue.call_count, 2)
+        attempt = PaymentAttempt.objects.get(status=PaymentAttempt.PENDING)
+        self.assertEqual(attempt.amount, 100.0)
+        # A submit finding an expired attempt in the way replaces it
+        PaymentAttempt.objects.filter(pk=attempt.pk).update(created=lost.created)
+        with mock.patch.object(payments.tasks, 'enqueue') as enqueue:
+            self.pay()
+        self.assertEqual(enqueue.call_count, 1)
+        self.assertEqual(PaymentAttempt.objects.filter(status=PaymentAttempt.PENDING).count(), 1)
+        # The lost job charging after all is flagged, not ordered
+        with self.assertLogs('core.payments', 'ERROR'):
+            payments.complete_attempt(lost.pk, 'ch_late')
+        self.assertFalse(Order.objects.get(user=self.user).ordered)
+
+    def test_charge_and_lines_come_from_the_same_snapshot(self):
+        Item.objects.filter(slug='jacket').update(price=45)
+        charge = payments.charge
+        charged = []
+
+        def reprice_then_charge(user, amount, *args, **kwargs):
+            charged.append(amount)
+            Item.objects.filter(slug='jacket').update(price=60)
+            return charge(user, amount, *args, **kwargs)
+
+        with mock.patch.object(payments, 'charge', reprice_then_charge):
+            self.pay()
+        order = Order.objects.get(user=self.user)
+        self.assertTrue(order.ordered)
+        self.assertEqual(charged, [Decimal('45.00')])
+        self.assertEqual((order.total, order.payment.amount, order.items.get().get_total_price()),
+                         (Decimal('45.00'),) * 3)
+
+    def test_failed_payment_releases_the_snapshot(self):
+        Item.objects.filter(slug='jacket').update(price=45)
+        self.pay(DECLINED_TOKEN)
+        Item.objects.filter(slug='jacket').update(price=40)
+        line = OrderItem.objects.get()
+        self.assertEqual((line.unit_price, line.get_unit_price()), (None, Decimal('40.00')))
+        self.assertEqual(Order.objects.get(user=self.user).total, 45.0)
+
+    def test_finalize_order_is_constant_and_snapshots_prices(self):
+        order = Order.objects.get(user=self.user)
+        for n in range(20):
+            line = OrderItem.objects.create(
+                user=self.user, item=make_item('extra-%d' % n, price=2.0, discount_price=1.5))
+            order.items.add(line)
+        amount = payments.snapshot_order(order)
+        self.assertEqual(amount, Decimal('80.00'))
+        with CaptureQueriesContext(connection) as queries:
+            payments.finalize_order(order, self.user, 'ch_1', amount)
+        self.assertEqual(sum(1 for query in queries.captured_queries
+                             if not is_transaction_control(query['sql'])), 3)
+        self.assertFalse(OrderItem.objects.filter(ordered=False).exists())
+        Item.objects.update(title='Renamed', price=99, discount_price=None)
+        lines = OrderItem.objects.filter(item__slug='extra-0')
+        with self.assertNumQueries(1):
+            line = lines.get()
+            self.assertEqual((line.get_title(), line.get_unit_price(),
+                              line.get_amount_saved()),
+                             ('Extra-0', Decimal('1.50'), Decimal('0.50')))
+        prices = sorted(line.get_total_price() for line in order.items.all())
+        self.assertEqual(prices, [Decimal('1.50')] * 20 + [Decimal('50.00')])
+        order.refresh_from_db()
+        self.assertTrue(order.ordered and order.ref_code)
+        self.assertEqual(order.payment.amount, 80.0)
+
+    def test_against_fake_stripe_server(self):
+        fake = FakeStripe()
+        # The real stripe library, talking HTTP to a local server
+        with mock.patch.object(payments, 'stripe', stripe), FakeStripeServer(fake):
+            self.pay(save='on')
+            self.assertTrue(Order.objects.get(user=self.user).ordered)
+            self.client.get(reverse('core:add-product_url', args=['jacket']))
+            Order.objects.filter(user=self.user, ordered=False).update(
+                billing_address=Address.objects.get())
+            response = self.client.get(reverse('core:payment_url', args=['stripe']))
+        self.assertEqual(response.context['card']['last4'], '4242')
+        self.assertEqual(fake.calls, ['Customer.create', 'Customer.sources.create',
+                                      'Charge.create', 'Customer.list_sources'])
+
+
+
+class OrderHistoryTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user('alice', 'alice@example.com', 'pw')
+        self.client.force_login(self.user)
+        self.items = [make_item('item-%d' % n, price=n + 1) for n in range(5)]
+
+    def place_orders(self, user, count, lines):
+        for n in range(count):
+            order = Order.objects.create(user=user, ordered_date=timezone.now())
+            for item in self.items[:lines]:
+                order.items.add(OrderItem.objects.create(user=user, item=item))
+            payments.finalize_order(order, user, 'ch_%d' % n, payments.snapshot_order(order))
+
+    def get_history(self, cursor=None):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(reverse('core:order-history_url'),
+                                       {'cursor': cursor} if cursor else {})
+        self.assertEqual(response.status_code, 200)
+        return response, len(queries)
+
+    def test_query_count_does_not_grow_with_history(self):
+        self.place_orders(self.user, 2, 1)
+        _, few = self.get_history()
+        self.place_orders(self.user, 30, 5)
+        response, many = self.get_history()
+        self.assertEqual(many, few)
+        self.assertEqual(len(response.context['orders']), 32)
+        self.assertContains(response, 'Item-4')
+
+    @override_settings(ORDER_HISTORY_PER_PAGE=3)
+    def test_pages_newest_first_and_only_own_orders(self):
+        self.place_orders(self.user, 7, 1)
+        self.place_orders(User.objects.create_user('bob'), 2, 1)
+        Order.objects.create(user=self.user, ordered_date=timezone.now())
+        seen, cursor = [], None
+        while True:
+            response, _ = self.get_history(cursor)
+            page = response.context['cursor_page']
+            seen += [order.pk for order in page]
+            if not page.has_next:
+                break
+            cursor = page.next_cursor
+        expected = Order.objects.filter(user=self.user, ordered=True)
+        self.assertEqual(seen, list(expected.order_by('-ordered_date', '-id')
+                                    .values_list('pk', flat=True)))
+
+    def test_invalid_cursor_is_404(self):
+        response = self.client.get(reverse('core:order-history_url'), {'cursor': 'nope'})
+        self.assertEqual(response.status_code, 404)
+
+
+class ApiTests(TestCase):
+    def setUp(self):
+        self.jacket = make_item('jacket', price=50.0, discount_price=40.0)
+        self.shirt = make_item('shirt', price=20.0)
+
+    def get_json(self, name, *args, data=None, **headers):
+        response = self.client.get(reverse(name, args=args), data, **headers)
+        body = b''.join(response.streaming_content) if response.streaming else response.content
+        return response, body and json.loads(body)
+
+    def test_item_detail_revalidates_without_rendering(self):
+        response, data = self.get_json('core:api-item_url', 'jacket')
+        self.assertEqual((data['title'], data['price'], data['discount_price']),
+                         ('Jacket', '50.00', '40.00'))
+        self.assertIn('max-age=', response['Cache-Control'])
+        etag = response['ETag']
+        with self.assertNumQueries(1):
+            response, _ = self.get_json('core:api-item_url', 'jacket',
+                                        HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response['ETag'], etag)
+        self.jacket.title = 'Rain Jacket'
+        self.jacket.save()
+        response, data = self.get_json('core:api-item_url', 'jacket',
+                                       HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual((response.status_code, data['title']), (200, 'Rain Jacket'))
+        self.assertEqual(self.get_json('core:api-item_url', 'nope')[0].status_code, 404)
+
+    @override_settings(API_CHUNK_SIZE=2)
+    def test_listing_streams_and_tracks_deletes(self):
+        make_item('cap', price=5.0)
+        response, data = self.get_json('core:api-items_url')
+        self.assertTrue(response.streaming)
+        self.assertEqual([row['slug'] for row in data], ['jacket', 'shirt', 'cap'])
+        self.assertEqual(data[0]['url'], self.jacket.get_absolute_url())
+        etag = response['ETag']
+        response, _ = self.get_json('core:api-items_url', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        Item.objects.filter(slug='cap').delete()
+        response, data = self.get_json('core:api-items_url', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(len(data), 2)
+        response, data = self.get_json('core:api-items_url', data={'category': 'OW'})
+        self.assertEqual(data, [])
+
+    def test_cart_is_private_and_follows_changes(self):
+        self.assertEqual(self.get_json('core:api-cart_url')[0].status_code, 401)
+        user = User.objects.create_user('alice', 'alice@example.com', 'pw')
+        self.client.force_login(user)
+        response, data = self.get_json('core:api-cart_url')
+        self.assertEqual(data['items'], [])
+        self.assertIn('private', response['Cache-Control'])
+        empty = response['ETag']
+        cart.add_item(user, self.jacket)
+        cart.add_item(user, self.jacket)
+        response, data = self.get_json('core:api-cart_url', HTTP_IF_NONE_MATCH=empty)
+        self.assertEqual(data['items'], [{'slug': 'jacket', 'title': 'Jacket', 'quantity': 2,
+                                          'unit_price': '40.00', 'total_price': '80.00'}])
+        self.assertEqual(data['total'], '80.00')
+        etag = response['ETag']
+        self.assertEqual(self.get_json('core:api-cart_url', HTTP_IF_NONE_MATCH=etag)[0]
+                         .status_code, 304)
+        self.jacket.discount_price = 35
+        self.jacket.save()
+        response, data = self.get_json('core:api-cart_url', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual((response.status_code, data['items'][0]['unit_price']),
+                         (200, '35.00'))
+        etag = response['ETag']
+        cart.decrement_item(user, self.jacket)
+        response, data = self.get_json('core:api-cart_url', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(data['total'], '35.00')
+
+        # A payment in flight shows the prices it is charging
+        payments.snapshot_order(Order.objects.get(user=user))
+        self.jacket.title = 'Rain Jacket'
+        self.jacket.discount_price = 30
+        self.jacket.save()
+        _, data = self.get_json('core:api-cart_url')
+        self.assertEqual(data['items'], [{'slug': 'jacket', 'title': 'Jacket', 'quantity': 1,
+                                          'unit_price': '35.00', 'total_price': '35.00'}])
+        self.assertEqual(data['total'], '35.00')
+
+
+class ExportTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user('alice', 'alice@example.com', 'pw')
+        self.jacket = make_item('jacket', price=50.0, discount_price=40.0)
+        self.cap = make_item('cap', price=5.0)
+        self.orders = []
+        for n, items in enumerate([[self.jacket, self.cap], [self.cap]]):
+            order = Order.objects.create(user=self.user, ordered_date=timezone.now())
+            for item in items:
+                order.items.add(OrderItem.objects.create(user=self.user, item=item))
+            payments.finalize_order(order, self.user, 'ch_%d' % n, payments.snapshot_order(order))
+            self.orders.append(order)
+        self.orders[0].set_coupon(Coupon.objects.create(code='TENOFF', amount=10))
+        Order.objects.filter(pk=self.orders[1].pk).update(refund_requested=True)
+        Order.objects.create(user=self.user, ordered_date=timezone.now())
+
+    def export(self, *args):
+        out = StringIO()
+        call_command('export_orders', *args, stdout=out)
+        return out.getvalue()
+
+    def test_csv_has_a_row_per_line_of_completed_orders(self):
+        rows = list(csv.DictReader(StringIO(self.export())))
+        self.assertEqual([(row['ref_code'], row['item_slug']) for row in rows],
+                         [(self.orders[0].ref_code, 'jacket'),
+                          (self.orders[0].ref_code, 'cap'),
+                          (self.orders[1].ref_code, 'cap')])
+        self.assertEqual((rows[0]['unit_price'], rows[0]['unit_discount'],
+                          rows[0]['coupon_code'], rows[0]['payment_charge_id']),
+                         ('40.00', '10.00', 'TENOFF', 'ch_0'))
+        self.assertEqual(rows[2]['refund_requested'], 'True')
+
+    def test_jsonl_nests_lines_and_filters_by_date(self):
+        with self.assertNumQueries(1):
+            orders = [json.loads(line) for line in self.export('--format', 'jsonl').splitlines()]
+        self.assertEqual([len(order['items']) for order in orders], [2, 1])
+        self.assertEqual(orders[1]['items'][0]['title'], 'Cap')
+        Order.objects.filter(pk=self.orders[0].pk).update(
+            ordered_date=timezone.now() - timezone.timedelta(days=3))
+        since = (timezone.now() - timezone.timedelta(days=1)).date().isoformat()
+        recent = self.export('--format', 'jsonl', '--since', since).splitlines()
+        self.assertEqual([json.loads(line)['ref_code'] for line in recent],
+                         [self.orders[1].ref_code])
+        self.assertEqual(len(self.export('--format', 'jsonl', '--all',
+                                         '--date-field', 'start_date',
+                                         '--since', since).splitlines()), 3)
+        with self.assertRaisesMessage(CommandError, "argument --since: Not a date: 'soon'"):
+            self.export('--since', 'soon')
+
+    def test_admin_action_streams_selection(self):
+        User.objects.create_superuser('admin', 'admin@example.com', 'pw')
+        self.client.login(username='admin', password='pw')
+        response = self.client.post(reverse('admin:core_order_changelist'),
+                                    {'action': 'export_orders_csv',
+                                     '_selected_action': [self.orders[1].pk]})
+        self.assertTrue(response.streaming)
+        self.assertIn('attachment;', response['Content-Disposition'])
+        rows = list(csv.DictReader(StringIO(
+            b''.join(response.streaming_content).decode())))
+        self.assertEqual([row['ref_code'] for row in rows], [self.orders[1].ref_code])
+
+
+class OrderAdminTests(TestCase):
+    def setUp(self):
+        admin = User.objects.create_superuser('admin', 'admin@example.com', 'pw')
+        self.client.force_login(admin)
+        self.changelist = reverse('admin:core_order_changelist')
+
+    def get_changelist(self, **params):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(self.changelist, params)
+        self.assertEqual(response.status_code, 200)
+        return response, len(queries)
+
+    def test_changelist_queries_do_not_grow_with_rows(self):
+        seed_admin_orders(5, users=3)
+        _, few = self.get_changelist()
+        seed_admin_orders(60, users=3)
+        response, many = self.get_changelist()
+        self.assertEqual(many, few)
+        self.assertEqual(response.context['cl'].result_count, 65)
+        response = self.client.get(reverse('admin:core_address_changelist'))
+        self.assertContains(response, 'admin-customer-2')
+
+    def test_search_matches_ref_code_or_start_of_username(self):
+        seed_admin_orders(30, users=3)
+        response, _ = self.get_changelist(q='admin-7')
+        self.assertEqual([order.ref_code for order in response.context['cl'].result_list],
+                         ['admin-7'])
+        response, _ = self.get_changelist(q='admin-customer-1')
+        self.assertEqual(response.context['cl'].result_count, 10)
+        response, _ = self.get_changelist(q='admin-cust')
+        self.assertEqual(response.context['cl'].result_count, 30)
+        response, _ = self.get_changelist(q='customer')
+        self.assertEqual(response.context['cl'].result_count, 0)
+        # Address columns sort by street, not by row id
+        response, _ = self.get_changelist(o='8')
+        self.assertIn('billing_address__street_address',
+                      response.context['cl'].get_ordering(response.wsgi_request,
+                                                           Order.objects.all()))
+
+    def test_estimated_count_past_the_limit(self):
+        seed_admin_orders(30, users=3)
+        Order.objects.filter(ref_code__in=['admin-3', 'admin-4']).delete()
+        with mock.patch.object(EstimatedCountPaginator, 'exact_count_limit', 10):
+            # MAX(pk) on SQLite, which does not notice the deleted rows
+            self.assertEqual(EstimatedCountPaginator(Order.objects.all(), 5).count, 30)
+            # Filtered counts are exact, so every page stays reachable
+            paid = Order.objects.filter(ordered=True)
+            paginator = EstimatedCountPaginator(paid, 5)
+            self.assertEqual(paginator.count, paid.count())
+            self.assertGreater(paginator.count, 10)
+            self.assertTrue(paginator.page(paginator.num_pages).object_list)
+            self.assertEqual(EstimatedCountPaginator(
+                Order.objects.filter(coupon__isnull=False), 5).count, 6)
+
+
+class SavedCardCacheTests(TestCase):
+    def setUp(self):
+        card_stats.reset()
+        self.user = User.objects.create_user('alice', 'alice@example.com', 'pw')
+        self.client.force_login(self.user)
+        address = Address.objects.create(
+            user=self.user, street_address='1 Main St', apartment_address='',
+            country='US', zip='10001', address_type='B', default=True)
+        Order.objects.create(user=self.user, ordered_date=timezone.now(),
+                             billing_address=address)
+        self.stripe = FakeStripe(latency=0.005)
+        customer = self.stripe.create_customer(source='tok_visa')
+        self.user.userprofile.stripe_customer_id = customer.id
+        self.user.userprofile.one_click_purchasing = True
+        self.user.userprofile.save()
+        patcher = mock.patch.object(payments, 'stripe', self.stripe)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def payment_page(self):
+        return self.client.get(reverse('core:payment_url', args=['stripe']))
+
+    def test_card_served_from_profile(self):
+        self.payment_page()
+        response = self.payment_page()
+        self.assertContains(response, '**** **** **** 4242')
+        self.assertEqual(self.stripe.calls.count('Customer.list_sources'), 1)
+        stats = card_stats.as_dict()
+        self.assertEqual((stats['hits'], stats['misses']), (1, 1))
+        self.assertGreater(stats['saved_ms'], 0)
+
+    @override_settings(CARD_CACHE_TIMEOUT=0)
+    def test_stale_card_is_refetched(self):
+        self.payment_page()
+        self.payment_page()
+        self.assertEqual(self.stripe.calls.count('Customer.list_sources'), 2)
+
+    def test_adding_a_card_invalidates(self):
+        self.payment_page()
+        self.client.post(reverse('core:payment_url', args=['stripe']),
+                         {'stripeToken': 'tok_mastercard', 'save': 'on'})
+        self.assertIsNone(UserProfile.objects.get(user=self.user).card_cached_at)
+        Order.objects.create(user=self.user, ordered_date=timezone.now(),
+                             billing_address=Address.objects.get())
+        self.payment_page()
+        self.assertEqual(self.stripe.calls.count('Customer.list_sources'), 2)
+
+
+class CatalogCacheTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        catalog_stats.reset()
+        for n in range(7):
+            make_item('item-%d' % n, price=10.0 + n)
+
+    def test_anonymous_hit_costs_no_queries(self):
+        first = self.client.get(reverse('core:item-list_url'))
+        with self.assertNumQueries(0):
+            second = self.client.get(reverse('core:item-list_url'))
+        self.assertEqual(first.content, second.content)
+        self.assertContains(second, 'Item-4')
+        self.assertNotContains(second, 'Item-5')
+        self.assertEqual(catalog_stats.as_dict()['hits'], 1)
+
+    def test_pages_are_cached_separately(self):
+        response = self.client.get(reverse('core:item-list_url'), {'page': 2})
+        self.assertContains(response, 'Item-6')
+        self.assertEqual(self.client.get(reverse('core:item-list_url'),
+                                         {'page': 3}).status_code, 404)
+
+    def test_item_save_and_delete_expire_pages(self):
+        self.client.get(reverse('core:item-list_url'))
+        item = Item.objects.get(slug='item-0')
+        item.title = 'Renamed'
+        item.save()
+        self.assertContains(self.client.get(reverse('core:item-list_url')), 'Renamed')
+        item.delete()
+        self.assertNotContains(self.client.get(reverse('core:item-list_url')), 'Renamed')
+
+    def test_warm_command(self):
+        out = StringIO()
+        call_command('warm_catalog_cache', pages=5, stdout=out)
+        self.assertIn('Warmed 2 catalog pages', out.getvalue())
+        with self.assertNumQueries(0):
+            self.client.get(reverse('core:item-list_url'), {'page': 2})
+
+    @override_settings(CATALOG_PAGINATION='cursor')
+    def test_warm_command_follows_cursors(self):
+        out = StringIO()
+        call_command('warm_catalog_cache', pages=5, stdout=out)
+        self.assertIn('Warmed 2 catalog pages', out.getvalue())
+        next_cursor = encode_cursor([Item.objects.get(slug='item-4').pk])
+        with self.assertNumQueries(0):
+            response = self.client.get(reverse('core:item-list_url'), {'cursor': next_cursor})
+        self.assertContains(response, 'Item-6')
+
+
+class ProductPageCacheTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        product_stats.reset()
+        self.jacket = make_item('jacket', price=50.0, discount_price=40.0)
+        self.url = reverse('core:product_url', args=['jacket'])
+
+    def test_anonymous_hit_costs_no_queries(self):
+        first = self.client.get(self.url)
+        with self.assertNumQueries(0):
+            second = self.client.get(self.url)
+        self.assertEqual(first.content, second.content)
+        self.assertContains(second, 'A fine jacket')
+        self.assertEqual(product_stats.as_dict()['hits'], 1)
+        self.assertEqual(self.client.get(reverse('core:product_url', args=['nope']))
+                         .status_code, 404)
+
+    def test_conditional_get(self):
+        response = self.client.get(self.url)
+        self.assertEqual(response['Last-Modified'],
+                         http_date(int(self.jacket.updated_at.timestamp())))
+        self.assertIn('no-cache', response['Cache-Control'])
+        self.assertNotIn('private', response['Cache-Control'])
+        etag = response['ETag']
+        with self.assertNumQueries(0):
+            response = self.client.get(self.url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual((response.status_code, response.content), (304, b''))
+        response = self.client.get(self.url,
+                                   HTTP_IF_MODIFIED_SINCE=response['Last-Modified'])
+        self.assertEqual(response.status_code, 304)
+
+    def test_item_save_expires_page_and_etag(self):
+        etag = self.client.get(self.url)['ETag']
+        self.jacket.description = 'Keeps the rain out'
+        self.jacket.save()
+        response = self.client.get(self.url, HTTP_IF_NONE_MATCH=etag)
+        self.assertContains(response, 'Keeps the rain out')
+        self.assertNotEqual(response['ETag'], etag)
+
+    def test_renamed_slug_leaves_the_cache(self):
+        self.client.get(self.url)
+        self.jacket.slug = 'rain-jacket'
+        self.jacket.save()
+        self.assertEqual(self.client.get(self.url).status_code, 404)
+        self.assertContains(self.client.get(self.jacket.get_absolute_url()), 'A fine jacket')
+        self.jacket.delete()
+        self.assertEqual(self.client.get(self.jacket.get_absolute_url()).status_code, 404)
+
+    def test_logged_in_etag_follows_the_cart(self):
+        user = User.objects.create_user('alice', 'alice@example.com', 'pw')
+        self.client.force_login(user)
+        response = self.client.get(self.url)
+        self.assertIn('private', response['Cache-Control'])
+        self.assertFalse(response.has_header('Last-Modified'))
+        etag = response['ETag']
+        self.assertNotEqual(etag, Client().get(self.url)['ETag'])
+        self.assertEqual(self.client.get(self.url, HTTP_IF_NONE_MATCH=etag).status_code, 304)
+        cart.add_item(user, self.jacket)
+        response = self.client.get(self.url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.context['user'].pk, user.pk)
+        self.assertContains(response, 'A fine jacket')
+        self.assertEqual(get_cart_summary(user)['count'], 1)
+
+    def test_pending_messages_are_shown(self):
+        user = User.objects.create_user('alice', 'alice@example.com', 'pw')
+        self.client.force_login(user)
+        etag = self.client.get(self.url)['ETag']
+        self.client.post(reverse('core:add-coupon_url'), {'code': 'NOPE'})
+        response = self.client.get(self.url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.context['messages']), 1)
+
+
+class InstrumentationTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        instrumentation.registry.reset()
+        for n in range(3):
+            make_item('item-%d' % n)
+        self.staff = User.objects.create_user('ops', is_staff=True)
+
+    def server_timing(self, response):
+        return dict(part.split(';', 1) for part in response['Server-Timing'].split(', '))
+
+    def test_server_timing(self):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(reverse('core:item-list_url'))
+        timing = self.server_timing(response)
+        self.assertEqual(timing['db'].split(';')[1], 'desc="%d queries"' % len(queries))
+        self.assertGreater(float(timing['tpl'][len('dur='):]), 0)
+        self.assertEqual(timing['cache'], 'desc="hits=0 misses=1"')
+        timing = self.server_timing(self.client.get(reverse('core:item-list_url')))
+        self.assertEqual(timing['db'].split(';')[1], 'desc="0 queries"')
+        self.assertEqual(timing['cache'], 'desc="hits=1 misses=0"')
+
+    @override_settings(SERVER_TIMING_HEADER=False)
+    def test_header_can_be_turned_off(self):
+        self.assertFalse(self.client.get(reverse('core:item-list_url')).has_header('Server-Timing'))
+
+    def test_metrics_endpoint(self):
+        self.client.get(reverse('core:item-list_url'))
+        self.client.get(reverse('core:item-list_url'))
+        self.client.get('/no-such-page')
+        self.client.force_login(self.staff)
+        text = self.client.get(reverse('core:metrics_url')).content.decode()
+        self.assertIn('core_requests_total{view="core:item-list_url",method="GET",status="200"} 2',
+                      text)
+        self.assertIn('core_requests_total{view="unresolved",method="GET",status="404"} 1', text)
+        self.assertIn('core_request_duration_seconds_bucket{view="core:item-list_url",le="+Inf"} 2',
+                      text)
+        self.assertIn('core_request_duration_seconds_count{view="core:item-list_url"} 2', text)
+        self.assertIn('core_cache_hits_total{cache="catalog"}', text)
+        self.assertIn('core_slow_requests_total 0', text)
+
+    @override_settings(METRICS_TOKEN='s3cret')
+    def test_metrics_need_staff_or_token(self):
+        url = reverse('core:metrics_url')
+        # Behind a local proxy every request comes from 127.0.0.1
+        self.assertEqual(self.client.get(url, REMOTE_ADDR='127.0.0.1').status_code, 403)
+        self.assertEqual(self.client.get(url, HTTP_AUTHORIZATION='Bearer nope').status_code, 403)
+        self.assertEqual(self.client.get(url, HTTP_AUTHORIZATION='Bearer s3cret').status_code, 200)
+        with override_settings(METRICS_TOKEN=''):
+            self.assertEqual(self.client.get(url, HTTP_AUTHORIZATION='Bearer ').status_code, 403)
+        self.client.force_login(User.objects.create_user('alice'))
+        self.assertEqual(self.client.get(url).status_code, 403)
+
+    @override_settings(SLOW_REQUEST_SECONDS=0)
+    def test_slow_requests_keep_their_sql(self):
+        self.client.get(reverse('core:product_url', args=['item-1']))
+        self.client.force_login(self.staff)
+        log = self.client.get(reverse('core:slow-requests_url')).json()
+        slow = log['requests'][0]
+        self.assertEqual((slow['view'], slow['status']), ('core:product_url', 200))
+        self.assertEqual(slow['queries'], len(slow['sql']))
+        self.assertTrue(any('"core_item"' in query['sql'] for query in slow['sql']))
+        # Statements only, without the values bound to them
+        self.assertFalse(any('item-1' in query['sql'] for query in slow['sql']))
+        self.client.logout()
+        self.assertEqual(self.client.get(reverse('core:slow-requests_url')).status_code, 403)
+
+    def test_queries_outside_requests_are_not_recorded(self):
+        self.assertIsNone(instrumentation.current())
+        Item.objects.count()
+        self.assertNotIn('core_db_queries_total{', instrumentation.registry.render())
+
+
+class QueryCheckTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user('alice', 'alice@example.com', 'pw')
+        for n in range(4):
+            OrderItem.objects.create(user=self.user, item=make_item('item-%d' % n))
+
+    def test_fingerprint(self):
+        self.assertEqual(
+            querycheck.fingerprint(
+                'SELECT "t"."id" FROM "t2" WHERE "t"."id" IN (%s, %s, %s)\n'
+                "  AND \"t\".\"name\" = 'it''s' AND \"t\".\"n\" > 3.5 LIMIT 21"),
+            'SELECT "t"."id" FROM "t2" WHERE "t"."id" IN (...) '
+            'AND "t"."name" = ? AND "t"."n" > ? LIMIT ?')
+
+    def test_template_n_plus_one_names_the_line(self):
+        template = Template('{% for line in lines %}\n{{ line.item.slug }}{% endfor %}')
+        with querycheck.record() as recorder:
+            template.render(Context({'lines': OrderItem.objects.all()}))
+        audit = querycheck.Audit(recorder.queries)
+        self.assertEqual(len(audit.repeated), 1)
+        group = audit.repeated[0]
+        self.assertEqual(len(group), 4)
+        self.assertIn('FROM "core_item" WHERE "core_item"."id" = ?', group[0].fingerprint)
+        self.assertEqual(group[0].stack[0], '<unknown source>:2 {{ line.item.slug }}')
+        self.assertTrue(group[0].stack[1].startswith('core/tests.py:'))
+        self.assertEqual(audit.duplicates, [])
+
+    def test_duplicates_are_told_apart(self):
+        with querycheck.record() as recorder:
+            Item.objects.filter(slug='item-0').first()
+            Item.objects.filter(slug='item-0').first()
+            Item.objects.filter(slug='item-1').first()
+        audit = querycheck.Audit(recorder.queries)
+        self.assertEqual(len(audit.repeated), 1)
+        with querycheck.record() as recorder:
+            Item.objects.filter(slug='item-0').first()
+            Item.objects.filter(slug='item-0').first()
+        audit = querycheck.Audit(recorder.queries)
+        self.assertEqual((len(audit.repeated), len(audit.duplicates)), (0, 1))
+
+    @override_settings(DEBUG=True)
+    def test_middleware_logs_n_plus_ones(self):
+        def view(request):
+            return HttpResponse(''.join(line.item.slug for line in OrderItem.objects.all()))
+
+        middleware = querycheck.QueryAuditMiddleware(view)
+        with self.assertLogs('core.querycheck', 'WARNING') as logs:
+            middleware(RequestFactory().get('/lines'))
+        self.assertEqual(len(logs.output), 1)
+        self.assertIn('N+1 on /lines: 4x', logs.output[0])
+        self.assertIn('core/tests.py', logs.output[0])
+
+    def test_strict_client_enforces_the_budget(self):
+        cache.clear()
+        client = querycheck.AuditClient(query_budget=1)
+        response = client.get(reverse('core:product_url', args=['item-0']))
+        self.assertEqual(response.query_audit.as_dict()['queries'], 1)
+        cache.clear()
+        client = querycheck.AuditClient(strict=True, query_budget=0)
+        with self.assertRaisesRegex(querycheck.QueryBudgetExceeded, '1 queries, budget 0'):
+            client.get(reverse('core:product_url', args=['item-0']))
+
+
+class DatabaseSetupTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        make_item('jacket')
+
+    def test_sqlite_pragmas(self):
+        if connection.vendor != 'sqlite':
+            self.skipTest('SQLite only')
+        with connection.cursor() as cursor:
+            cursor.execute('PRAGMA synchronous')
+            self.assertEqual(cursor.fetchone()[0], 1)
+            cursor.execute('PRAGMA busy_timeout')
+            self.assertEqual(cursor.fetchone()[0], settings.SQLITE_PRAGMAS['busy_timeout'])
+
+    @override_settings(DATABASE_REPLICAS=['replica'])
+    def test_router_sends_only_catalog_reads_to_replicas(self):
+        router = db.ReplicaRouter()
+        self.assertIsNone(router.db_for_read(Item))
+        with db.replica_reads():
+            self.assertEqual(router.db_for_read(Item), 'replica')
+            self.assertIsNone(router.db_for_read(Order))
+            self.assertEqual(router.db_for_write(Item), 'default')
+        self.assertFalse(router.allow_migrate('replica', 'core'))
+        self.assertTrue(router.allow_migrate('default', 'core'))
+
+    def test_router_is_idle_without_replicas(self):
+        with db.replica_reads():
+            self.assertIsNone(db.ReplicaRouter().db_for_read(Item))
+
+    @override_settings(DATABASE_REPLICAS=['replica'])
+    def test_catalog_views_read_from_replicas(self):
+        with mock.patch.object(db, 'choose_replica', return_value='default') as choose:
+            self.client.get(reverse('core:product_url', args=['jacket']))
+            self.assertEqual(choose.call_count, 1)
+            self.client.get(reverse('core:item-list_url'))
+            self.assertGreater(choose.call_count, 1)
+            choose.reset_mock()
+            user = User.objects.create_user('alice', 'alice@example.com', 'pw')
+            self.client.force_login(user)
+            self.client.get(reverse('core:add-product_url', args=['jacket']))
+            self.client.get(reverse('core:order-summary_url'))
+            self.assertEqual(choose.call_count, 0)
+            # Only the item itself: the cart badge comes from the primary
+            cache.clear()
+            response = self.client.get(reverse('core:product_url', args=['jacket']))
+            self.assertEqual(choose.call_count, 1)
+            self.assertEqual(response.status_code, 200)
+
+
+class ImageDerivativeTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        media_root = tempfile.TemporaryDirectory()
+        self.addCleanup(media_root.cleanup)
+        overrider = override_settings(MEDIA_ROOT=media_root.name)
+        overrider.enable()
+        self.addCleanup(overrider.disable)
+        self.item = make_item('shirt')
+        self.item.image = self.upload('shirt.jpg', (1200, 1500))
+        self.item.save()
+
+    def upload(self, name, size, mode='RGB', format='JPEG'):
+        buffer = BytesIO()
+        Image.new(mode, size, (200, 80, 40, 128)[:len(mode)]).save(buffer, format)
+        return default_storage.save(name, ContentFile(buffer.getvalue()))
+
+    def test_derivatives_are_made_per_width_and_format(self):
+        derivatives = images.make_derivatives(self.item.pk)
+        self.assertEqual(derivatives['source'], 'shirt.jpg')
+        for format in ('webp', 'jpeg'):
+            self.assertEqual(sorted(derivatives[format], key=int), ['320', '640', '960'])
+        name = derivatives['webp']['640']
+        self.assertRegex(name, r'^derivatives/shirt-640w\.[0-9a-f]{12}\.webp$')
+        with default_storage.open(name) as f:
+            self.assertEqual(Image.open(f).size, (640, 800))
+        files = len(os.listdir(os.path.join(settings.MEDIA_ROOT, 'derivatives')))
+        self.assertEqual(images.make_derivatives(self.item.pk), derivatives)
+        self.assertEqual(len(os.listdir(os.path.join(settings.MEDIA_ROOT, 'derivatives'))),
+                         files)
+
+    def test_small_and_transparent_images(self):
+        self.item.image = self.upload('cap.png', (200, 100), 'RGBA', 'PNG')
+        self.item.save()
+        derivatives = images.make_derivatives(self.item.pk)
+        self.assertEqual(set(derivatives), {'source', 'webp', 'png'})
+        self.assertEqual(list(derivatives['png']), ['200'])
+
+    def test_card_offers_srcset_once_derivatives_exist(self):
+        response = self.client.get(reverse('core:item-list_url'))
+        self.assertContains(response, 'src="/media/shirt.jpg"')
+        self.assertNotContains(response, 'srcset')
+        images.make_derivatives(self.item.pk)
+        response = self.client.get(reverse('core:item-list_url'))
+        self.assertContains(response, '<source type="image/webp" srcset="/media/derivatives/'
+                                      'shirt-320w.')
+        self.assertContains(response, ' 960w"')
+        self.assertContains(response, 'src="/media/derivatives/shirt-640w.')
+
+        # A replaced image shows as is until its own derivatives are made
+        Item.objects.filter(pk=self.item.pk).update(image='other.jpg')
+        self.item.refresh_from_db()
+        self.assertEqual(images.srcset(self.item), '')
+        self.assertEqual(images.fallback_url(self.item), '/media/other.jpg')
+
+    @override_settings(BACKGROUND_TASKS_EAGER=True)
+    def test_upload_queues_derivatives_after_commit(self):
+        with mock.patch.object(images.transaction, 'on_commit') as on_commit:
+            self.item.image = self.upload('jacket.jpg', (800, 800))
+            self.item.save()
+            self.item.save()
+        self.assertEqual(on_commit.call_count, 2)
+        on_commit.call_args[0][0]()
+        self.item.refresh_from_db()
+        self.assertEqual(self.item.image_derivatives['source'], 'jacket.jpg')
+        with mock.patch.object(images.transaction, 'on_commit') as on_commit:
+            self.item.save()
+        on_commit.assert_not_called()
+
+    def test_missing_source_is_skipped(self):
+        Item.objects.filter(pk=self.item.pk).update(image='gone.jpg')
+        with self.assertLogs('core.images', 'WARNING'):
+            self.assertIsNone(images.make_derivatives(self.item.pk))
+        out = StringIO()
+        call_command('make_image_derivatives', stdout=out)
+        self.assertIn('Made derivatives for 0 items', out.getvalue())
+
+
+class AssetTests(TestCase):
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.directory = tempfile.TemporaryDirectory()
+        cls.built = override_settings(
+            STATIC_ROOT=os.path.join(cls.directory.name, 'root'),
+            STATIC_BUNDLE_DIR=os.path.join(cls.directory.name, 'bundles'),
+            STATIC_USE_BUNDLES=True)
+        cls.built.enable()
+        call_command('build_static', verbosity=0, stdout=StringIO())
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.built.disable()
+        cls.directory.cleanup()
+        super().tearDownClass()
+
+    def serve(self, path, **headers):
+        return assets.serve(RequestFactory().get(path, **headers), path)
+
+    def test_pages_link_fingerprinted_bundles(self):
+        response = self.client.get(reverse('core:item-list_url'))
+        self.assertRegex(response.content.decode(),
+                         r'<link href="/static/css/site\.[0-9a-f]{12}\.css" rel="stylesheet" />')
+        self.assertRegex(response.content.decode(),
+                         r'src="/static/js/site\.[0-9a-f]{12}\.js"')
+        with override_settings(STATIC_USE_BUNDLES=False):
+            response = self.client.get(reverse('core:item-list_url'))
+        self.assertRegex(response.content.decode(), r'/static/css/mdb\.min\.[0-9a-f]{12}\.css')
+
+    def test_bundles_are_built_and_precompressed(self):
+        root = settings.STATIC_ROOT
+        self.assertFalse(os.path.exists(os.path.join(root, 'scss')))
+        name = staticfiles_storage.stored_name('css/site.css')
+        with open(os.path.join(root, name), 'rb') as f:
+            css = f.read()
+        self.assertTrue(css.startswith(b'@charset "UTF-8";\n/*!'))
+        self.assertEqual(css.count(b'@charset'), 1)
+        # url()s inside the bundle point at fingerprinted fonts
+        self.assertRegex(css.decode(), r'url\("\.\./font/roboto/Roboto-Bold\.[0-9a-f]{12}\.woff2"\)')
+        with gzip.open(os.path.join(root, name + '.gz')) as f:
+            self.assertEqual(f.read(), css)
+        js = staticfiles_storage.open(staticfiles_storage.stored_name('js/site.js')).read()
+        self.assertNotIn(b'sourceMappingURL', js)
+
+    def test_serve_picks_encoding_and_lifetime(self):
+        name = staticfiles_storage.stored_name('css/site.css')
+        response = self.serve(name, HTTP_ACCEPT_ENCODING='gzip, deflate')
+        self.assertEqual(response['Content-Encoding'], 'gzip')
+        self.assertEqual(response['Content-Type'], 'text/css')
+        self.assertEqual(response['Vary'], 'Accept-Encoding')
+        self.assertIn('immutable', response['Cache-Control'])
+        self.assertEqual(gzip.decompress(b''.join(response.streaming_content)),
+                         staticfiles_storage.open(name).read())
+
+        response = self.serve('css/site.css', HTTP_ACCEPT_ENCODING='gzip;q=0')
+        self.assertFalse(response.has_header('Content-Encoding'))
+        self.assertIn('max-age=%d' % settings.STATIC_CACHE_MAX_AGE, response['Cache-Control'])
+        response = self.serve('css/site.css', HTTP_IF_MODIFIED_SINCE=response['Last-Modified'])
+        self.assertEqual(response.status_code, 304)
+        with self.assertRaises(Http404):
+            self.serve('../manage.py')
+
+    def test_minify_css(self):
+        self.assertEqual(assets.minify_css('/* note */\n.a  .b :hover {\n  color: red;\n}\n'
+                                           '/*! keep */ a > b, c { margin: 0 }'),
+                         '.a .b :hover{color:red}/*! keep */ a>b,c{margin:0}')
+
+
+class CursorPaginationTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        for n in range(12):
+            make_item('item-%02d' % n, price=float(n % 4))
+
+    def walk(self, paginator):
+        seen, page = [], paginator.page()
+        while True:
+            seen += [item.slug for item in page]
+            if not page.has_next:
+                return seen, page
+            page = paginator.page(page.next_cursor)
+
+    def test_forward_and_back_with_ties(self):
+        paginator = CursorPaginator(Item.objects.all(), 5, ['-price', 'id'])
+        expected = list(Item.objects.order_by('-price', 'id').values_list('slug', flat=True))
+        seen, last = self.walk(paginator)
+        self.assertEqual(seen, expected)
+        previous = paginator.page(last.previous_cursor)
+        self.assertEqual([item.slug for item in previous], expected[5:10])
+        self.assertTrue(previous.has_next and previous.has_previous)
+
+    def test_deep_page_is_a_single_query(self):
+        paginator = CursorPaginator(Item.objects.all(), 5)
+        cursor = encode_cursor([Item.objects.order_by('id')[9].pk])
+        with self.assertNumQueries(1):
+            page = paginator.page(cursor)
+        self.assertEqual(len(page), 2)
+
+    def test_garbage_cursor(self):
+        paginator = CursorPaginator(Item.objects.all(), 5)
+        for token in ('%%%', encode_cursor(['x']), encode_cursor([1, 2])):
+            with self.assertRaises(InvalidCursor):
+                paginator.page(token)
+
+    @override_settings(CATALOG_PAGINATION='cursor', CATALOG_APPROXIMATE_COUNT=True)
+    def test_home_view_cursor_mode(self):
+        response = self.client.get(reverse('core:item-list_url'))
+        self.assertContains(response, 'Item-04')
+        self.assertContains(response, '?cursor=')
+        self.assertNotContains(response, '?page=')
+        next_cursor = encode_cursor([Item.objects.get(slug='item-04').pk])
+        response = self.client.get(reverse('core:item-list_url'), {'cursor': next_cursor})
+        self.assertContains(response, 'Item-05')
+        self.assertNotContains(response, 'Item-04')
+        self.assertEqual(self.client.get(reverse('core:item-list_url'),
+                                         {'cursor': 'bogus'}).status_code, 404)
+
+
+class ExplainQueriesTests(TestCase):
+    def test_hot_queries_use_indexes(self):
+        out = StringIO()
+        call_command('explain_queries', strict=True, stdout=out)
+        self.assertNotIn('SCAN', out.getvalue())
+
+
+class SearchTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        make_item('linen-shirt', price=30.0)
+        make_item('linen-jacket', price=80.0, discount_price=45.0)
+        jacket = make_item('wool-jacket', price=90.0)
+        jacket.category, jacket.label = Item.OUTWEAR, Item.DANGER
+        jacket.save()
+        tee = make_item('plain-tee', price=12.0)
+        tee.description = 'Soft linen blend'
+        tee.save()
+
+    def slugs(self, results):
+        return [item.slug for item in results.items]
+
+    def check_backend(self):
+        results = search.search('linen')
+        self.assertEqual(results.total, 3)
+        # Title hits outrank description-only hits
+        self.assertEqual(self.slugs(results)[-1], 'plain-tee')
+        self.assertEqual(self.slugs(search.search('jack')),
+                         ['linen-jacket', 'wool-jacket'])
+        self.assertEqual(self.slugs(search.search('linen jack')), ['linen-jacket'])
+        self.assertEqual(search.search('nothing').total, 0)
+
+        results = search.search('jacket', category=Item.SHIRT)
+        self.assertEqual(self.slugs(results), ['linen-jacket'])
+        self.assertEqual(results.facets['category'],
+                         [(Item.OUTWEAR, 'Outwear', 1), (Item.SHIRT, 'Shirt', 1)])
+        self.assertEqual(results.facets['label'], [(Item.PRIMARY, 'primary', 1)])
+
+        # Effective price: the discounted jacket is 45, not 80
+        results = search.search('', min_price=40, max_price=50)
+        self.assertEqual(self.slugs(results), ['linen-jacket'])
+        self.assertEqual(search.search('', limit=2, offset=2).total, 4)
+
+    def test_memory_backend(self):
+        self.check_backend()
+
+    def test_memory_index_follows_item_changes(self):
+        search.search('linen')
+        item = Item.objects.get(slug='wool-jacket')
+        item.title = 'Linen Parka'
+        item.save()
+        self.assertIn('wool-jacket', self.slugs(search.search('parka')))
+        self.assertEqual(search.search('linen').total, 4)
+        item.delete()
+        self.assertEqual(search.search('parka').total, 0)
+        self.assertEqual(search.search('linen').total, 3)
+
+    def test_memory_rebuild_does_not_block_searches(self):
+        backend = search.get_backend()
+        backend.build()
+        rows = backend.rows()
+        reading, release = threading.Event(), threading.Event()
+
+        def slow_rows():
+            reading.set()
+            release.wait(5)
+            return rows
+
+        with mock.patch.object(backend, 'rows', slow_rows):
+            rebuild = threading.Thread(target=backend.build)
+            rebuild.start()
+            reading.wait(5)
+            start = time.perf_counter()
+            self.assertEqual(search.search('linen').total, 3)
+            self.assertLess(time.perf_counter() - start, 1)
+            release.set()
+            rebuild.join()
+        self.assertEqual(search.search('linen').total, 3)
+
+    @override_settings(SEARCH_BACKEND='database')
+    def test_database_backend(self):
+        search.DatabaseBackend().install(rebuild=True)
+        self.check_backend()
+        make_item('linen-parka', price=70.0)
+        self.assertEqual(search.search('parka').total, 1)
+
+    def test_database_index_skips_unindexed_updates(self):
+        search.DatabaseBackend().install()
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT sql FROM sqlite_master WHERE name = 'core_item_fts_update'")
+            self.assertIn('AFTER UPDATE OF title, description', cursor.fetchone()[0])
+        Item.objects.filter(slug='plain-tee').update(stock=5)
+        Item.objects.filter(slug='plain-tee').update(title='Plain Parka')
+        with override_settings(SEARCH_BACKEND='database'):
+            self.assertEqual(self.slugs(search.search('parka')), ['plain-tee'])
+            self.assertEqual(search.search('tee').total, 0)
+
+    def test_rebuild_command(self):
+        with self.assertRaisesMessage(CommandError, 'each server process'):
+            call_command('rebuild_search_index', stdout=StringIO())
+        out = StringIO()
+        with override_settings(SEARCH_BACKEND='database'):
+            call_command('rebuild_search_index', stdout=out)
+            make_item('linen-parka', price=70.0)
+            self.assertEqual(search.search('linen').total, 4)
+        self.assertIn('Rebuilt the database search index', out.getvalue())
+
+    def test_search_view(self):
+        response = self.client.get(reverse('core:search_url'),
+                                   {'q': 'linen', 'category': Item.SHIRT})
+        self.assertContains(response, 'Linen-Shirt')
+        self.assertContains(response, '3 results')
+        self.assertNotContains(response, 'Wool-Jacket')
+        response = self.client.get(reverse('core:search_url'), {'min_price': 'x'})
+        self.assertEqual(response.status_code, 200)
@@ -1,26 +1,43 @@
+from django.conf import settings
 from django.urls import path
+from . import api, instrumentation
 from .views import (HomeView, 
                     ItemDetailView, 
                     CheckoutView,
                     PaymentView, 
+                    PaymentStatusView,
                     add_to_cart, 
                     remove_from_cart, 
                     remove_single_item_from_cart, 
                     OrderSummaryView,
+                    OrderHistoryView,
                     AddCouponView,
-                    RequestRefundView)
+                    RequestRefundView,
+                    SearchView)
 
 app_name = 'core'
 
 urlpatterns = [
     path('', HomeView.as_view(), name='item-list_url'),
+    path('search', SearchView.as_view(), name='search_url'),
     path('checkout', CheckoutView.as_view(), name='checkout_url'),
     path('order-summary', OrderSummaryView.as_view(), name='order-summary_url'),
+    path('orders', OrderHistoryView.as_view(), name='order-history_url'),
     path('product/<slug>', ItemDetailView.as_view(), name='product_url'),
     path('add-product/<slug>', add_to_cart, name='add-product_url'),
     path('add-coupon/', AddCouponView.as_view(), name='add-coupon_url'),
     path('remove-product/<slug>', remove_from_cart, name='remove-product_url'),
     path('remove-single-product/<slug>', remove_single_item_from_cart, name='remove-single-product_url'),
     path('payment/<payment_option>',PaymentView.as_view(),name='payment_url'),
-    path('request-refund',RequestRefundView.as_view(),name='request-refund_url')
+    path('payment-status/<uuid:key>', PaymentStatusView.as_view(), name='payment-status_url'),
+    path('request-refund',RequestRefundView.as_view(),name='request-refund_url'),
+    path('api/items', api.ItemListView.as_view(), name='api-items_url'),
+    path('api/items/<slug>', api.ItemDetailView.as_view(), name='api-item_url'),
+    path('api/cart', api.CartView.as_view(), name='api-cart_url'),
 ]
+
+if settings.METRICS_ENABLED:
+    urlpatterns += [
+        path('metrics', instrumentation.metrics, name='metrics_url'),
+        path('metrics/slow', instrumentation.slow_request_log, name='slow-requests_url'),
+    ]
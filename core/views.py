@@ -1,72 +1,252 @@
-from decouple import config
 from django.conf import settings
 from django.contrib import messages
 from django.contrib.auth.decorators import login_required
 from django.contrib.auth.mixins import LoginRequiredMixin
 from django.core.exceptions import ObjectDoesNotExist
+from django.db.models import Prefetch
+from django.http import Http404
 from django.shortcuts import render, get_object_or_404, redirect
+from django.template.loader import render_to_string
+from django.utils.cache import get_conditional_response, patch_cache_control, patch_vary_headers
+from django.utils.http import http_date
+from django.utils.safestring import mark_safe
 from django.views.generic import ListView, DetailView, View
-from django.utils import timezone
-from .models import Item, OrderItem, Order, Address, Payment, Coupon, Refund, UserProfile
-from .forms import CheckoutForm, CouponForm, RefundForm, PaymentForm
+from . import cart, coupons, db, inventory, payments, search
+from .api import make_etag
+from .db import ReplicaReadsMixin
+from .cache import (catalog_page_key, catalog_stats, get_cache, get_cart_summary,
+                    get_version, product_page_key,
+                    product_stats, product_version_key)
+from .pagination import CursorPaginator, InvalidCursor
+from .models import Item, OrderItem, Order, Address, PaymentAttempt, Refund
+from .forms import CheckoutForm, CouponForm, RefundForm, PaymentForm, SearchForm
 
-import random
-import string
-import stripe
-stripe.api_key = settings.STRIPE_SECRET_KEY
 
 
 # Create your views here.
 
-def create_ref_code():
-    return ''.join(random.choices(string.ascii_lowercase + string.digits, k=20))
+def get_cart_queryset():
+    # Everything the summary/checkout templates touch, in three queries
+    return Order.objects.select_related('coupon').prefetch_related(
+        Prefetch('items', queryset=OrderItem.objects.select_related('item')))
 
 
-class HomeView(ListView):
+class HomeView(ReplicaReadsMixin, ListView):
     model = Item
     paginate_by = 5
     template_name = 'home-page.html'
+    grid_template_name = 'includes/catalog_grid.html'
     context_object_name = 'items'
+    cursor_kwarg = 'cursor'
+    cursor_page = None
 
+    def get(self, request, *args, **kwargs):
+        return render(request, self.template_name,
+                      {'catalog_grid': self.get_catalog_grid()})
 
-class ItemDetailView(DetailView):
+    def get_ordering(self):
+        return settings.CATALOG_ORDERING
+
+    def uses_cursor(self):
+        return settings.CATALOG_PAGINATION == 'cursor'
+
+    def get_catalog_grid(self):
+        # The grid is the same for every visitor, so it is cached per page
+        # under the catalog version that Item saves/deletes bump
+        if self.uses_cursor():
+            page = 'cursor:' + self.request.GET.get(self.cursor_kwarg, '')
+        else:
+            page = self.request.GET.get(self.page_kwarg) or 1
+        key = catalog_page_key(page)
+        cache = get_cache()
+        grid = cache.get(key)
+        if grid is not None:
+            catalog_stats.hit()
+            return mark_safe(grid)
+
+        catalog_stats.miss()
+        if self.uses_cursor():
+            context = self.get_cursor_context_data()
+        else:
+            self.object_list = self.get_queryset()
+            context = self.get_context_data()
+        grid = render_to_string(self.grid_template_name, context, self.request)
+        cache.set(key, grid, db.fill_timeout(settings.CATALOG_CACHE_TIMEOUT))
+        return grid
+
+    def get_context_data(self, **kwargs):
+        context = super().get_context_data(**kwargs)
+        page_obj = context['page_obj']
+        if page_obj:
+            # Only the page numbers around the current one are rendered
+            context['page_window'] = range(
+                max(page_obj.number - 2, 1),
+                min(page_obj.number + 2, page_obj.paginator.num_pages) + 1)
+        return context
+
+    def get_cursor_page(self):
+        if self.cursor_page is None:
+            paginator = CursorPaginator(
+                Item.objects.all(), self.paginate_by, self.get_ordering(),
+                with_count=settings.CATALOG_APPROXIMATE_COUNT)
+            try:
+                self.cursor_page = paginator.page(self.request.GET.get(self.cursor_kwarg))
+            except InvalidCursor:
+                raise Http404('Invalid cursor')
+        return self.cursor_page
+
+    def get_cursor_context_data(self):
+        page = self.get_cursor_page()
+        return {'items': page.object_list, 'cursor_page': page}
+
+
+class SearchView(View):
+    def get(self, *args, **kwargs):
+        form = SearchForm(self.request.GET)
+        if not form.is_valid():
+            return render(self.request, 'search.html', {'form': form})
+
+        data = form.cleaned_data
+        per_page = settings.SEARCH_RESULTS_PER_PAGE
+        page = data['page'] or 1
+        results = search.search(
+            data['q'],
+            category=data['category'] or None,
+            label=data['label'] or None,
+            min_price=data['min_price'],
+            max_price=data['max_price'],
+            limit=per_page,
+            offset=(page - 1) * per_page)
+
+        query = self.request.GET.copy()
+        query.pop('page', None)
+        context = {'form': form,
+                   'results': results,
+                   'query_string': query.urlencode(),
+                   'previous_page': page - 1 if page > 1 else None,
+                   'next_page': page + 1 if page * per_page < results.total else None}
+        return render(self.request, 'search.html', context)
+
+
+class ItemDetailView(ReplicaReadsMixin, DetailView):
     model = Item
     template_name = 'product-page.html'
+    detail_template_name = 'includes/product_detail.html'
     context_object_name = 'item'
 
+    def get(self, request, *args, **kwargs):
+        page = self.get_product_page()
+        etag, last_modified = self.get_validators(page)
+        timestamp = last_modified and int(last_modified.timestamp())
+        response = None
+        # A 304 would leave pending messages for whatever page comes next
+        if not len(messages.get_messages(request)):
+            response = get_conditional_response(
+                request, etag=etag, last_modified=timestamp)
+        if response is None:
+            response = render(request, self.template_name,
+                              {'product_detail': mark_safe(page['html'])})
+        response['ETag'] = etag
+        if timestamp:
+            response['Last-Modified'] = http_date(timestamp)
+        # Revalidated on every view: the validators are cheap, and the
+        # navbar differs per visitor
+        if request.user.is_authenticated:
+            patch_cache_control(response, no_cache=True, private=True)
+        else:
+            patch_cache_control(response, no_cache=True)
+        patch_vary_headers(response, ['Cookie'])
+        return response
+
+    def get_product_page(self):
+        # The item's part of the page is the same for every visitor, so it
+        # is cached per slug under a version that saves of the item bump
+        slug = self.kwargs[self.slug_url_kwarg]
+        cache = get_cache()
+        key, version_key = product_page_key(slug), product_version_key(slug)
+        found = cache.get_many([key, version_key])
+        page = found.get(key)
+        if page is not None and page['version'] == found.get(version_key):
+            product_stats.hit()
+            return page
+
+        product_stats.miss()
+        # Read before the item, so a save racing this one leaves the entry stale
+        version = get_version(version_key)
+        self.object = self.get_object()
+        page = {'version': version,
+                'updated_at': self.object.updated_at,
+                'html': render_to_string(self.detail_template_name,
+                                         {'item': self.object}, self.request)}
+        cache.set(key, page, db.fill_timeout(settings.PRODUCT_CACHE_TIMEOUT))
+        return page
+
+    def get_validators(self, page):
+        """``(etag, last_modified)`` of the whole page for this visitor."""
+        stamp = page['updated_at'].timestamp()
+        if self.request.user.is_authenticated:
+            # The cart badge changes without the item changing, so only
+            # the ETag, which covers both, can tell
+            count = get_cart_summary(self.request.user)['count']
+            return make_etag('product', stamp, 'user', self.request.user.pk, count), None
+        return make_etag('product', stamp), page['updated_at']
+
 
 class OrderSummaryView(LoginRequiredMixin, View):
     def get(self, *args, **kwargs):
         try:
-            object = Order.objects.get(user=self.request.user, ordered=False)
+            object = get_cart_queryset().get(
+                user=self.request.user, ordered=False)
         except ObjectDoesNotExist:
             messages.warning(self.request, 'You do not have an active order')
             return redirect('/')
         return render(self.request, 'order-summary.html', {'object': object})
 
 
+def get_order_history_queryset(user):
+    # Lines carry their own title and prices once ordered, so Item is
+    # never joined; a page is two queries however many orders it holds
+    return Order.objects.filter(user=user, ordered=True).select_related(
+        'payment', 'coupon', 'billing_address', 'shipping_address'
+    ).prefetch_related('items')
+
+
+class OrderHistoryView(LoginRequiredMixin, View):
+    cursor_kwarg = 'cursor'
+
+    def get(self, *args, **kwargs):
+        paginator = CursorPaginator(
+            get_order_history_queryset(self.request.user),
+            settings.ORDER_HISTORY_PER_PAGE, ('-ordered_date', '-id'))
+        try:
+            page = paginator.page(self.request.GET.get(self.cursor_kwarg))
+        except InvalidCursor:
+            raise Http404('Invalid cursor')
+        addresses = {address.address_type: address for address in
+                     Address.objects.filter(user=self.request.user, default=True)}
+        context = {'orders': page.object_list,
+                   'cursor_page': page,
+                   'default_shipping': addresses.get(Address.SHIPPING),
+                   'default_billing': addresses.get(Address.BILLING)}
+        return render(self.request, 'order-history.html', context)
+
+
+PAYMENT_PENDING_MESSAGE = 'Your cart cannot change while its payment is being processed'
+
+
 @login_required
 def add_to_cart(request, slug):
     item = get_object_or_404(Item, slug=slug)
-    order_item, created = OrderItem.objects.get_or_create(
-        item=item, user=request.user, ordered=False)
-    order_qs = Order.objects.filter(user=request.user, ordered=False)
-    if order_qs.exists():
-        order = order_qs[0]
-        if order.items.filter(item__slug=item.slug).exists():
-            order_item.quantity += 1
-            order_item.save()
-            messages.info(
-                request, 'This item quantity was updated to your cart')
-        else:
-            messages.info(request, 'This item was added to your cart')
-            order.items.add(order_item)
-
+    status = cart.add_item(request.user, item)
+    if status == cart.OUT_OF_STOCK:
+        messages.warning(request, 'Sorry, this item is sold out')
+        return redirect('core:product_url', slug=slug)
+    if status == cart.PAYMENT_PENDING:
+        messages.warning(request, PAYMENT_PENDING_MESSAGE)
+        return redirect('core:product_url', slug=slug)
+    if status == cart.UPDATED:
+        messages.info(request, 'This item quantity was updated to your cart')
     else:
-        ordered_date = timezone.now()
-        order = Order.objects.create(
-            user=request.user, ordered_date=ordered_date)
-        order.items.add(order_item)
         messages.info(request, 'This item was added to your cart')
     return redirect('core:order-summary_url')
 
@@ -74,17 +254,13 @@ def add_to_cart(request, slug):
 @login_required
 def remove_from_cart(request, slug):
     item = get_object_or_404(Item, slug=slug)
-
-    order_qs = Order.objects.filter(user=request.user, ordered=False)
-    if order_qs.exists():
-        order = order_qs[0]
-        if order.items.filter(item__slug=item.slug).exists():
-            order_item = OrderItem.objects.filter(
-                item=item, user=request.user, ordered=False)[0]
-            order.items.remove(order_item)
-            messages.info(request, 'This item was removed from your cart')
-        else:
-            messages.info(request, 'This item was not in your cart')
+    status = cart.remove_item(request.user, item)
+    if status == cart.REMOVED:
+        messages.info(request, 'This item was removed from your cart')
+    elif status == cart.PAYMENT_PENDING:
+        messages.warning(request, PAYMENT_PENDING_MESSAGE)
+    elif status == cart.NOT_IN_CART:
+        messages.info(request, 'This item was not in your cart')
     else:
         messages.info(request, 'You do not have an active order')
     return redirect('core:product_url', slug=slug)
@@ -93,22 +269,15 @@ def remove_from_cart(request, slug):
 @login_required
 def remove_single_item_from_cart(request, slug):
     item = get_object_or_404(Item, slug=slug)
-
-    order_qs = Order.objects.filter(user=request.user, ordered=False)
-    if order_qs.exists():
-        order = order_qs[0]
-        if order.items.filter(item__slug=item.slug).exists():
-            order_item = OrderItem.objects.filter(
-                item=item, user=request.user, ordered=False)[0]
-            if order_item.quantity > 1:
-                order_item.quantity -= 1
-                order_item.save()
-                messages.info(request, 'This item quantity was updated')
-            else:
-                order.items.remove(order_item)
-                messages.info(request, 'This item was removed from your cart')
-        else:
-            messages.info(request, 'This item was not in your cart')
+    status = cart.decrement_item(request.user, item)
+    if status == cart.UPDATED:
+        messages.info(request, 'This item quantity was updated')
+    elif status == cart.REMOVED:
+        messages.info(request, 'This item was removed from your cart')
+    elif status == cart.PAYMENT_PENDING:
+        messages.warning(request, PAYMENT_PENDING_MESSAGE)
+    elif status == cart.NOT_IN_CART:
+        messages.info(request, 'This item was not in your cart')
     else:
         messages.info(request, 'You do not have an active order')
     return redirect('core:order-summary_url')
@@ -126,7 +295,8 @@ def is_valid_form(values):
 class CheckoutView(View):
     def get(self, *args, **kwargs):
         try:
-            order = Order.objects.get(user=self.request.user, ordered=False)
+            order = get_cart_queryset().get(
+                user=self.request.user, ordered=False)
             form = CheckoutForm()
             context = {'form': form,
                        'couponForm': CouponForm(),
@@ -288,25 +458,18 @@ class CheckoutView(View):
 
 class PaymentView(View):
     def get(self, *args, **kwargs):
-        order = Order.objects.get(user=self.request.user, ordered=False)
+        order = get_cart_queryset().get(user=self.request.user, ordered=False)
         if order.billing_address:
             context = {
                 'order': order, 
                 'DISPLAY_COUPON_FORM': False,
                 'STRIPE_PUBLIC_KEY': settings.STRIPE_PUBLIC_KEY
             }
-            userprofile = self.request.user.userprofile
-            if userprofile.one_click_purchasing:
-                cards = stripe.Customer.list_sources(
-                    userprofile.stripe_customer_id,
-                    limit = 3,
-                    object = 'card'
-                )
-                card_list = cards['data']
-                if len(card_list) > 0:
-                    context.update({
-                        'card':card_list[0]
-                    })
+            card = payments.default_card(self.request.user.userprofile)
+            if card:
+                context.update({
+                    'card': card
+                })
             return render(self.request, 'payment.html', context=context)
         else:
             messages.warning(
@@ -316,137 +479,66 @@ class PaymentView(View):
     def post(self, *args, **kwargs):
         order = Order.objects.get(user=self.request.user, ordered=False)
         form = PaymentForm(self.request.POST)
-        userprofile = UserProfile.objects.get(user=self.request.user)
         if form.is_valid():
             token = form.cleaned_data['stripeToken']
             save = form.cleaned_data['save']
             use_default = form.cleaned_data['use_default']
-            
-
-            if save:
-                if userprofile.stripe_customer_id != '' and userprofile.stripe_customer_id is not None:
-                    customer = stripe.Customer.retrieve(
-                        userprofile.stripe_customer_id)
-                    customer.sources.create(source=token)
-
-                else:
-                    customer = stripe.Customer.create(
-                        email=self.request.user.email,
-                        source=token
-                    )
-                    userprofile.stripe_customer_id = customer['id']
-                    userprofile.one_click_purchasing = True
-                    userprofile.save()
-
-
-            amount = int(order.get_total() * 100)
 
             try:
-                # Use Stripe's library to make requests...
-                if use_default or save:
-                    charge = stripe.Charge.create(
-                        amount=amount,  # cents
-                        currency="usd",
-                        customer=userprofile.stripe_customer_id
-                    )
-                else:
-                    charge = stripe.Charge.create(
-                        amount=amount,  # cents
-                        currency="usd",
-                        source=token
-                    )
-                # create payment
-                payment = Payment()
-                payment.stripe_charge_id = charge['id']
-                payment.user = self.request.user
-                payment.amount = order.get_total()
-                payment.save()
-
-                # assign the payment to the order
-                order_items = order.items.all()
-                order_items.update(ordered=True)
-                for item in order_items:
-                    item.save()
-
-                order.ordered = True
-                order.payment = payment
-                order.ref_code = create_ref_code()
-                order.save()
-
-                messages.success(self.request, 'Your order was successful')
-                return redirect('/')
-
-            except stripe.error.CardError as e:
-                # Since it's a decline, stripe.error.CardError will be caught
-                messages.warning(self.request, f"{e.user_message}")
-                print('Status is: %s' % e.http_status)
-                print('Code is: %s' % e.code)
-                # param is '' in this case
-                print('Param is: %s' % e.param)
-                print('Message is: %s' % e.user_message)
-                return redirect('/')
-
-            except stripe.error.RateLimitError as e:
-                # Too many requests made to the API too quickly
-                messages.warning(self.request, "Rate Limit Error")
-                return redirect('/')
-
-            except stripe.error.InvalidRequestError as e:
-                # Invalid parameters were supplied to Stripe's API
-                messages.warning(self.request, "Invalid Request")
-                return redirect('/')
-
-            except stripe.error.AuthenticationError as e:
-                # Authentication with Stripe's API failed
-                # (maybe you changed API keys recently)
-                messages.warning(self.request, "Not Authenticated")
-                return redirect('/')
-
-            except stripe.error.APIConnectionError as e:
-                # Network communication with Stripe failed
-                messages.warning(self.request, "Network Error")
-                return redirect('/')
-
-            except stripe.error.StripeError as e:
-                # Display a very generic error to the user, and maybe send
-                # yourself an email
-                messages.warning(
-                    self.request, "Something went wrong. You were not charged. Please try again")
-                return redirect('/')
+                if settings.PAYMENT_MODE == 'async':
+                    attempt = payments.start_payment(order, token, save, use_default)
+                    return redirect('core:payment-status_url', key=attempt.key)
+                # Committed before Stripe is called, and undone if it declines;
+                # the pending attempt keeps the cart still meanwhile
+                attempt, created = payments.open_attempt(order)
+            except inventory.OutOfStock as e:
+                messages.warning(self.request, str(e))
+                return redirect('core:order-summary_url')
+            if not created:
+                # Submitted again while the first charge is running
+                return redirect('core:payment-status_url', key=attempt.key)
 
+            try:
+                attempt = payments.process_payment(attempt.pk, token, save, use_default)
             except Exception as e:
-                # Something else happened, completely unrelated to Stripe
-                messages.warning(
-                    self.request, "A serious error occurred. We've been notified")
+                messages.warning(self.request, payments.error_message(e))
                 return redirect('/')
+            if attempt.status == PaymentAttempt.SUCCEEDED:
+                messages.success(self.request, 'Your order was successful')
+            else:
+                messages.warning(self.request, attempt.error)
+            return redirect('/')
 
 
-def get_coupon(request, code):
-    try:
-        coupon = Coupon.objects.get(code=code)
-        return coupon
-    except ObjectDoesNotExist:
-        messages.warning(request, 'This code does not exist')
-        return redirect('core:checkout_url')
+class PaymentStatusView(LoginRequiredMixin, View):
+    def get(self, *args, **kwargs):
+        attempt = get_object_or_404(PaymentAttempt, key=kwargs['key'],
+                                    user=self.request.user)
+        if (attempt.status == PaymentAttempt.PENDING
+                and not payments.payment_pending(attempt.order_id)):
+            attempt.refresh_from_db()
+        if attempt.status == PaymentAttempt.SUCCEEDED:
+            messages.success(self.request, 'Your order was successful')
+            return redirect('/')
+        if attempt.status == PaymentAttempt.FAILED:
+            messages.warning(self.request, attempt.error)
+            return redirect('/')
+        return render(self.request, 'payment-status.html', {'attempt': attempt})
 
 
-class AddCouponView(View):
+class AddCouponView(LoginRequiredMixin, View):
     def post(self, *args, **kwargs):
         form = CouponForm(self.request.POST or None)
         if form.is_valid():
             try:
-                code = form.cleaned_data.get('code')
-                order = Order.objects.get(
-                    user=self.request.user, ordered=False)
-                order.coupon = get_coupon(self.request, code)
-                order.save()
+                coupons.apply(self.request.user, form.cleaned_data.get('code'))
                 messages.success(self.request, 'Successfully added coupon')
-                return redirect('core:checkout_url')
-
+            except coupons.CouponError as e:
+                messages.warning(self.request, str(e))
             except ObjectDoesNotExist:
                 messages.warning(
                     self.request, 'You do not have an active order')
-                return redirect('core:checkout_url')
+        return redirect('core:checkout_url')
 
 
 class RequestRefundView(View):